@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 import json
-from typing import Optional
 
 from fedservice.entity import get_verified_trust_chains
+from fedservice.entity.function.crawler import Crawler
 from fedservice.entity.function.trust_chain_collector import verify_self_signed_signature
 from fedservice.utils import make_federation_entity
 
@@ -15,24 +15,6 @@ def get_entity_configuration(federation_entity, entity_id: str):
     return verify_self_signed_signature(_jws)
 
 
-def do_subordinates(federation_entity, entity_id: str, superior: Optional[str] = "") -> dict:
-    entity_configuration = get_entity_configuration(federation_entity, entity_id)
-    if superior:
-        if superior not in entity_configuration["authority_hints"]:
-            print(f"ERROR! {superior} not in authority_hints for {entity_id}")
-
-    if "federation_list_endpoint" in entity_configuration["metadata"]["federation_entity"]:
-        res = {}
-        endpoint = entity_configuration["metadata"]["federation_entity"]["federation_list_endpoint"]
-        # Ask the superior for the subordinates
-        _list_response = federation_entity.client.do_request('list', endpoint=endpoint)
-        if _list_response:
-            for sub in _list_response:
-                res.update(do_subordinates(federation_entity, sub, entity_id))
-        return res
-    else:
-        return {entity_id: {}}
-
 def find_trust_chain(federation_entity, item, trust_anchor):
     for entity_id, subordinates in item.items():
         trust_chains = get_verified_trust_chains(federation_entity, entity_id)
@@ -53,6 +35,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', "--trust_chains", action='store_true')
     parser.add_argument('-k', "--insecure", action='store_true')
+    parser.add_argument('-w', "--workers", type=int, default=8)
+    parser.add_argument('-d', "--checkpoint_dir", default="")
     parser.add_argument(dest="root_entity_id")
     args = parser.parse_args()
 
@@ -70,7 +54,14 @@ if __name__ == '__main__':
     if args.insecure:
         federation_entity.keyjar.httpc_params = {"verify": False}
 
-    res = do_subordinates(federation_entity, entity_id=args.root_entity_id)
+    crawler = Crawler(upstream_get=federation_entity.unit_get, max_workers=args.workers,
+                      checkpoint_dir=args.checkpoint_dir)
+    graph = crawler.crawl(args.root_entity_id, resume=bool(args.checkpoint_dir))
+    for entity_id, node in graph.nodes.items():
+        if node["error"]:
+            print(f"ERROR! {entity_id}: {node['error']}")
+
+    res = graph.tree()
 
     print(res)
 
@@ -204,13 +204,12 @@ def wkof():
     metadata = _srv.get_metadata()
     _fe = current_app.federation_entity
     _ctx = _fe.context
-    iss = sub = _ctx.entity_id
-    _statement = _ctx.create_entity_statement(
-        metadata=metadata,
-        iss=iss, sub=sub,
-        authority_hints=_fe.get_authority_hints(),
-        lifetime=_ctx.default_lifetime)
-
-    response = make_response(_statement)
-    response.headers['Content-Type'] = 'application/jose; charset=UTF-8'
+    _statement, _etag = _ctx.signed_entity_configuration(
+        metadata=metadata, authority_hints=_fe.get_authority_hints())
+    if request.headers.get('If-None-Match') == _etag:
+        response = make_response('', 304)
+    else:
+        response = make_response(_statement)
+        response.headers['Content-Type'] = 'application/jose; charset=UTF-8'
+    response.headers['ETag'] = _etag
     return response
@@ -37,13 +37,17 @@ def do_endpoints(conf, upstream_get):
         return {}
 
 
-def import_client_keys(information: Union[Message, dict], keyjar: KeyJar, entity_id: str):
+def import_client_keys(information: Union[Message, dict], keyjar: KeyJar, entity_id: str,
+                       httpc: Optional[Callable] = None):
     _signed_jwks_uri = information.get('signed_jwks_uri')
     if _signed_jwks_uri:
         pass
     else:
         _jwks_uri = information.get('jwks_uri')
         if _jwks_uri:
+            if httpc:
+                # Load the keys over the same pooled connections as the federation fetches
+                keyjar.return_issuer(entity_id).httpc = httpc
             # if it can't load keys because the URL is false it will
             # just silently fail. Waiting for better times.
             keyjar.add_url(entity_id, _jwks_uri)
@@ -70,7 +70,8 @@ class Authorization(authorization.Authorization):
 
         # handle the registration request as in the non-federation case.
         # If there is a signed_jwks_uri, jwks_uri or jwks in the metadata import keys
-        import_client_keys(trust_chain.metadata['oauth_client'], self.upstream_get('attribute', 'keyjar'), entity_id)
+        import_client_keys(trust_chain.metadata['oauth_client'], self.upstream_get('attribute', 'keyjar'), entity_id,
+                           httpc=_fe.httpc)
 
         req = OauthClientMetadata(**trust_chain.metadata['oauth_client'])
         req['client_id'] = entity_id
@@ -62,7 +62,8 @@ class PushedAuthorization(Authorization):
         _metadata = trust_chain.metadata['oauth_client']
 
         # If there is a signed_jwks_uri, jwks_uri or jwks in the metadata import the keys
-        import_client_keys(_metadata, self.upstream_get('attribute', 'keyjar'), entity_id)
+        import_client_keys(_metadata, self.upstream_get('attribute', 'keyjar'), entity_id,
+                           httpc=_fe.httpc)
 
         req = OauthClientMetadata(**_metadata)
         req['client_id'] = entity_id
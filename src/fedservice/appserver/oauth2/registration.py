@@ -292,7 +292,8 @@ class Registration(Endpoint):
                             logger.warning('Lacking support for "{}"'.format(request[item]))
                             del _cinfo[item]
 
-        import_client_keys(request, _keyjar, client_id)
+        import_client_keys(request, _keyjar, client_id,
+                           httpc=getattr(get_federation_entity(self), "httpc", None))
         logger.debug(f"Keys for {client_id}: {_keyjar.key_summary(client_id)}")
 
         return _cinfo
@@ -10,9 +10,9 @@ from idpyoidc.configure import Configuration
 from idpyoidc.message import Message
 from idpyoidc.node import Unit
 from idpyoidc.server.util import execute
-from requests import request
 
 from fedservice.entity import FederationEntity
+from fedservice.http_client import HTTPClient
 
 logger = logging.getLogger(__name__)
 
@@ -91,8 +91,11 @@ class FederationCombo(Combo):
                  keyjar: Optional[Union[KeyJar, bool]] = None,
                  httpc_params: Optional[dict] = None
                  ):
+        # Only a HTTP client created here is closed by close()
+        self._own_httpc = httpc is None
         if httpc is None:
-            httpc = request
+            # One managed client with keep-alive connection pools shared by all parts
+            httpc = HTTPClient(**config.get("http_client", {}))
 
         if 'keyjar' not in config and 'key_conf' not in config:
             Combo.__init__(self, config=config, httpc=httpc, entity_id=entity_id, keyjar=False,
@@ -101,6 +104,13 @@ class FederationCombo(Combo):
             Combo.__init__(self, config=config, httpc=httpc, entity_id=entity_id, keyjar=keyjar,
                            httpc_params=httpc_params)
 
+    def close(self):
+        """
+        Close the keep-alive connections of the HTTP client if this combo created it.
+        """
+        if self._own_httpc and isinstance(self.httpc, HTTPClient):
+            self.httpc.close()
+
     def _get_httpc_params(self, config):
         _hp = config.get("httpc_params")
         if _hp:
@@ -214,9 +214,32 @@ FEDERATION_ENTITY_FUNCTIONS = {
     }
 }
 
+# Functions that are only there if asked for by name in the configuration. The asynchronous
+# trust chain collector, the crawler and the federation index are otherwise created when
+# first needed.
+OPTIONAL_FEDERATION_ENTITY_FUNCTIONS = {
+    "async_trust_chain_collector": {
+        "class": 'fedservice.entity.function.async_trust_chain_collector.AsyncTrustChainCollector',
+        "kwargs": {}
+    },
+    "refresh_scheduler": {
+        "class": 'fedservice.entity.function.refresh_scheduler.RefreshScheduler',
+        "kwargs": {}
+    },
+    "crawler": {
+        "class": 'fedservice.entity.function.crawler.Crawler',
+        "kwargs": {}
+    },
+    "federation_index": {
+        "class": 'fedservice.entity.function.federation_index.FederationIndex',
+        "kwargs": {}
+    }
+}
+
 
 def federation_functions(*apis):
-    return {a: FEDERATION_ENTITY_FUNCTIONS[a] for a in apis}
+    return {a: FEDERATION_ENTITY_FUNCTIONS.get(a) or OPTIONAL_FEDERATION_ENTITY_FUNCTIONS[a]
+            for a in apis}
 
 
 DEFAULT_FEDERATION_ENTITY_FUNCTIONS = federation_functions("trust_chain_collector", "verifier",
@@ -1,23 +1,29 @@
 import logging
 from typing import Callable
+from typing import Iterator
+from typing import List
 from typing import Optional
 from typing import Union
 
-from cryptojwt import as_unicode
 from cryptojwt import KeyJar
-from cryptojwt.jws.jws import factory
 from cryptojwt.utils import importer
 from idpyoidc.client.client_auth import client_auth_setup
 from idpyoidc.server.util import execute
 from idpyoidc.util import instantiate
-from requests import request
 
 from fedservice import message
+from fedservice.http_client import HTTPClient
 from fedservice.entity.function import apply_policies
 from fedservice.entity.function import collect_trust_chains
 from fedservice.entity.function import get_payload
 from fedservice.entity.function import get_verified_trust_chains
+from fedservice.entity.function import refresh_trust_chain
 from fedservice.entity.function import verify_trust_chains
+from fedservice.entity.function.async_trust_chain_collector import AsyncTrustChainCollector
+from fedservice.entity.function.batch_resolver import BatchResolver
+from fedservice.entity.function.crawler import Crawler
+from fedservice.entity.function.crawler import FederationGraph
+from fedservice.entity.function.federation_index import FederationIndex
 
 __author__ = 'Roland Hedberg'
 
@@ -46,11 +52,19 @@ class FederationEntity(Unit):
                  authority_hints: Optional[Union[list, str, Callable]] = None,
                  persistence: Optional[dict] = None,
                  client_authn_methods: Optional[list] = None,
+                 http_client: Optional[dict] = None,
                  **kwargs
                  ):
 
-        if upstream_get is None and httpc is None:
-            httpc = request
+        if httpc is None and upstream_get is not None and http_client is None:
+            # Use the HTTP client of the entity this entity is part of
+            httpc = upstream_get("attribute", "httpc")
+        # Only a HTTP client created here is closed by close()
+        self._own_httpc = httpc is None
+        if httpc is None:
+            # A managed client with keep-alive connection pools, shared by the collector,
+            # the services and the key jar.
+            httpc = HTTPClient(**(http_client or {}))
 
         if not keyjar and not key_conf:
             keyjar = False
@@ -81,6 +95,11 @@ class FederationEntity(Unit):
             self.context.client_authn_methods = client_auth_setup(client_authn_methods)
 
         self.trust_chain = {}
+        # Used if no asynchronous collector, crawler or federation index is configured as a
+        # function
+        self._async_trust_chain_collector = None
+        self._crawler = None
+        self._federation_index = None
 
         self.context.provider_info = self.context.claims.get_server_metadata(
             endpoints=self.server.endpoint.values(),
@@ -98,6 +117,14 @@ class FederationEntity(Unit):
             else:
                 self.persistence = _class(**kwargs)
 
+    def close(self):
+        """
+        Close the keep-alive connections of the HTTP client if this entity created it.
+        A HTTP client that was handed to the entity is left to its owner.
+        """
+        if self._own_httpc and isinstance(self.httpc, HTTPClient):
+            self.httpc.close()
+
     def get_context(self, *arg):
         return self.context
 
@@ -241,9 +268,7 @@ class FederationEntity(Unit):
         return _trust_chains[_tas[0]]
 
     def get_payload(self, self_signed_statement):
-        _jws = as_unicode(self_signed_statement)
-        _jwt = factory(_jws)
-        return _jwt.jwt.payload()
+        return get_payload(self_signed_statement)
 
     def supported(self):
         _supports = self.context.supports()
@@ -265,8 +290,33 @@ class FederationEntity(Unit):
                         _info[md_param] = _val
         return _info
 
+    def stored_trust_chains(self, entity_id: str) -> Optional[list]:
+        """
+        Stored trust chains for an entity. Trust chains that have expired are refreshed by
+        refetching the statements that have expired.
+
+        :return: List of TrustChain instances or None if there are no stored trust chains or
+            they could not be refreshed.
+        """
+        _trust_chains = self.trust_chain.get(entity_id)
+        if not _trust_chains:
+            return None
+
+        _refreshed = []
+        for trust_chain in _trust_chains:
+            _trust_chain = refresh_trust_chain(self, trust_chain)
+            if _trust_chain is None:
+                logger.debug(f"Could not refresh the trust chains for '{entity_id}'")
+                del self.trust_chain[entity_id]
+                return None
+            _refreshed.append(_trust_chain)
+
+        if _refreshed != _trust_chains:
+            self.store_trust_chain(entity_id, _refreshed)
+        return _refreshed
+
     def get_trust_chains(self, entity_id):
-        _trust_chains = self.trust_chain.get(entity_id, None)
+        _trust_chains = self.stored_trust_chains(entity_id)
         if _trust_chains is None:
             _trust_chains = get_verified_trust_chains(self, entity_id)
             if _trust_chains:
@@ -276,6 +326,25 @@ class FederationEntity(Unit):
 
         return _trust_chains
 
+    def resolve_many(self, entity_ids: List[str], max_workers: Optional[int] = 8,
+                     store: Optional[bool] = False) -> BatchResolver:
+        """
+        Resolve the trust chains of many entities in parallel.
+
+        :param entity_ids: List of entity IDs
+        :param max_workers: Max number of entities resolved in parallel
+        :param store: Whether the trust chains should be stored
+        :return: A BatchResolver instance. Iterate over it to get (entity ID, list of
+            TrustChain instances or exception) tuples as they are done. Timing information
+            is available through its `timings` attribute.
+        """
+        return BatchResolver(self, entity_ids, max_workers=max_workers,
+                             on_result=self._store_result if store else None)
+
+    def _store_result(self, entity_id: str, result):
+        if result and isinstance(result, list):
+            self.store_trust_chain(entity_id, result)
+
     def store_trust_chain(self, entity_id, trust_chains):
         self.trust_chain[entity_id] = trust_chains
 
@@ -283,7 +352,7 @@ class FederationEntity(Unit):
         self.trust_chain[entity_id] = chains
 
     def get_verified_metadata(self, entity_id: str, *args):
-        _trust_chains = self.trust_chain.get(entity_id)
+        _trust_chains = self.stored_trust_chains(entity_id)
         if _trust_chains is None:
             _trust_chains = get_verified_trust_chains(self, entity_id)
             if _trust_chains:
@@ -313,7 +382,68 @@ class FederationEntity(Unit):
                                       request_args=request_args, behaviour_args=behaviour_args,
                                       **kwargs)
 
-    def trawl(self, superior, subordinate, entity_type):
+    def get_async_trust_chain_collector(self) -> AsyncTrustChainCollector:
+        _collector = self.get_function("async_trust_chain_collector")
+        if _collector:
+            return _collector
+        if self._async_trust_chain_collector is None:
+            self._async_trust_chain_collector = AsyncTrustChainCollector(
+                upstream_get=self.unit_get)
+        return self._async_trust_chain_collector
+
+    def get_crawler(self) -> Crawler:
+        _crawler = self.get_function("crawler")
+        if _crawler:
+            return _crawler
+        if self._crawler is None:
+            self._crawler = Crawler(upstream_get=self.unit_get)
+        return self._crawler
+
+    def get_federation_index(self) -> FederationIndex:
+        _index = self.get_function("federation_index")
+        if _index:
+            return _index
+        if self._federation_index is None:
+            self._federation_index = FederationIndex(upstream_get=self.unit_get)
+        return self._federation_index
+
+    def crawl(self, root: str, max_age: Optional[int] = None) -> FederationGraph:
+        """
+        The federation below an entity. A graph from an earlier crawl is reused if it is
+        recent enough, otherwise it is brought up to date.
+
+        :param root: The entity to start from, normally a trust anchor
+        :param max_age: How old, in seconds, the graph may be
+        :return: A FederationGraph instance
+        """
+        return self.get_crawler().get_graph(root, max_age=max_age)
+
+    def trawl(self, superior, subordinate, entity_type, max_age: Optional[int] = None):
+        """
+        Find the entities of a specific type in the federation below an entity, the entity
+        itself included. The result comes from a crawl that may be up to `max_age` seconds
+        old, entities added after that are not found. Use a `max_age` of 0 to always crawl.
+
+        :param superior: The superior of the entity to start from. Not used.
+        :param subordinate: The entity to start from
+        :param entity_type: The entity type to look for
+        :param max_age: How old, in seconds, the crawl may be. Default is the crawler's.
+        :return: List of entity IDs
+        """
+        return self.crawl(subordinate, max_age=max_age).entities(entity_type=entity_type)
+
+    def iter_trawl(self, superior: str, subordinate: str, entity_type: str,
+                   page_size: Optional[int] = 100) -> Iterator[str]:
+        """
+        Walk the federation tree below an entity looking for entities of a specific type.
+        The subordinates are listed page by page as the search proceeds.
+
+        :param superior: The superior of the entity to start from
+        :param subordinate: The entity to start from
+        :param entity_type: The entity type to look for
+        :param page_size: Number of entity IDs asked for per List request
+        :return: Iterator over entity IDs
+        """
         if subordinate in self.function.trust_chain_collector.config_cache:
             _ec = self.function.trust_chain_collector.config_cache[subordinate]
         else:
@@ -327,36 +457,21 @@ class FederationEntity(Unit):
             _ec = self.client.do_request("entity_configuration", entity_id=subordinate)
 
         if entity_type in _ec["metadata"]:
-            _issuers = [_ec["sub"]]
-        else:
-            _issuers = []
+            yield _ec["sub"]
 
         if "federation_list_endpoint" not in _ec["metadata"]["federation_entity"]:
-            return _issuers
+            return
 
+        _list = self.client.get_service("list")
         # One step down the tree
         # All subordinates that are of a specific entity_type
-        _added_issuers = self.client.do_request("list",
-                                                entity_id=subordinate,
-                                                entity_type=entity_type)
-        if _added_issuers is None:
-            pass
-        else:
-            _issuers.extend(_added_issuers)
-
-        # All subordinates that are intermediates
-        _intermediates = self.client.do_request("list",
-                                                entity_id=subordinate,
-                                                intermediate=True)
-
-        # For all intermediates go further down the tree
-        if _intermediates:
-            for entity_id in _intermediates:
-                _ids = self.trawl(subordinate, entity_id, entity_type)
-                if _ids:
-                    _issuers.extend(_ids)
+        for entity_id in _list.iterate(subordinate, limit=page_size, entity_type=entity_type):
+            yield entity_id
 
-        return _issuers
+        # For all subordinates that are intermediates go further down the tree
+        for entity_id in _list.iterate(subordinate, limit=page_size, intermediate=True):
+            for _id in self.iter_trawl(subordinate, entity_id, entity_type, page_size):
+                yield _id
 
     def verify_trust_mark(self, trust_mark: str, check_with_issuer: Optional[bool] = True):
         _trust_mark_payload = get_payload(trust_mark)
@@ -406,6 +521,14 @@ class FederationEntity(Unit):
 
         _keyjar = import_jwks(_keyjar, jwks, entity_id)
         self.trust_anchors[entity_id] = jwks
+        # Trust chains verified using the old keys must be verified again
+        _verifier = self.get_function("verifier")
+        if _verifier and hasattr(_verifier, "clear_cache"):
+            _verifier.clear_cache()
+        # As must resolve responses for the trust anchor
+        _resolve = getattr(self.server, "endpoint", {}).get("resolve")
+        if _resolve and hasattr(_resolve, "clear_cache"):
+            _resolve.clear_cache(anchor=entity_id)
 
     def supports(self):
         res = {}
@@ -274,6 +274,9 @@ class FederationClient(FederationClientEntity):
             entity_id=entity_id,
         )
 
+        if httpc is None and upstream_get is not None:
+            # Use the HTTP client of the entity this client is part of
+            httpc = upstream_get("attribute", "httpc")
         self.httpc = httpc or request
 
         if isinstance(config, Configuration):
@@ -4,7 +4,6 @@ from typing import Optional
 from typing import Union
 from urllib.parse import urlparse
 
-import requests
 from idpyoidc.client.configure import Configuration
 from idpyoidc.message import oauth2
 from idpyoidc.message.oauth2 import ResponseMessage
@@ -45,7 +44,6 @@ class EntityConfiguration(FederationService):
                  conf: Optional[Union[dict, Configuration]] = None):
         """The service that talks to the OIDC federation well-known endpoint."""
         FederationService.__init__(self, upstream_get, conf=conf)
-        self.httpc = requests.request
         self.httpc_params = {}
 
     def get_request_parameters(
@@ -1,4 +1,5 @@
 from typing import Callable
+from typing import Iterator
 from typing import Optional
 from typing import Union
 from urllib.parse import urlencode
@@ -47,7 +48,8 @@ class List(FederationService):
             endpoint = get_verified_endpoint(self, entity_id, self.endpoint_name)
 
         qpart = {}
-        for arg in ["entity_type", "trust_marked", "trust_mark_id", "intermediate"]:
+        for arg in ["entity_type", "trust_marked", "trust_mark_id", "intermediate", "limit",
+                    "from"]:
             val = kwargs.get(arg)
             if val:
                 qpart[arg] = val
@@ -56,3 +58,42 @@ class List(FederationService):
             return {"url": f"{endpoint}?{urlencode(qpart)}", 'method': self.http_method}
         else:
             return {"url": f"{endpoint}", 'method': self.http_method}
+
+    def iterate(self, entity_id: str, limit: Optional[int] = 100, endpoint: Optional[str] = "",
+                before_request: Optional[Callable] = None, **kwargs) -> Iterator[str]:
+        """
+        Go through an entity's subordinates one page at the time. A page is only asked for
+        when the entity IDs in the one before have been consumed.
+
+        :param entity_id: The entity whose subordinates should be listed
+        :param limit: Number of entity IDs per page
+        :param endpoint: The List endpoint. If not given it is picked up from a verified
+            entity configuration.
+        :param before_request: Called before each page is asked for
+        :param kwargs: Filters, like entity_type or intermediate
+        :return: Iterator over entity IDs
+        """
+        _client = self.upstream_get("unit")
+        _endpoint = endpoint or get_verified_endpoint(self, entity_id, self.endpoint_name)
+        if not _endpoint:
+            return
+        _from = ""
+        while True:
+            _args = dict(kwargs, limit=limit)
+            if _from:
+                _args["from"] = _from
+            if before_request:
+                before_request()
+            _page = _client.do_request(self.service_name, entity_id=entity_id,
+                                       endpoint=_endpoint, **_args)
+            if not _page:
+                return
+            # A server that doesn't do paging returns the same entity IDs again
+            if _from and _page[0] <= _from:
+                return
+            for _entity_id in _page:
+                yield _entity_id
+            # A short page is the last one
+            if len(_page) != limit:
+                return
+            _from = _page[-1]
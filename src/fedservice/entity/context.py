@@ -1,10 +1,14 @@
+import hashlib
 import json
+import threading
 from typing import Callable
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import Union
 
 from cryptojwt import KeyJar
+from cryptojwt.jwt import utc_time_sans_frac
 from idpyoidc.client.client_auth import client_auth_setup
 from idpyoidc.configure import Configuration
 from idpyoidc.impexp import ImpExp
@@ -97,6 +101,10 @@ class FederationContext(ImpExp):
         # For backward compatibility
         self.kid = {"sig": {}, "enc": {}}
 
+        # The last signed entity configuration: (digest, signed at, lifetime, body, ETag)
+        self._signed_ec = None
+        self._signed_ec_lock = threading.Lock()
+
     def supports(self):
         return self.claims._supports
 
@@ -129,6 +137,70 @@ class FederationContext(ImpExp):
                                        metadata_policy=metadata_policy,
                                        authority_hints=authority_hints, lifetime=lifetime, **kwargs)
 
+    def _entity_configuration_digest(self, key_jar, metadata, authority_hints, trust_marks,
+                                     lifetime) -> str:
+        try:
+            _keys = key_jar.get_issuer_keys("")
+        except KeyError:
+            _keys = []
+        _state = {
+            "metadata": metadata,
+            "authority_hints": authority_hints,
+            "trust_marks": trust_marks,
+            "lifetime": lifetime,
+            "keys": sorted(k.thumbprint("SHA-256").decode() for k in _keys)
+        }
+        return hashlib.sha256(
+            json.dumps(_state, sort_keys=True, default=str).encode()).hexdigest()
+
+    def signed_entity_configuration(self,
+                                    metadata: dict,
+                                    authority_hints: Optional[list] = None,
+                                    trust_marks: Optional[list] = None,
+                                    lifetime: Optional[int] = 0,
+                                    key_jar: Optional[KeyJar] = None,
+                                    refresh_fraction: Optional[float] = 0.5
+                                    ) -> Tuple[bytes, str]:
+        """
+        The entity's own signed entity configuration. It is only signed again if the metadata,
+        the keys, the authority hints or the trust marks have changed or if more than
+        `refresh_fraction` of its lifetime has passed.
+
+        :param metadata: The entity's metadata
+        :param authority_hints: Authority hints, default is the context's
+        :param trust_marks: Trust marks, default is the context's
+        :param lifetime: Lifetime of the entity configuration, default is default_lifetime
+        :param key_jar: The key jar holding the signing keys
+        :param refresh_fraction: How much of the lifetime that may pass before it is signed
+            again.
+        :return: The signed entity configuration as bytes and its ETag
+        """
+        key_jar = key_jar or self.upstream_get("attribute", "keyjar")
+        if authority_hints is None:
+            authority_hints = self.get_authority_hints()
+        if trust_marks is None:
+            trust_marks = self.get_trust_marks()
+        if not lifetime:
+            lifetime = self.default_lifetime
+
+        _digest = self._entity_configuration_digest(key_jar, metadata, authority_hints,
+                                                    trust_marks, lifetime)
+        _now = utc_time_sans_frac()
+        with self._signed_ec_lock:
+            _cached = self._signed_ec
+            if _cached and _cached[0] == _digest and _now < _cached[1] + int(
+                    _cached[2] * refresh_fraction):
+                return _cached[3], _cached[4]
+
+            _kwargs = {"trust_marks": trust_marks} if trust_marks else {}
+            _jws = create_entity_statement(self.entity_id, self.entity_id, key_jar=key_jar,
+                                           metadata=metadata, authority_hints=authority_hints,
+                                           lifetime=lifetime, **_kwargs)
+            _body = _jws.encode()
+            _etag = '"{}"'.format(hashlib.sha256(_body).hexdigest()[:32])
+            self._signed_ec = (_digest, _now, lifetime, _body, _etag)
+            return _body, _etag
+
     def map_preferred_to_registered(self, registration_response: Optional[dict] = None):
         self.claims.use = preferred_to_registered(
             self.claims.prefer,
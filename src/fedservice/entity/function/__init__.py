@@ -1,23 +1,23 @@
+import copy
+import heapq
 import logging
 from typing import Callable
+from typing import Iterator
 from typing import List
 from typing import Optional
 
-from cryptojwt import as_unicode
-from cryptojwt.jws.jws import factory
-from cryptojwt.jwt import JWT
-from cryptojwt.key_jar import KeyJar
+from cryptojwt.jwt import utc_time_sans_frac
 from idpyoidc.impexp import ImpExp
-from idpyoidc.key_import import import_jwks
 
 from fedservice.entity.utils import get_federation_entity
+from fedservice.entity_statement.parse import parse_statement
+from fedservice.entity_statement.parse import verify_self_signed
 
 logger = logging.getLogger(__name__)
 
 
 def unverified_entity_statement(signed_jwt):
-    _jws = factory(signed_jwt)
-    return _jws.jwt.payload()
+    return parse_statement(signed_jwt).claims()
 
 
 def verify_self_signed_signature(token):
@@ -29,17 +29,23 @@ def verify_self_signed_signature(token):
     :return: Payload of the signed JWT
     """
 
-    payload = unverified_entity_statement(token)
-    keyjar = KeyJar()
-    keyjar = import_jwks(keyjar, payload['jwks'], payload['iss'])
-
-    _jwt = JWT(key_jar=keyjar)
-    _val = _jwt.unpack(token)
+    _val = copy.deepcopy(verify_self_signed(token))
     _val["_jws"] = token
     return _val
 
 
-def tree2chains(unit):
+def tree2chains(unit, _memo: Optional[dict] = None):
+    """
+    Turn a collected tree into a list of chains. A subtree shared by several branches is
+    only expanded once.
+
+    :param unit: A tree as returned by the trust chain collector
+    :return: List of lists of signed statements, each ending with a statement about the
+        entity the tree was collected for.
+    """
+    if _memo is None:
+        _memo = {}
+
     res = []
     for issuer, branch in unit.items():
         if branch is None:
@@ -51,35 +57,102 @@ def tree2chains(unit):
             res.append([statement])
             continue
 
-        _lists = tree2chains(unit)
-        for l in _lists:
-            l.append(statement)
+        _lists = _memo.get(id(unit))
+        if _lists is None:
+            _lists = tree2chains(unit, _memo)
+            _memo[id(unit)] = _lists
 
-        if not res:
-            res = _lists
-        else:
-            res.extend(_lists)
+        res.extend([l + [statement] for l in _lists])
     return res
 
 
+def _anchor_rank(anchor: str, priority: List[str]) -> int:
+    try:
+        return priority.index(anchor)
+    except ValueError:
+        return len(priority)
+
+
+def iter_chains(tree: dict, priority: Optional[List[str]] = None) -> Iterator[List[str]]:
+    """
+    Lazily enumerate the chains in a collected tree. Chains ending in a trust anchor
+    early in the priority list come first and among those the shorter ones first.
+
+    :param tree: A tree as returned by the trust chain collector
+    :param priority: Trust anchor IDs in order of preference
+    :return: Iterator over chains, each a list of signed statements starting with the one
+        issued by the trust anchor.
+    """
+    priority = priority or []
+    # The best (rank, length) of the chains in each subtree
+    _best = {}
+
+    def best(unit):
+        _key = id(unit)
+        if _key not in _best:
+            _options = []
+            for authority, branch in unit.items():
+                if branch is None:
+                    continue
+                if not branch[1]:
+                    _options.append((_anchor_rank(authority, priority), 1))
+                else:
+                    _sub = best(branch[1])
+                    if _sub:
+                        _options.append((_sub[0], _sub[1] + 1))
+            _best[_key] = min(_options) if _options else None
+        return _best[_key]
+
+    _heap = []
+    _count = 0
+
+    def push(unit, partial):
+        nonlocal _count
+        for authority, (statement, sub) in [(a, b) for a, b in unit.items() if b]:
+            _partial = [statement] + partial
+            if not sub:
+                _rank = (_anchor_rank(authority, priority), len(_partial))
+                _sub = None
+            else:
+                _sub_best = best(sub)
+                if _sub_best is None:
+                    continue
+                _rank = (_sub_best[0], _sub_best[1] + len(_partial))
+                _sub = sub
+            heapq.heappush(_heap, (_rank, _count, _partial, _sub))
+            _count += 1
+
+    push(tree, [])
+    while _heap:
+        _rank, _, _partial, _sub = heapq.heappop(_heap)
+        if _sub is None:
+            yield _partial
+        else:
+            push(_sub, _partial)
+
+
 def collect_trust_chains(unit,
                          entity_id: str,
                          signed_entity_configuration: Optional[str] = "",
                          stop_at: Optional[str] = "",
-                         authority_hints: Optional[list] = None):
+                         authority_hints: Optional[list] = None,
+                         resolution: Optional[object] = None):
     _federation_entity = get_federation_entity(unit)
 
     _collector = _federation_entity.function.trust_chain_collector
+    # The collector's state for this resolution. Only passed on if given.
+    _kwargs = {"resolution": resolution} if resolution else {}
 
     # Collect the trust chains
     if signed_entity_configuration:
         entity_configuration = verify_self_signed_signature(signed_entity_configuration)
         if authority_hints:
             entity_configuration["authority_hints"] = authority_hints
-        tree = _collector.collect_tree(entity_id, entity_configuration, stop_at=stop_at)
+        tree = _collector.collect_tree(entity_id, entity_configuration, stop_at=stop_at,
+                                       **_kwargs)
     else:
         try:
-            _collector_response = _collector(entity_id, stop_at=stop_at)
+            _collector_response = _collector(entity_id, stop_at=stop_at, **_kwargs)
         except Exception as err:
             logger.error(f"Trust chain collection failed {err}")
             raise (err)
@@ -139,9 +212,7 @@ def apply_policies(unit, trust_chains):
 
 
 def get_payload(self_signed_statement):
-    _jws = as_unicode(self_signed_statement)
-    _jwt = factory(_jws)
-    return _jwt.jwt.payload()
+    return parse_statement(self_signed_statement).claims()
 
 
 class Function(ImpExp):
@@ -152,6 +223,18 @@ class Function(ImpExp):
 
 
 def get_verified_trust_chains(unit, entity_id):
+    """
+    Collect, verify and apply policies to the trust chains for an entity.
+    Concurrent resolutions of the same entity are coalesced into one.
+    """
+    _collector = get_federation_entity(unit).function.trust_chain_collector
+    _resolutions = getattr(_collector, "resolutions", None)
+    if _resolutions is None:
+        return _get_verified_trust_chains(unit, entity_id)
+    return _resolutions.do(entity_id, _get_verified_trust_chains, unit, entity_id)
+
+
+def _get_verified_trust_chains(unit, entity_id):
     chains, leaf_ec = collect_trust_chains(unit, entity_id)
     if len(chains) == 0:
         return []
@@ -161,6 +244,135 @@ def get_verified_trust_chains(unit, entity_id):
     return trust_chains
 
 
+def refresh_trust_chain(unit, trust_chain, margin: Optional[int] = 0):
+    """
+    Bring a trust chain up to date by refetching only the statements in it that have
+    expired. The statements above them are not verified again and if only the entity
+    configuration has changed the combined policies are reused.
+
+    :param unit: A Unit instance
+    :param trust_chain: A TrustChain instance
+    :param margin: Statements that expire within this many seconds are refetched too
+    :return: The trust chain, a new TrustChain instance or None if the chain could not be
+        refreshed.
+    """
+    _when = utc_time_sans_frac() + margin
+    _links = trust_chain.expiring_links(_when)
+    if not _links:
+        return trust_chain
+
+    _federation_entity = get_federation_entity(unit)
+    _collector = _federation_entity.function.trust_chain_collector
+    _verified_chain = trust_chain.verified_chain
+    _leaf = len(_verified_chain) - 1
+    _new = {}
+    for i in _links:
+        _statement = _verified_chain[i]
+        logger.debug(f"Refreshing statement by '{_statement['iss']}' about '{_statement['sub']}'")
+        try:
+            if i == _leaf:
+                _new[i] = _collector.refresh_entity_configuration(_statement['sub'])
+                if _leaf and _verified_chain[i - 1]['iss'] not in get_payload(
+                        _new[i]).get('authority_hints', []):
+                    logger.info(f"'{_statement['sub']}' no longer points to "
+                                f"'{_verified_chain[i - 1]['iss']}'")
+                    return None
+            else:
+                _new[i] = _collector.refresh_entity_statement(_statement['sub'],
+                                                              _statement['iss'])
+        except Exception as err:
+            logger.warning(f"Could not refresh statement: {err}")
+            return None
+        if not _new[i]:
+            return None
+
+    try:
+        _updated = _federation_entity.function.verifier.update_trust_chain(trust_chain, _new)
+    except Exception as err:
+        logger.warning(f"Refreshed trust chain did not verify: {err}")
+        return None
+    if _updated is None or _updated.exp <= _when:
+        return None
+
+    if _links == [_leaf]:
+        _federation_entity.function.policy(_updated, combined_policy=trust_chain.combined_policy)
+    else:
+        _federation_entity.function.policy(_updated)
+    return _updated
+
+
+def _hint_bound(authority: str, priority: List[str], trust_anchors) -> int:
+    # The best rank a chain through the authority could have. A trust anchor is the end
+    # of its chains, anything else may lead to any trust anchor.
+    if authority in trust_anchors:
+        return _anchor_rank(authority, priority)
+    return 0
+
+
+def get_first_verified_trust_chain(unit, entity_id: str):
+    """
+    Find one acceptable trust chain for an entity. If the entity has trust anchor priorities
+    (tr_priority) the chain returned is one to the trust anchor with the highest priority
+    that can be reached.
+
+    Collection is done one authority hint at the time, trust anchors with priority first.
+    It stops, as does verification and policy application, as soon as a chain has been
+    verified that no authority hint not yet collected could better. An authority hint
+    that can't be collected, or a chain that doesn't verify, is skipped.
+
+    :param unit: A Unit instance
+    :param entity_id: The entity ID
+    :return: A TrustChain instance or None
+    """
+    _federation_entity = get_federation_entity(unit)
+    _collector = _federation_entity.function.trust_chain_collector
+    _verifier = _federation_entity.function.verifier
+    _priority = list(getattr(_federation_entity.context, "tr_priority", None) or [])
+    _trust_anchors = _federation_entity.trust_anchors or {}
+
+    _leaf = _collector.leaf_configuration(entity_id)
+    if _leaf is None:
+        return None
+    entity_config, signed_entity_config = _leaf
+
+    # The limits on collection apply to the search as a whole
+    _resolution = _collector.new_resolution(leaf=entity_id)
+    _hints = _collector.followed_hints(entity_id, entity_config.get("authority_hints", []))
+    # Trust anchors before other authorities that could lead to as good chains
+    _pending = sorted(_hints, key=lambda a: (_hint_bound(a, _priority, _trust_anchors),
+                                             a not in _trust_anchors))
+    _tree = {}
+    _tried = set()
+    while True:
+        _bound = min([_hint_bound(a, _priority, _trust_anchors) for a in _pending],
+                     default=None)
+        for chain in iter_chains(_tree, _priority):
+            _anchor = parse_statement(chain[0]).payload()["iss"]
+            if _bound is not None and _anchor_rank(_anchor, _priority) > _bound:
+                # An authority hint not collected yet may lead to a better one
+                break
+            if tuple(chain) in _tried:
+                continue
+            _tried.add(tuple(chain))
+            try:
+                trust_chain = _verifier(chain + [signed_entity_config])
+                if trust_chain:
+                    return apply_policies(unit, [trust_chain])[0]
+            except Exception as err:
+                logger.warning(f"Trust chain could not be used: {err}")
+
+        if not _pending:
+            return None
+        authority = _pending.pop(0)
+        try:
+            _branch = _collector.collect_branch(entity_id, authority, resolution=_resolution)
+        except Exception as err:
+            logger.warning(f"Could not collect trust chains through '{authority}': {err}")
+            continue
+        if _branch:
+            _tree[authority] = _branch
+
+
 def get_entity_endpoint(unit, entity_id, metadata_type, metadata_parameter):
     _federation_entity = get_federation_entity(unit)
     if entity_id in _federation_entity.trust_anchors:
@@ -168,10 +380,9 @@ def get_entity_endpoint(unit, entity_id, metadata_type, metadata_parameter):
         _ec = _federation_entity.client.do_request("entity_configuration", entity_id=entity_id)
         return _ec["metadata"][metadata_type][metadata_parameter]
     else:
-        trust_chains = get_verified_trust_chains(unit, entity_id)
-        # pick one
-        if trust_chains:
-            return trust_chains[0].metadata[metadata_type][metadata_parameter]
+        trust_chain = get_first_verified_trust_chain(unit, entity_id)
+        if trust_chain:
+            return trust_chain.metadata[metadata_type][metadata_parameter]
         else:
             return ""
 
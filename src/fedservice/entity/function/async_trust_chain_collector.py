@@ -0,0 +1,350 @@
+import asyncio
+import functools
+import logging
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Union
+
+from cryptojwt.utils import importer
+from idpyoidc.exception import MissingPage
+from idpyoidc.message import Message
+from requests.exceptions import ConnectionError
+
+from fedservice.entity.function import apply_policies
+from fedservice.entity.function import Function
+from fedservice.entity.function import tree2chains
+from fedservice.entity.function import verify_self_signed_signature
+from fedservice.entity.function import verify_trust_chains
+from fedservice.entity.function.trust_chain_collector import get_endpoint
+from fedservice.entity.function.trust_chain_collector import Resolution
+from fedservice.entity.utils import get_federation_entity
+from fedservice.single_flight import AsyncSingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTrustChainCollector(Function):
+    """
+    An asyncio variant of :py:class:`fedservice.entity.function.trust_chain_collector.TrustChainCollector`.
+    It uses the caches of the synchronous collector, so the two can be used side by side in
+    one process.
+
+    The HTTP client must be a coroutine function with the same signature as
+    `requests.request` that returns an object with the attributes `status_code`, `headers`
+    and `text`.
+    """
+
+    def __init__(self,
+                 upstream_get: Callable,
+                 httpc: Optional[Union[Callable, str]] = None,
+                 httpc_params: Optional[dict] = None,
+                 **kwargs):
+        Function.__init__(self, upstream_get)
+        if isinstance(httpc, str):
+            httpc = importer(httpc)
+        self.async_httpc = httpc
+        self.async_httpc_params = httpc_params
+        self.fetches = AsyncSingleFlight()
+        self.resolutions = AsyncSingleFlight(copy_shared=True)
+
+    @property
+    def collector(self):
+        return get_federation_entity(self).function.trust_chain_collector
+
+    @property
+    def config_cache(self):
+        return self.collector.config_cache
+
+    @property
+    def entity_statement_cache(self):
+        return self.collector.entity_statement_cache
+
+    @property
+    def trust_anchors(self):
+        return self.collector.trust_anchors
+
+    async def _request(self, method, url, **kwargs):
+        if self.async_httpc:
+            return await self.async_httpc(method, url, **kwargs)
+
+        # No asynchronous HTTP client configured. Fall back to running the synchronous one
+        # in a worker thread.
+        _httpc = self.upstream_get('attribute', 'httpc')
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(_httpc, method, url, **kwargs))
+
+    async def get_document(self, url: str) -> str:
+        """
+        Concurrent requests for the same URL are coalesced into one.
+
+        :param url: Target URL
+        :return: Signed EntityStatement
+        """
+        return await self.fetches.do(url, self.fetch_document, url)
+
+    async def fetch_document(self, url: str) -> str:
+        _httpc_params = self.collector.request_args(url)
+        if self.async_httpc_params is not None:
+            _headers = _httpc_params.get("headers")
+            _httpc_params = self.async_httpc_params.copy()
+            if _headers:
+                _httpc_params["headers"] = _headers
+
+        _failures = self.collector.failures
+        _failures.check(url)
+        try:
+            response = await self._request("GET", url, **_httpc_params)
+            _document = self.collector.process_response(url, response)
+        except ConnectionError as err:
+            logger.error(f'Could not connect to {url}:{err}')
+            _failures.record_failure(url, err)
+            raise
+        except Exception as err:
+            if isinstance(err, asyncio.CancelledError):
+                # An Exception before Python 3.8
+                _failures.release(url)
+            else:
+                # Every failure must be recorded, otherwise a failed probe of a host would
+                # keep its circuit half open for good.
+                _failures.record_failure(url, err)
+            raise
+        except BaseException:
+            # Cancelled. No answer either way, so let another request probe the host.
+            _failures.release(url)
+            raise
+
+        _failures.record_success(url)
+        return _document
+
+    async def get_entity_configuration(self, entity_id: str) -> str:
+        """
+        Get configuration information about an entity from itself.
+
+        :param entity_id: About whom the entity statement should be
+        :return: Configuration information as a signed JWT
+        """
+        logger.debug(f"--get_configuration_information({entity_id})")
+        _serv = self.collector._get_service('entity_configuration')
+        _res = _serv.get_request_parameters(request_args={"entity_id": entity_id})
+        try:
+            return await self.get_document(_res['url'])
+        except MissingPage:  # if tenant involved
+            _tres = _serv.get_request_parameters(request_args={"entity_id": entity_id},
+                                                 tenant=True)
+            if _tres["url"] != _res["url"]:
+                return await self.get_document(_tres["url"])
+            else:
+                raise MissingPage(f"No such page: '{_tres['url']}'")
+
+    async def get_federation_fetch_endpoint(self, intermediate: str) -> str:
+        fed_fetch_endpoint = self.collector.cached_fetch_endpoint(intermediate)
+
+        if not fed_fetch_endpoint:
+            signed_entity_config = await self.get_entity_configuration(intermediate)
+            if signed_entity_config is None:
+                return ''
+
+            entity_config = self.collector.cache_entity_configuration(intermediate,
+                                                                      signed_entity_config)
+            fed_fetch_endpoint = get_endpoint("fetch", entity_config)
+
+        return fed_fetch_endpoint
+
+    async def get_entity_statement(self, fetch_endpoint: str, issuer: str, subject: str) -> str:
+        """
+        Get Entity Statement by one entity about another
+
+        :param fetch_endpoint: The federation fetch endpoint
+        :param issuer: Who should issue the entity statement
+        :param subject: About whom the entity statement should be
+        :return: A signed JWT
+        """
+        return await self.get_document(
+            self.collector.entity_statement_url(fetch_endpoint, issuer, subject))
+
+    async def _get_entity_statement(self, entity: str, authority: str) -> Optional[str]:
+        entity_statement = self.collector.cached_entity_statement(entity, authority)
+
+        if entity_statement is None:
+            fed_fetch_endpoint = await self.get_federation_fetch_endpoint(authority)
+            if not fed_fetch_endpoint:
+                return None
+            _url = self.collector.entity_statement_url(fed_fetch_endpoint, authority, entity)
+            entity_statement = await self.get_document(_url)
+            self.collector.cache_entity_statement(entity, authority, entity_statement)
+
+        return entity_statement
+
+    async def collect_tree(self,
+                           entity_id: str,
+                           entity_configuration: Union[dict, Message],
+                           seen: Optional[list] = None,
+                           max_superiors: Optional[int] = None,
+                           stop_at: Optional[str] = "",
+                           resolution: Optional[Resolution] = None) -> Optional[dict]:
+        """
+        Collect superiors one level at the time. Sibling branches are collected concurrently.
+
+        :param entity_id: The entity ID
+        :param entity_configuration: Entity Configuration as a dictionary
+        :param seen: A list of authorities that this process has seen. This to capture
+            loops.
+        :param max_superiors: The maximum number of superiors.
+        :param stop_at: The ID of the trust anchor at which the trust chain should stop.
+        :param resolution: State shared by all branches collected for one entity.
+        :return: Dictionary of superiors
+        """
+        if seen is None:
+            seen = []
+        if resolution is None:
+            resolution = self.collector.new_resolution(leaf="" if seen else entity_id)
+
+        if 'authority_hints' not in entity_configuration:
+            logger.debug("No authority for this entity")
+            return {}
+        elif entity_configuration['iss'] == stop_at:
+            logger.debug("Reached trust anchor")
+            return {}
+
+        _authorities = self.collector.followed_hints(entity_id,
+                                                     entity_configuration['authority_hints'])
+        for authority in _authorities:
+            if authority in seen:  # loop ?!
+                logger.warning(f"Loop detected at {authority}")
+
+        _branches = await asyncio.gather(
+            *[self.collect_branch(entity_id, authority, seen, max_superiors, stop_at=stop_at,
+                                  resolution=resolution)
+              for authority in _authorities])
+        return dict(zip(_authorities, _branches))
+
+    async def collect_branch(self, entity, authority, seen=None, max_superiors=None, stop_at="",
+                             resolution=None):
+        """
+        Collect an entity statement about an entity submitted by another entity, the authority.
+
+        :param entity: The ID of the entity
+        :param authority: An authority from the authority_hints
+        :param seen: A list of authorities that this process has seen.
+        :param max_superiors: The maximum number of superiors allowed.
+        :param stop_at: When this entity ID is reached stop processing
+        :param resolution: State shared by all branches collected for one entity.
+        :return:
+        """
+        if entity == authority and entity in self.trust_anchors:
+            return None
+
+        if seen is None:
+            _seen = []
+        else:
+            _seen = seen[:]
+
+        if authority in _seen:
+            logger.warning(f"Loop detected at {authority}, path: {_seen}")
+            return None
+
+        _seen.append(authority)
+        if max_superiors is None:
+            max_superiors = self.collector.max_superiors
+        if resolution is None:
+            resolution = self.collector.new_resolution(leaf="" if seen else entity)
+        if self.collector.out_of_budget(_seen, max_superiors, resolution):
+            return None
+
+        entity_statement = await self._get_entity_statement(entity, authority)
+
+        if entity_statement:
+            if self.collector.violates_constraints(entity, entity_statement, _seen, resolution):
+                return None
+            _entity_configuration = self.config_cache[authority]
+            if _entity_configuration is None:
+                await self.get_federation_fetch_endpoint(authority)
+                _entity_configuration = self.config_cache[authority]
+            return entity_statement, await self.collect_tree(authority,
+                                                             _entity_configuration,
+                                                             stop_at=stop_at,
+                                                             seen=_seen,
+                                                             max_superiors=max_superiors,
+                                                             resolution=resolution)
+        else:
+            return None
+
+    async def __call__(self,
+                       entity_id: str,
+                       max_superiors: Optional[int] = None,
+                       seen: Optional[List[str]] = None,
+                       stop_at: Optional[str] = ''):
+        _cached = self.collector.cached_entity_configuration(entity_id)
+        if _cached:
+            entity_config, signed_entity_config = _cached
+        else:
+            signed_entity_config = await self.get_entity_configuration(entity_id)
+            if not signed_entity_config:
+                logger.warning(f"Could not find any entity configuration for {entity_id}")
+                return None
+            entity_config = self.collector.cache_entity_configuration(entity_id,
+                                                                      signed_entity_config)
+
+        _tree = await self.collect_tree(entity_id, entity_config, seen=seen,
+                                        max_superiors=max_superiors, stop_at=stop_at)
+        return _tree, signed_entity_config
+
+
+async def collect_trust_chains(unit,
+                               entity_id: str,
+                               signed_entity_configuration: Optional[str] = "",
+                               stop_at: Optional[str] = "",
+                               authority_hints: Optional[list] = None):
+    """
+    The asyncio equivalent of :py:func:`fedservice.entity.function.collect_trust_chains`.
+    """
+    _federation_entity = get_federation_entity(unit)
+
+    _collector = _federation_entity.get_async_trust_chain_collector()
+
+    if signed_entity_configuration:
+        entity_configuration = verify_self_signed_signature(signed_entity_configuration)
+        if authority_hints:
+            entity_configuration["authority_hints"] = authority_hints
+        tree = await _collector.collect_tree(entity_id, entity_configuration, stop_at=stop_at)
+    else:
+        try:
+            _collector_response = await _collector(entity_id, stop_at=stop_at)
+        except Exception as err:
+            logger.error(f"Trust chain collection failed {err}")
+            raise (err)
+        if _collector_response:
+            tree, signed_entity_configuration = _collector_response
+        else:
+            tree = None
+
+    if tree:
+        chains = tree2chains(tree)
+        logger.debug("%d chains", len(chains))
+        return chains, signed_entity_configuration
+    elif tree == {}:
+        return [], signed_entity_configuration
+    else:
+        return [], None
+
+
+async def get_verified_trust_chains(unit, entity_id: str):
+    """
+    The asyncio equivalent of :py:func:`fedservice.entity.function.get_verified_trust_chains`.
+    Verification and policy application are CPU bound and are run synchronously.
+    Concurrent resolutions of the same entity are coalesced into one.
+    """
+    _collector = get_federation_entity(unit).get_async_trust_chain_collector()
+    return await _collector.resolutions.do(entity_id, _get_verified_trust_chains, unit,
+                                           entity_id)
+
+
+async def _get_verified_trust_chains(unit, entity_id: str):
+    chains, leaf_ec = await collect_trust_chains(unit, entity_id)
+    if len(chains) == 0:
+        return []
+
+    trust_chains = verify_trust_chains(unit, chains, leaf_ec)
+    trust_chains = apply_policies(unit, trust_chains)
+    return trust_chains
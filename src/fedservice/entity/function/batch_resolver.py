@@ -0,0 +1,123 @@
+import logging
+import time
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from fedservice.entity.function import apply_policies
+from fedservice.entity.function import collect_trust_chains
+from fedservice.entity.function import verify_trust_chains
+from fedservice.entity.utils import get_federation_entity
+
+logger = logging.getLogger(__name__)
+
+
+class BatchResolver(object):
+    """
+    Collects, verifies and applies policies to the trust chains of many entities.
+
+    The entities are resolved in parallel by at most `max_workers` threads. They share the
+    collector's caches and the superior trees of the intermediates they have in common are
+    only collected once per batch, as long as they are within `max_superiors` from each
+    entity that reaches them. Iterating over the instance gives
+    (entity ID, list of TrustChain instances or the exception raised) tuples in the order
+    the resolutions complete.
+    """
+
+    def __init__(self, unit, entity_ids: List[str], max_workers: Optional[int] = 8,
+                 on_result: Optional[Callable] = None):
+        """
+        :param unit: A Unit instance
+        :param entity_ids: The entities to resolve. Duplicates are only resolved once.
+        :param max_workers: Max number of entities resolved in parallel
+        :param on_result: Called with the entity ID and the result of each resolution
+        """
+        self.unit = unit
+        self.entity_ids = list(dict.fromkeys(entity_ids))
+        self.max_workers = max_workers
+        self.on_result = on_result
+        self.durations = {}
+        self.errors = {}
+        self.started = 0
+        self.finished = 0
+        # Memoized subtrees shared by all the resolutions in the batch. Only subtrees that
+        # were collected without anything being pruned are memoized, so they don't depend
+        # on the path from the entity that reached them.
+        self._subtrees = {}
+
+    def resolve(self, entity_id: str) -> list:
+        _start = time.monotonic()
+        try:
+            _collector = get_federation_entity(self.unit).function.trust_chain_collector
+            _resolution = _collector.new_resolution(leaf=entity_id, subtrees=self._subtrees)
+            chains, leaf_ec = collect_trust_chains(self.unit, entity_id, resolution=_resolution)
+            if not chains:
+                return []
+            trust_chains = verify_trust_chains(self.unit, chains, leaf_ec)
+            return apply_policies(self.unit, trust_chains)
+        finally:
+            self.durations[entity_id] = time.monotonic() - _start
+
+    def _result(self, entity_id: str, future) -> Tuple[str, Union[list, Exception]]:
+        try:
+            _result = future.result()
+        except Exception as err:
+            logger.warning(f"Could not resolve '{entity_id}': {err}")
+            self.errors[entity_id] = err
+            _result = err
+        if self.on_result:
+            self.on_result(entity_id, _result)
+        return entity_id, _result
+
+    def __iter__(self) -> Iterator[Tuple[str, Union[list, Exception]]]:
+        self.started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix="batch_resolver") as executor:
+            _futures = {executor.submit(self.resolve, entity_id): entity_id
+                        for entity_id in self.entity_ids}
+            try:
+                for future in as_completed(_futures):
+                    yield self._result(_futures[future], future)
+            finally:
+                # If the caller stops early, don't start on the rest
+                for future in _futures:
+                    future.cancel()
+                self.finished = time.monotonic()
+
+    def results(self) -> dict:
+        """
+        Resolve all the entities.
+
+        :return: A dictionary with entity IDs as keys and lists of TrustChain instances or
+            exceptions as values.
+        """
+        return dict(self)
+
+    @property
+    def timings(self) -> dict:
+        """
+        :return: Number of entities resolved and failed, the wall clock time spent on the
+            batch and statistics on the time spent per entity. In seconds.
+        """
+        _durations = sorted(self.durations.values())
+        _timings = {
+            "entities": len(self.entity_ids),
+            "resolved": len(_durations) - len(self.errors),
+            "failed": len(self.errors),
+            "elapsed": ((self.finished or time.monotonic()) - self.started
+                        if self.started else 0.0)
+        }
+        if _durations:
+            _timings.update({
+                "min": _durations[0],
+                "max": _durations[-1],
+                "mean": sum(_durations) / len(_durations),
+                "median": _durations[len(_durations) // 2],
+                "p95": _durations[min(len(_durations) - 1, int(len(_durations) * 0.95))]
+            })
+        return _timings
@@ -0,0 +1,372 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from typing import Callable
+from typing import List
+from typing import Optional
+from urllib.parse import urlparse
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity.function import Function
+from fedservice.entity.function import verify_self_signed_signature
+from fedservice.entity.function.refresh_scheduler import TokenBucket
+from fedservice.entity.server.subordinate_registry import get_trust_mark_id
+from fedservice.entity.utils import get_federation_entity
+
+logger = logging.getLogger(__name__)
+
+
+class FederationGraph(object):
+    """
+    The entities found below a root entity and how they are connected.
+
+    Each node is a dictionary with the entity's verified entity configuration, when it
+    expires, a digest of the signed version, the entity's superiors and subordinates and,
+    if visiting it failed, the error.
+    """
+
+    def __init__(self, root: Optional[str] = "", nodes: Optional[dict] = None,
+                 crawled: Optional[int] = 0):
+        self.root = root
+        self.nodes = nodes or {}
+        # When the last complete crawl finished
+        self.crawled = crawled
+        self._lock = threading.Lock()
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self.nodes
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def get(self, entity_id: str) -> Optional[dict]:
+        return self.nodes.get(entity_id)
+
+    def _node(self, entity_id: str) -> dict:
+        _node = self.nodes.get(entity_id)
+        if _node is None:
+            _node = {"entity_id": entity_id, "configuration": {}, "exp": 0, "digest": "",
+                     "superiors": [], "subordinates": [], "error": ""}
+            self.nodes[entity_id] = _node
+        return _node
+
+    def add(self, entity_id: str, configuration: dict, digest: str,
+            subordinates: Optional[List[str]] = None) -> dict:
+        with self._lock:
+            _node = self._node(entity_id)
+            # Subordinates that are gone no longer have this entity as a superior
+            for sub in set(_node["subordinates"]).difference(subordinates or []):
+                if sub in self.nodes and entity_id in self.nodes[sub]["superiors"]:
+                    self.nodes[sub]["superiors"].remove(entity_id)
+            _node.update({
+                "configuration": configuration,
+                "exp": configuration.get("exp", 0),
+                "digest": digest,
+                "subordinates": list(subordinates or []),
+                "error": ""
+            })
+            return _node
+
+    def set_error(self, entity_id: str, error: str):
+        with self._lock:
+            self._node(entity_id)["error"] = error
+
+    def link(self, superior: str, subordinate: str):
+        with self._lock:
+            _sub = self._node(subordinate)
+            if superior not in _sub["superiors"]:
+                _sub["superiors"].append(superior)
+            _sup = self._node(superior)
+            if subordinate not in _sup["subordinates"]:
+                _sup["subordinates"].append(subordinate)
+
+    def subordinates(self, entity_id: str) -> List[str]:
+        _node = self.nodes.get(entity_id)
+        return list(_node["subordinates"]) if _node else []
+
+    def superiors(self, entity_id: str) -> List[str]:
+        _node = self.nodes.get(entity_id)
+        return list(_node["superiors"]) if _node else []
+
+    def entities(self, entity_type: Optional[str] = "",
+                 trust_mark_id: Optional[str] = "") -> List[str]:
+        """
+        :param entity_type: Only entities with metadata for this entity type
+        :param trust_mark_id: Only entities that have a trust mark with this ID
+        :return: The IDs of the matching entities that could be visited
+        """
+        res = []
+        for entity_id, node in self.nodes.items():
+            _configuration = node["configuration"]
+            if not _configuration:
+                continue
+            if entity_type and entity_type not in _configuration.get("metadata", {}):
+                continue
+            if trust_mark_id and trust_mark_id not in [
+                    get_trust_mark_id(tm) for tm in _configuration.get("trust_marks", [])]:
+                continue
+            res.append(entity_id)
+        return res
+
+    def tree(self, entity_id: Optional[str] = "") -> dict:
+        """
+        :param entity_id: The entity to start from, default is the root
+        :return: The part of the graph below the entity as nested dictionaries
+        """
+        entity_id = entity_id or self.root
+
+        def _tree(eid, path):
+            return {sub: _tree(sub, path | {sub}) for sub in self.subordinates(eid)
+                    if sub not in path}
+
+        return {entity_id: _tree(entity_id, {entity_id})}
+
+    def prune(self, reached: set):
+        """
+        Remove the nodes that were not reached and the links to them.
+        """
+        with self._lock:
+            for entity_id in [e for e in self.nodes if e not in reached]:
+                del self.nodes[entity_id]
+            for node in self.nodes.values():
+                node["superiors"] = [e for e in node["superiors"] if e in reached]
+                node["subordinates"] = [e for e in node["subordinates"] if e in reached]
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"root": self.root, "nodes": json.loads(json.dumps(self.nodes)),
+                    "crawled": self.crawled}
+
+    @classmethod
+    def from_dict(cls, info: dict) -> "FederationGraph":
+        return cls(root=info.get("root", ""), nodes=info.get("nodes", {}),
+                   crawled=info.get("crawled", 0))
+
+
+class Crawler(Function):
+    """
+    Walks the federation below an entity and builds a :py:class:`FederationGraph`.
+
+    Entities are visited in parallel by at most `max_workers` threads and no host is sent
+    more than `host_rate` requests per second on average. Every entity is visited once
+    per crawl. A crawl can be checkpointed to a file and resumed from there if it is
+    interrupted. Crawling again with an earlier graph only refetches the entity
+    configurations that have expired or are about to, the subordinates of every entity are
+    always listed again. Entity configurations that turn out not to have changed are not
+    verified again.
+
+    Entity configurations are verified with their own keys and subordinates listed via
+    the List endpoint. Trust chains are not resolved.
+    """
+
+    def __init__(self,
+                 upstream_get: Callable,
+                 max_workers: Optional[int] = 8,
+                 host_rate: Optional[float] = 2.0,
+                 host_burst: Optional[int] = 5,
+                 page_size: Optional[int] = 100,
+                 checkpoint_dir: Optional[str] = "",
+                 checkpoint_interval: Optional[int] = 100,
+                 refresh_margin: Optional[int] = 300,
+                 max_age: Optional[int] = 3600,
+                 **kwargs):
+        """
+        :param upstream_get: Function to get information from the entity this is part of
+        :param max_workers: Max number of entities visited in parallel
+        :param host_rate: Average number of requests per second per host. 0 means no limit.
+        :param host_burst: Max number of requests per host in a burst
+        :param page_size: Number of entity IDs asked for per List request
+        :param checkpoint_dir: Where checkpoints are written. No checkpoints if not given.
+        :param checkpoint_interval: Number of entities visited between checkpoints
+        :param refresh_margin: When crawling again, entity configurations that expire within
+            this many seconds are refetched.
+        :param max_age: How old, in seconds, a graph returned by get_graph may be
+        """
+        Function.__init__(self, upstream_get)
+        self.max_workers = max_workers
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.page_size = page_size
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.refresh_margin = refresh_margin
+        self.max_age = max_age
+        self.graphs = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _throttle(self, url: str):
+        if not self.host_rate:
+            return
+        _host = urlparse(url).netloc
+        while True:
+            with self._lock:
+                _bucket = self._buckets.get(_host)
+                if _bucket is None:
+                    _bucket = TokenBucket(self.host_rate, self.host_burst)
+                    self._buckets[_host] = _bucket
+                if _bucket.take():
+                    return
+            time.sleep(1.0 / self.host_rate)
+
+    def _list(self, entity_id: str, endpoint: str) -> List[str]:
+        _list = get_federation_entity(self).client.get_service("list")
+        return list(_list.iterate(entity_id, limit=self.page_size, endpoint=endpoint,
+                                  before_request=lambda: self._throttle(endpoint)))
+
+    def visit(self, graph: FederationGraph, entity_id: str, superior: Optional[str] = "",
+              incremental: Optional[bool] = False) -> List[str]:
+        """
+        Visit one entity and update the graph.
+
+        :return: The entity's subordinates
+        """
+        _node = graph.get(entity_id)
+        _known = incremental and _node and _node["configuration"] and not _node["error"]
+        try:
+            if _known and _node["exp"] > utc_time_sans_frac() + self.refresh_margin:
+                # The entity configuration is still valid but subordinates may have been
+                # added or removed since, so they are listed again
+                _jws = None
+                _digest = _node["digest"]
+            else:
+                self._throttle(entity_id)
+                _collector = get_federation_entity(self).function.trust_chain_collector
+                _jws = _collector.get_entity_configuration(entity_id)
+                _digest = hashlib.sha256(_jws.encode()).hexdigest()
+
+            if _jws is None or (_known and _node["digest"] == _digest):
+                # Same entity configuration, no need to verify it again
+                _configuration = _node["configuration"]
+            else:
+                _configuration = verify_self_signed_signature(_jws)
+                del _configuration["_jws"]
+                if _configuration.get("iss") != entity_id or _configuration.get(
+                        "sub") != entity_id:
+                    raise ValueError("Not an entity configuration for the entity")
+                if superior and superior not in _configuration.get("authority_hints", []):
+                    logger.warning(f"'{superior}' not in authority_hints of '{entity_id}'")
+
+            _subordinates = []
+            _endpoint = _configuration.get("metadata", {}).get("federation_entity", {}).get(
+                "federation_list_endpoint")
+            if _endpoint:
+                _subordinates = self._list(entity_id, _endpoint)
+            graph.add(entity_id, _configuration, _digest, _subordinates)
+            return _subordinates
+        except Exception as err:
+            logger.warning(f"Could not visit '{entity_id}': {err}")
+            graph.set_error(entity_id, str(err))
+            return _node["subordinates"] if _node else []
+
+    def checkpoint_file(self, root: str) -> str:
+        return os.path.join(self.checkpoint_dir,
+                            hashlib.sha256(root.encode()).hexdigest()[:16] + ".json")
+
+    def _checkpoint(self, graph: FederationGraph, pending: list, visited: set):
+        if not self.checkpoint_dir:
+            return
+        _fname = self.checkpoint_file(graph.root)
+        _tmp = f"{_fname}.tmp"
+        with open(_tmp, "w") as fp:
+            json.dump({"graph": graph.to_dict(), "pending": pending,
+                       "visited": sorted(visited)}, fp)
+        os.replace(_tmp, _fname)
+
+    def _load_checkpoint(self, root: str) -> Optional[dict]:
+        if not self.checkpoint_dir:
+            return None
+        _fname = self.checkpoint_file(root)
+        if not os.path.isfile(_fname):
+            return None
+        with open(_fname) as fp:
+            return json.load(fp)
+
+    def crawl(self, root: str, graph: Optional[FederationGraph] = None,
+              resume: Optional[bool] = False) -> FederationGraph:
+        """
+        Crawl the federation below an entity.
+
+        :param root: The entity to start from, normally a trust anchor
+        :param graph: A graph from an earlier crawl. Only what has expired is refetched.
+        :param resume: Continue from the checkpoint of an interrupted crawl if there is one
+        :return: A FederationGraph instance
+        """
+        _checkpoint = self._load_checkpoint(root) if resume else None
+        if _checkpoint:
+            graph = FederationGraph.from_dict(_checkpoint["graph"])
+            _pending = deque(tuple(p) for p in _checkpoint["pending"])
+            _visited = set(_checkpoint["visited"])
+            logger.info(f"Resuming crawl of '{root}', {len(_pending)} entities pending")
+        else:
+            _pending = deque([(root, "")])
+            _visited = set()
+        _incremental = graph is not None
+        if graph is None:
+            graph = FederationGraph(root=root)
+
+        _seen = set(_visited) | {e for e, _ in _pending}
+        _running = {}
+        _count = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers or 1,
+                                thread_name_prefix="crawler") as executor:
+            while _pending or _running:
+                while _pending and len(_running) < 2 * (self.max_workers or 1):
+                    entity_id, superior = _pending.popleft()
+                    _future = executor.submit(self.visit, graph, entity_id, superior,
+                                              _incremental)
+                    _running[_future] = (entity_id, superior)
+
+                _done, _ = wait(_running, return_when=FIRST_COMPLETED)
+                for _future in _done:
+                    entity_id, _ = _running.pop(_future)
+                    _visited.add(entity_id)
+                    for sub in _future.result():
+                        graph.link(entity_id, sub)
+                        if sub not in _seen:
+                            _seen.add(sub)
+                            _pending.append((sub, entity_id))
+                    _count += 1
+                    if self.checkpoint_interval and _count % self.checkpoint_interval == 0:
+                        # What is being visited right now has to be done again on resume
+                        self._checkpoint(graph, list(_pending) + list(_running.values()),
+                                         _visited)
+
+        # Entities that are no longer in the federation
+        graph.prune(_visited)
+        graph.crawled = utc_time_sans_frac()
+        if self.checkpoint_dir:
+            _fname = self.checkpoint_file(root)
+            if os.path.isfile(_fname):
+                os.unlink(_fname)
+        self.graphs[root] = graph
+        return graph
+
+    def recrawl(self, graph: FederationGraph) -> FederationGraph:
+        """
+        Bring a graph up to date. Only entity configurations that have expired are fetched
+        again, subordinates are listed again for all entities.
+        """
+        return self.crawl(graph.root, graph=graph)
+
+    def get_graph(self, root: str, max_age: Optional[int] = None) -> FederationGraph:
+        """
+        The graph below an entity. It is crawled if it hasn't been and brought up to date
+        if the last crawl is more than `max_age` seconds old.
+        """
+        if max_age is None:
+            max_age = self.max_age
+        _graph = self.graphs.get(root)
+        if _graph is None:
+            return self.crawl(root, resume=True)
+        if utc_time_sans_frac() - _graph.crawled >= max_age:
+            return self.recrawl(_graph)
+        return _graph
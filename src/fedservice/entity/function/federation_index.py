@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+import threading
+from typing import Callable
+from typing import List
+from typing import Optional
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity.function import Function
+from fedservice.entity.utils import get_federation_entity
+
+logger = logging.getLogger(__name__)
+
+
+def credential_types(metadata: dict) -> List[str]:
+    """
+    The types of the credentials a credential issuer says it supports.
+
+    :param metadata: Verified metadata
+    :return: List of credential types
+    """
+    _issuer = metadata.get("openid_credential_issuer", {})
+    _supported = _issuer.get("credentials_supported", [])
+    if isinstance(_supported, dict):
+        # Newer drafts use a dictionary with identifiers as keys
+        _supported = list(_supported.values())
+    res = []
+    for cs in _supported:
+        for _type in cs.get("credential_definition", {}).get("type", []):
+            if _type not in res:
+                res.append(_type)
+    return res
+
+
+class FederationIndex(Function):
+    """
+    A locally persisted index over the entities in a federation.
+
+    For every entity below a trust anchor the index holds the metadata of its trust chain
+    to that trust anchor, its entity types, the types of credentials it supports and the
+    IDs of its verified trust marks. Discovery queries are answered from the index. When
+    an index is older than `max_age` it is rebuilt in the background while queries
+    are still answered from the old one.
+    """
+
+    def __init__(self,
+                 upstream_get: Callable,
+                 file_name: Optional[str] = "",
+                 max_age: Optional[int] = 3600,
+                 max_workers: Optional[int] = 8,
+                 check_with_issuer: Optional[bool] = True,
+                 **kwargs):
+        """
+        :param upstream_get: Function to get information from the entity this is part of
+        :param file_name: Where the index is kept. If not given it only lives in memory.
+        :param max_age: Number of seconds after which an index is rebuilt
+        :param max_workers: Max number of trust chains resolved in parallel
+        :param check_with_issuer: Whether the trust mark issuers should be asked if the
+            trust marks are still active.
+        """
+        Function.__init__(self, upstream_get)
+        self.file_name = file_name
+        self.max_age = max_age
+        self.max_workers = max_workers
+        self.check_with_issuer = check_with_issuer
+        # Per trust anchor; when the index was built and the entries
+        self.index = {}
+        self._lookup = {}
+        self._lock = threading.Lock()
+        self._building = set()
+        # One build at the time per trust anchor
+        self._build_locks = {}
+        self.load()
+
+    def load(self):
+        if not self.file_name or not os.path.isfile(self.file_name):
+            return
+        with open(self.file_name) as fp:
+            _index = json.load(fp)
+        with self._lock:
+            self.index = _index
+            self._lookup = {ta: self._make_lookup(item["entities"]) for ta, item in _index.items()}
+
+    def dump(self):
+        if not self.file_name:
+            return
+        _tmp = f"{self.file_name}.tmp"
+        with self._lock:
+            with open(_tmp, "w") as fp:
+                json.dump(self.index, fp)
+        os.replace(_tmp, self.file_name)
+
+    @staticmethod
+    def _make_lookup(entities: dict) -> dict:
+        _lookup = {"entity_type": {}, "credential_type": {}, "trust_mark_id": {}}
+        for entity_id, entry in entities.items():
+            for key, attr in [("entity_type", "entity_types"),
+                              ("credential_type", "credential_types"),
+                              ("trust_mark_id", "trust_mark_ids")]:
+                for val in entry[attr]:
+                    _lookup[key].setdefault(val, set()).add(entity_id)
+        return _lookup
+
+    def _trust_marks(self, federation_entity, entity_configuration: dict) -> dict:
+        # Trust mark IDs and when the trust marks expire, 0 if they don't
+        res = {}
+        for _mark in entity_configuration.get("trust_marks", []):
+            if isinstance(_mark, dict):
+                _mark = _mark.get("trust_mark", "")
+            try:
+                _verified = federation_entity.verify_trust_mark(
+                    _mark, check_with_issuer=self.check_with_issuer)
+            except Exception as err:
+                logger.warning(f"Could not verify trust mark: {err}")
+                continue
+            if _verified and _verified.get("id") not in res:
+                res[_verified["id"]] = _verified.get("exp", 0)
+        return res
+
+    def _entry(self, federation_entity, trust_chain) -> dict:
+        _trust_marks = self._trust_marks(federation_entity, trust_chain.verified_chain[-1])
+        return {
+            "entity_types": list(trust_chain.metadata.keys()),
+            "metadata": trust_chain.metadata,
+            "credential_types": credential_types(trust_chain.metadata),
+            "trust_mark_ids": list(_trust_marks.keys()),
+            "trust_mark_exp": _trust_marks,
+            "exp": trust_chain.exp
+        }
+
+    @staticmethod
+    def _valid(entry: dict, now: int, trust_mark_id: Optional[str] = "") -> bool:
+        # Neither the trust chain nor, if asked for, the trust mark may have expired
+        if entry["exp"] and entry["exp"] <= now:
+            return False
+        if trust_mark_id:
+            _exp = entry.get("trust_mark_exp", {}).get(trust_mark_id, 0)
+            if _exp and _exp <= now:
+                return False
+        return True
+
+    def _build_lock(self, trust_anchor: str) -> threading.Lock:
+        with self._lock:
+            return self._build_locks.setdefault(trust_anchor, threading.Lock())
+
+    def build(self, trust_anchor: str) -> dict:
+        """
+        Crawl the federation below a trust anchor, resolve the trust chains of all the
+        entities found and replace the index for the trust anchor.
+
+        :param trust_anchor: The trust anchor's entity ID
+        :return: The new index for the trust anchor
+        """
+        with self._build_lock(trust_anchor):
+            return self._build(trust_anchor)
+
+    def _build(self, trust_anchor: str) -> dict:
+        _federation_entity = get_federation_entity(self)
+        _graph = _federation_entity.crawl(trust_anchor, max_age=0)
+        _entity_ids = [eid for eid in _graph.entities() if eid != trust_anchor]
+
+        _entities = {}
+        _batch = _federation_entity.resolve_many(_entity_ids, max_workers=self.max_workers)
+        for entity_id, result in _batch:
+            if isinstance(result, Exception) or not result:
+                continue
+            _trust_chains = [tc for tc in result if tc.anchor == trust_anchor]
+            if not _trust_chains:
+                continue
+            _entities[entity_id] = self._entry(_federation_entity, _trust_chains[0])
+
+        _index = {"updated": utc_time_sans_frac(), "entities": _entities}
+        _lookup = self._make_lookup(_entities)
+        with self._lock:
+            self.index[trust_anchor] = _index
+            self._lookup[trust_anchor] = _lookup
+        self.dump()
+        logger.info(f"Indexed {len(_entities)} entities below '{trust_anchor}'")
+        return _index
+
+    def _build_in_background(self, trust_anchor: str):
+        with self._lock:
+            if trust_anchor in self._building:
+                return
+            self._building.add(trust_anchor)
+
+        def _build():
+            try:
+                self.build(trust_anchor)
+            except Exception as err:
+                logger.warning(f"Could not rebuild the index for '{trust_anchor}': {err}")
+            finally:
+                with self._lock:
+                    self._building.discard(trust_anchor)
+
+        threading.Thread(target=_build, name="federation_index", daemon=True).start()
+
+    def get(self, trust_anchor: str) -> dict:
+        """
+        The index for a trust anchor. It is built if there is none, only once however many
+        ask for it at the same time. If it is too old it is rebuilt in the background and
+        the old one returned.
+        """
+        _index = self.index.get(trust_anchor)
+        if _index is None:
+            with self._build_lock(trust_anchor):
+                # Someone else may have built it while this waited
+                _index = self.index.get(trust_anchor)
+                if _index is None:
+                    return self._build(trust_anchor)
+        if utc_time_sans_frac() - _index["updated"] > self.max_age:
+            self._build_in_background(trust_anchor)
+        return _index
+
+    def updated(self, trust_anchor: str) -> int:
+        """
+        :return: When the index for the trust anchor was built. 0 if it hasn't been.
+        """
+        _index = self.index.get(trust_anchor)
+        return _index["updated"] if _index else 0
+
+    def find(self, trust_anchor: str,
+             entity_type: Optional[str] = "",
+             credential_type: Optional[str] = "",
+             trust_mark_id: Optional[str] = "") -> List[str]:
+        """
+        Find the entities below a trust anchor that match all the given criteria. Entities
+        whose trust chains, or the trust marks asked for, have expired are left out.
+
+        :param trust_anchor: The trust anchor's entity ID
+        :param entity_type: Entity type
+        :param credential_type: The type of a credential the entities should support
+        :param trust_mark_id: The ID of a trust mark the entities should have
+        :return: Sorted list of entity IDs
+        """
+        _index = self.get(trust_anchor)
+        with self._lock:
+            _lookup = self._lookup[trust_anchor]
+            _sets = [_lookup[key].get(val, set()) for key, val in
+                     [("entity_type", entity_type), ("credential_type", credential_type),
+                      ("trust_mark_id", trust_mark_id)] if val]
+        _entities = _index["entities"]
+        _match = set.intersection(*_sets) if _sets else _entities.keys()
+        _now = utc_time_sans_frac()
+        return sorted(eid for eid in _match if self._valid(_entities[eid], _now, trust_mark_id))
+
+    def metadata(self, trust_anchor: str, entity_id: str) -> Optional[dict]:
+        """
+        :return: The indexed metadata of an entity, None if it is not in the index or its
+            trust chain has expired
+        """
+        _entry = self.get(trust_anchor)["entities"].get(entity_id)
+        if _entry and self._valid(_entry, utc_time_sans_frac()):
+            return _entry["metadata"]
+        return None
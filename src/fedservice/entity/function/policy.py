@@ -1,3 +1,4 @@
+import copy
 import logging
 from typing import Optional
 
@@ -355,12 +356,15 @@ class TrustChainPolicy(Function):
 
         return metadata
 
-    def _policy(self, trust_chain: TrustChain, entity_type: str):
-        combined_policy = self.gather_policies(trust_chain.verified_chain[:-1], entity_type)
+    def _policy(self, trust_chain: TrustChain, entity_type: str,
+                combined_policy: Optional[dict] = None):
+        if combined_policy is None:
+            combined_policy = self.gather_policies(trust_chain.verified_chain[:-1], entity_type)
         logger.debug("Combined policy: %s", combined_policy)
         try:
             # This should be the entity configuration
-            metadata = trust_chain.verified_chain[-1]['metadata'][entity_type]
+            # Copied since applying the policy modifies it
+            metadata = copy.deepcopy(trust_chain.verified_chain[-1]['metadata'][entity_type])
         except KeyError:
             return None
         else:
@@ -370,19 +374,27 @@ class TrustChainPolicy(Function):
             logger.debug(f"After applied policy: {_metadata}")
             return _metadata
 
-    def __call__(self, trust_chain: TrustChain, entity_type: Optional[str] = ''):
+    def __call__(self, trust_chain: TrustChain, entity_type: Optional[str] = '',
+                 combined_policy: Optional[dict] = None):
         """
         :param trust_chain: TrustChain instance
         :param entity_type: Which Entity Type the entity are
+        :param combined_policy: Already combined policies per entity type. Can be used if
+            only the entity configuration has changed since they were combined.
         """
+        if combined_policy is None:
+            combined_policy = {}
         if len(trust_chain.verified_chain) > 1:
             if entity_type:
-                trust_chain.metadata[entity_type] = self._policy(trust_chain, entity_type)
+                trust_chain.metadata[entity_type] = self._policy(
+                    trust_chain, entity_type, combined_policy.get(entity_type))
             else:
                 for _type in trust_chain.verified_chain[-1]['metadata'].keys():
-                    trust_chain.metadata[_type] = self._policy(trust_chain, _type)
+                    trust_chain.metadata[_type] = self._policy(trust_chain, _type,
+                                                               combined_policy.get(_type))
         else:
-            trust_chain.metadata = trust_chain.verified_chain[0]["metadata"][entity_type]
+            trust_chain.metadata = copy.deepcopy(
+                trust_chain.verified_chain[0]["metadata"][entity_type])
             trust_chain.combined_policy[entity_type] = {}
 
 
@@ -0,0 +1,344 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import List
+from typing import Optional
+from urllib.parse import urlparse
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity.function import Function
+from fedservice.entity.function import refresh_trust_chain
+from fedservice.entity.utils import get_federation_entity
+
+logger = logging.getLogger(__name__)
+
+CONFIGURATION = "configuration"
+STATEMENT = "statement"
+TRUST_CHAIN = "trust_chain"
+SUBORDINATE = "subordinate"
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per second on average with bursts of up to `burst` requests.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        _now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (_now - self.updated) * self.rate)
+        self.updated = _now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Task(object):
+    __slots__ = ["kind", "key", "host", "exp"]
+
+    def __init__(self, kind: str, key: str, host: str, exp: int):
+        self.kind = kind
+        self.key = key
+        self.host = host
+        self.exp = exp
+
+
+class RefreshScheduler(Function):
+    """
+    Refreshes cached entity configurations, subordinate statements and stored trust chains
+    a while before they expire so that they never have to be refreshed while someone waits.
+    Also keeps what the entity knows about its own subordinates from their entity
+    configurations up to date.
+
+    The caches are scanned every `interval` seconds. Items that are due are refreshed by a
+    pool of at most `max_concurrency` workers and no host is sent more than `host_rate`
+    requests per second on average.
+    """
+
+    def __init__(self,
+                 upstream_get: Callable,
+                 refresh_ahead: Optional[int] = 300,
+                 jitter: Optional[int] = 60,
+                 interval: Optional[int] = 10,
+                 retry_interval: Optional[int] = 60,
+                 max_concurrency: Optional[int] = 4,
+                 host_rate: Optional[float] = 1.0,
+                 host_burst: Optional[int] = 5,
+                 trust_chains: Optional[bool] = True,
+                 subordinates: Optional[bool] = True,
+                 autostart: Optional[bool] = False,
+                 **kwargs):
+        """
+        :param upstream_get: Function to get information from the entity this is part of
+        :param refresh_ahead: How many seconds before an item expires it should be refreshed
+        :param jitter: Max number of seconds added to refresh_ahead, chosen at random per
+            item, so that items that expire at the same time are not refreshed at once.
+        :param interval: Seconds between scans of the caches
+        :param retry_interval: Seconds to wait before trying again if a refresh failed or
+            did not produce anything newer.
+        :param max_concurrency: Max number of refreshes done in parallel
+        :param host_rate: Average number of refreshes per second per host
+        :param host_burst: Max number of refreshes per host in a burst
+        :param trust_chains: Whether stored trust chains should be refreshed
+        :param subordinates: Whether the entity configurations of the entity's subordinates
+            should be picked up
+        :param autostart: Start the background thread directly
+        """
+        Function.__init__(self, upstream_get)
+        self.refresh_ahead = refresh_ahead
+        self.jitter = jitter
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.max_concurrency = max_concurrency
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.trust_chains = trust_chains
+        self.subordinates = subordinates
+        # (kind, key) -> (exp, jitter, time of the next attempt)
+        self._schedule = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self.refreshed = 0
+        self.retries = 0
+        if autostart:
+            self.start()
+
+    @property
+    def collector(self):
+        return get_federation_entity(self).function.trust_chain_collector
+
+    def tracked(self) -> List[Task]:
+        """
+        :return: The items in the caches that can be refreshed
+        """
+        _collector = self.collector
+        _delta = _collector.allowed_delta
+        _tasks = []
+        for entity_id in _collector.config_cache.keys():
+            _exp = _collector.config_cache.get_exp(entity_id)
+            if _exp:
+                _tasks.append(Task(CONFIGURATION, entity_id, urlparse(entity_id).netloc,
+                                   _exp - _delta))
+        for key in _collector.entity_statement_cache.keys():
+            _exp = _collector.entity_statement_cache.get_exp(key)
+            if _exp:
+                _authority = key.split("!!")[0]
+                _tasks.append(Task(STATEMENT, key, urlparse(_authority).netloc, _exp - _delta))
+        if self.trust_chains:
+            _federation_entity = get_federation_entity(self)
+            for entity_id, trust_chains in list(_federation_entity.trust_chain.items()):
+                if trust_chains:
+                    _tasks.append(Task(TRUST_CHAIN, entity_id, urlparse(entity_id).netloc,
+                                       min(tc.exp for tc in trust_chains)))
+        _registry = self._subordinate_registry()
+        if _registry is not None:
+            for entity_id in list(_registry.keys()):
+                # Subordinates never picked up are due at once
+                _tasks.append(Task(SUBORDINATE, entity_id, urlparse(entity_id).netloc,
+                                   _registry.get_exp(entity_id)))
+        return _tasks
+
+    def _subordinate_registry(self):
+        if not self.subordinates:
+            return None
+        _server = getattr(get_federation_entity(self), "server", None)
+        _registry = getattr(_server, "subordinate", None)
+        if _registry is None or not hasattr(_registry, "refresh"):
+            return None
+        return _registry
+
+    def _due(self, task: Task, now: int) -> bool:
+        _id = (task.kind, task.key)
+        _scheduled = self._schedule.get(_id)
+        if _scheduled is None or _scheduled[0] != task.exp:
+            # New or refreshed by someone else
+            _jitter = random.randint(0, self.jitter) if self.jitter else 0
+            _scheduled = (task.exp, _jitter, task.exp - self.refresh_ahead - _jitter)
+            self._schedule[_id] = _scheduled
+        return now >= _scheduled[2]
+
+    def _allowed(self, host: str) -> bool:
+        if not self.host_rate:
+            return True
+        _bucket = self._buckets.get(host)
+        if _bucket is None:
+            _bucket = TokenBucket(self.host_rate, self.host_burst)
+            self._buckets[host] = _bucket
+        return _bucket.take()
+
+    def due(self, now: Optional[int] = None) -> List[Task]:
+        """
+        :param now: The time to compare with. Default is the current time.
+        :return: The items that should be refreshed now, soonest expiring first
+        """
+        if now is None:
+            now = utc_time_sans_frac()
+        _tasks = self.tracked()
+        with self._lock:
+            _present = {(t.kind, t.key) for t in _tasks}
+            for _id in [i for i in self._schedule if i not in _present]:
+                del self._schedule[_id]
+            _due = sorted([t for t in _tasks if self._due(t, now)], key=lambda t: t.exp)
+            _allowed = []
+            for task in _due:
+                if self._allowed(task.host):
+                    _allowed.append(task)
+                else:
+                    logger.debug(f"Rate limit reached for '{task.host}'")
+            return _allowed
+
+    def refresh(self, task: Task) -> bool:
+        """
+        Refresh one item.
+
+        :return: True if the item was replaced by a newer one
+        """
+        _collector = self.collector
+        try:
+            if task.kind == CONFIGURATION:
+                _collector.refresh_entity_configuration(task.key)
+                _exp = _collector.config_cache.get_exp(task.key) - _collector.allowed_delta
+            elif task.kind == SUBORDINATE:
+                _exp = self._subordinate_registry().refresh(task.key)
+            elif task.kind == STATEMENT:
+                _authority, _entity = task.key.split("!!")
+                _collector.refresh_entity_statement(_entity, _authority)
+                _exp = _collector.entity_statement_cache.get_exp(
+                    task.key) - _collector.allowed_delta
+            else:
+                _exp = self._refresh_trust_chains(task.key)
+        except Exception as err:
+            logger.warning(f"Could not refresh {task.kind} '{task.key}': {err}")
+            _exp = 0
+
+        if _exp > task.exp:
+            logger.debug(f"Refreshed {task.kind} '{task.key}'")
+            self.refreshed += 1
+            return True
+
+        # Try again later
+        self.retries += 1
+        with self._lock:
+            _scheduled = self._schedule.get((task.kind, task.key))
+            if _scheduled:
+                self._schedule[(task.kind, task.key)] = (
+                    _scheduled[0], _scheduled[1], utc_time_sans_frac() + self.retry_interval)
+        return False
+
+    def _refresh_trust_chains(self, entity_id: str) -> int:
+        _federation_entity = get_federation_entity(self)
+        _trust_chains = _federation_entity.trust_chain.get(entity_id)
+        if not _trust_chains:
+            return 0
+        _margin = self.refresh_ahead + self.jitter
+        _refreshed = []
+        for trust_chain in _trust_chains:
+            _trust_chain = refresh_trust_chain(_federation_entity, trust_chain, margin=_margin)
+            if _trust_chain is None:
+                return 0
+            _refreshed.append(_trust_chain)
+        _federation_entity.store_trust_chain(entity_id, _refreshed)
+        return min(tc.exp for tc in _refreshed)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency or 1,
+                                                thread_name_prefix="refresh_scheduler")
+        return self._executor
+
+    def tick(self, now: Optional[int] = None) -> int:
+        """
+        Refresh everything that is due. Returns when all the refreshes are done.
+
+        :return: The number of items that were refreshed
+        """
+        _tasks = self.due(now)
+        if not _tasks:
+            return 0
+        if self.max_concurrency and self.max_concurrency > 1 and len(_tasks) > 1:
+            return sum(self._get_executor().map(self.refresh, _tasks))
+        return sum(self.refresh(task) for task in _tasks)
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as err:
+                logger.exception(f"Refresh failed: {err}")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="refresh_scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class AsyncRefreshScheduler(RefreshScheduler):
+    """
+    The asyncio version of :py:class:`RefreshScheduler`. Runs as a task in the event loop.
+    The refreshes themselves are done by the synchronous collector in the loop's default
+    executor, at most `max_concurrency` at the time.
+    """
+
+    def __init__(self, upstream_get: Callable, **kwargs):
+        kwargs["autostart"] = False
+        RefreshScheduler.__init__(self, upstream_get, **kwargs)
+        self._task = None
+
+    async def tick(self, now: Optional[int] = None) -> int:
+        _tasks = self.due(now)
+        if not _tasks:
+            return 0
+        _loop = asyncio.get_running_loop()
+        _slots = asyncio.Semaphore(self.max_concurrency or 1)
+
+        async def _refresh(task):
+            async with _slots:
+                return await _loop.run_in_executor(None, self.refresh, task)
+
+        return sum(await asyncio.gather(*[_refresh(t) for t in _tasks]))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception as err:
+                logger.exception(f"Refresh failed: {err}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -1,18 +1,17 @@
+import copy
 from typing import Optional
 
-from cryptojwt.jws.jws import factory
-
-from fedservice.entity.function import get_verified_trust_chains
+from fedservice.entity.function import get_first_verified_trust_chain
 from fedservice.entity.utils import get_federation_entity
+from fedservice.entity_statement.parse import parse_statement
 
 
 def get_verified_trust_anchor_statement(federation_entity, entity_id: str):
     _collector = federation_entity.function.trust_chain_collector
     _ec = _collector.get_entity_configuration(entity_id)
-    _jwt = factory(_ec)
-    keys = federation_entity.keyjar.get_jwt_verify_keys(_jwt.jwt)
-    res = _jwt.verify_compact(keys=keys)
-    return res
+    _statement = parse_statement(_ec)
+    keys = federation_entity.keyjar.get_jwt_verify_keys(_statement)
+    return copy.deepcopy(_statement.verify(keys))
 
 
 def get_verified_endpoint(unit, entity_id: str, endpoint_name: str) -> Optional[str]:
@@ -25,11 +24,10 @@ def get_verified_endpoint(unit, entity_id: str, endpoint_name: str) -> Optional[
         except KeyError:
             endpoint = None
     else:
-        _trust_chains = get_verified_trust_chains(unit, entity_id)
-        _trust_chain = _federation_entity.pick_trust_chain(_trust_chains)
+        _trust_chain = get_first_verified_trust_chain(unit, entity_id)
         try:
             endpoint = _trust_chain.metadata["federation_entity"].get(endpoint_name)
-        except KeyError:
+        except (KeyError, AttributeError):
             endpoint = None
 
     return endpoint
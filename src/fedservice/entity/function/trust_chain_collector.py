@@ -1,18 +1,20 @@
+import copy
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from ssl import SSLError
 from typing import Callable
 from typing import List
 from typing import Optional
 from typing import Union
 
-from cryptojwt import JWT
 from cryptojwt import KeyJar
-from cryptojwt.jws.jws import factory
 from cryptojwt.jwt import utc_time_sans_frac
 from idpyoidc.exception import MissingPage
 from idpyoidc.key_import import import_jwks
 from idpyoidc.message import Message
+from idpyoidc.util import instantiate
 from requests.exceptions import ConnectionError
 
 from fedservice.entity.function import collect_trust_chains
@@ -20,17 +22,20 @@ from fedservice.entity.function import Function
 from fedservice.entity.function import verify_trust_chains
 from fedservice.entity.utils import get_federation_entity
 from fedservice.entity_statement.cache import ESCache
+from fedservice.entity_statement.constraints import constraint_violation
+from fedservice.entity_statement.failure_cache import FailureCache
+from fedservice.entity_statement.http_cache import ConditionalCache
+from fedservice.entity_statement.parse import parse_statement
+from fedservice.entity_statement.parse import verify_self_signed
 from fedservice.exception import FailedConfigurationRetrieval
+from fedservice.single_flight import SingleFlight
 from fedservice.utils import statement_is_expired
 
 logger = logging.getLogger(__name__)
 
 
 def unverified_entity_statement(signed_jwt):
-    _jws = factory(signed_jwt)
-    if not _jws:
-        raise ValueError(f"Not a proper signed JWT: {signed_jwt}")
-    return _jws.jwt.payload()
+    return parse_statement(signed_jwt).claims()
 
 
 def verify_self_signed_signature(statement):
@@ -42,14 +47,7 @@ def verify_self_signed_signature(statement):
     :return: Payload of the signed JWT
     """
 
-    payload = unverified_entity_statement(statement)
-    keyjar = KeyJar()
-    if payload['iss'] not in keyjar:
-        keyjar = import_jwks(keyjar, payload['jwks'], payload['iss'])
-
-    _jwt = JWT(key_jar=keyjar)
-    _val = _jwt.unpack(statement)
-    return _val
+    return copy.deepcopy(verify_self_signed(statement))
 
 
 def get_endpoint(endpoint_type, config):
@@ -57,12 +55,102 @@ def get_endpoint(endpoint_type, config):
     return _fe.get(f"federation_{endpoint_type}_endpoint")
 
 
+def subtree_height(subtree: Optional[dict]) -> int:
+    """
+    :return: The number of superiors on the longest path up through a superior tree
+    """
+    if not subtree:
+        return 0
+    return max([1 + subtree_height(branch[1]) for branch in subtree.values() if branch],
+               default=0)
+
+
+class Resolution(object):
+    """
+    State shared by all the branches collected while resolving the superiors of one entity.
+    """
+
+    def __init__(self,
+                 max_concurrency: Optional[int] = 0,
+                 max_statements: Optional[int] = 0,
+                 timeout: Optional[float] = 0,
+                 leaf: Optional[str] = "",
+                 subtrees: Optional[dict] = None):
+        """
+        :param max_concurrency: Max number of branches collected in parallel
+        :param max_statements: Max number of subordinate statements collected. 0 means no
+            limit.
+        :param timeout: Seconds the resolution may take. 0 means no limit.
+        :param leaf: The entity whose superiors are collected
+        :param subtrees: Memoized subtrees shared with other resolutions
+        """
+        if max_concurrency:
+            self.slots = threading.BoundedSemaphore(max_concurrency)
+        else:
+            self.slots = None
+        # The superior tree of each authority is only collected once. Authorities reached
+        # along several paths share the same subtree which makes the result a DAG.
+        self.subtrees = {} if subtrees is None else subtrees
+        self._lock = threading.Lock()
+        self.leaf = leaf
+        self.max_statements = max_statements
+        self.statements = 0
+        if timeout:
+            self.deadline = time.monotonic() + timeout
+        else:
+            self.deadline = 0
+        # Number of branches that were pruned
+        self.cuts = 0
+
+    def spend(self) -> bool:
+        """
+        Account for one more subordinate statement.
+
+        :return: False if the statement budget is used up
+        """
+        with self._lock:
+            if self.max_statements and self.statements >= self.max_statements:
+                return False
+            self.statements += 1
+            return True
+
+    def timed_out(self) -> bool:
+        return bool(self.deadline) and time.monotonic() > self.deadline
+
+    def cut(self):
+        with self._lock:
+            self.cuts += 1
+
+    def get_subtree(self, authority: str, stop_at: str) -> Optional[tuple]:
+        """
+        :return: A (subtree, expiration time, height) tuple or None
+        """
+        with self._lock:
+            return self.subtrees.get((authority, stop_at))
+
+    def set_subtree(self, authority: str, stop_at: str, subtree: dict, exp: int):
+        _height = subtree_height(subtree)
+        with self._lock:
+            self.subtrees[(authority, stop_at)] = (subtree, exp, _height)
+
+    def acquire(self) -> bool:
+        if self.slots is None:
+            return True
+        return self.slots.acquire(blocking=False)
+
+    def release(self):
+        if self.slots is not None:
+            self.slots.release()
+
+
 def cache_key(authority, entity):
     return f"{authority}!!{entity}"
 
 
-def time_key(authority, entity):
-    return f"{authority}!exp!{entity}"
+def make_storage(spec: Optional[dict], namespace: str):
+    if not spec:
+        return None
+    return instantiate(spec["class"], namespace=namespace, **spec.get("kwargs", {}))
 
 
 class TrustChainCollector(Function):
@@ -72,13 +160,61 @@ class TrustChainCollector(Function):
                  trust_anchors: dict,
                  allowed_delta: int = 300,
                  keyjar: Optional[KeyJar] = None,
+                 concurrent: Optional[bool] = False,
+                 max_workers: Optional[int] = 4,
+                 max_concurrency: Optional[int] = 0,
+                 http_cache_size: Optional[int] = 10000,
+                 cache_max_entries: Optional[int] = 0,
+                 cache_max_size: Optional[int] = 0,
+                 cache_storage: Optional[dict] = None,
+                 failure_cache: Optional[dict] = None,
+                 keep_subtrees: Optional[bool] = False,
+                 max_superiors: Optional[int] = 10,
+                 max_fan_out: Optional[int] = 0,
+                 max_statements: Optional[int] = 0,
+                 resolution_timeout: Optional[float] = 0,
                  **kwargs
                  ):
         Function.__init__(self, upstream_get)
         self.trust_anchors = trust_anchors
         self.allowed_delta = allowed_delta
-        self.config_cache = ESCache(allowed_delta=allowed_delta)
-        self.entity_statement_cache = ESCache(allowed_delta=allowed_delta)
+        # Collect sibling branches in parallel
+        self.concurrent = concurrent
+        self.max_workers = max_workers
+        # Max number of branches collected in parallel per resolution. 0 means no limit
+        # other than the size of the worker pool.
+        self.max_concurrency = max_concurrency
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # cache_storage is a class/kwargs specification of a storage backend shared by all
+        # the processes on a host.
+        self.config_cache = ESCache(allowed_delta=allowed_delta, max_entries=cache_max_entries,
+                                    max_size=cache_max_size,
+                                    storage=make_storage(cache_storage, "config"))
+        self.entity_statement_cache = ESCache(allowed_delta=allowed_delta,
+                                              max_entries=cache_max_entries,
+                                              max_size=cache_max_size,
+                                              storage=make_storage(cache_storage, "statement"))
+        # HTTP validators and freshness information for fetched statements
+        self.http_cache = ConditionalCache(max_entries=http_cache_size)
+        # Coalesces concurrent fetches of the same URL and concurrent resolutions of the
+        # same entity.
+        self.fetches = SingleFlight()
+        self.resolutions = SingleFlight(copy_shared=True)
+        # Remembers failed fetches and the health of hosts. failure_cache are keyword
+        # arguments to FailureCache.
+        self.failures = FailureCache(**(failure_cache or {}))
+        # Superior trees of authorities kept between collections until a statement in them
+        # expires.
+        self.keep_subtrees = keep_subtrees
+        self.subtree_cache = ESCache(allowed_delta=allowed_delta, max_entries=cache_max_entries)
+        # Limits on the work done per resolution: the path length, the number of authority
+        # hints followed per entity, the number of subordinate statements collected and the
+        # number of seconds spent. 0 means no limit.
+        self.max_superiors = max_superiors
+        self.max_fan_out = max_fan_out
+        self.max_statements = max_statements
+        self.resolution_timeout = resolution_timeout
         # should not have a Key Jar of its own
         if keyjar:
             self.keyjar = keyjar
@@ -88,17 +224,97 @@ class TrustChainCollector(Function):
         for id, keys in trust_anchors.items():
             keyjar = import_jwks(keyjar, keys, id)
 
-    def _get_service(self, service):
-        federation_entity = get_federation_entity(self)
-        return federation_entity.client.get_service(service)
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="trust_chain_collector")
+        return self._executor
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def new_resolution(self, leaf: Optional[str] = "",
+                       subtrees: Optional[dict] = None) -> Resolution:
+        """
+        :param leaf: The entity whose superiors are collected
+        :param subtrees: Memoized subtrees shared with other resolutions
+        """
+        return Resolution(max_concurrency=self.max_concurrency,
+                          max_statements=self.max_statements,
+                          timeout=self.resolution_timeout,
+                          leaf=leaf,
+                          subtrees=subtrees)
 
-    def get_document(self, url: str):
+    def followed_hints(self, entity_id: str, authority_hints: List[str]) -> List[str]:
         """
+        :return: The authority hints that should be followed, at most max_fan_out of them
+        """
+        if self.max_fan_out and len(authority_hints) > self.max_fan_out:
+            logger.warning(f"'{entity_id}' has {len(authority_hints)} authority hints, "
+                           f"only following the first {self.max_fan_out}")
+            return authority_hints[:self.max_fan_out]
+        return authority_hints
+
+    def out_of_budget(self, seen: List[str], max_superiors: int,
+                      resolution: Resolution) -> bool:
+        """
+        Check the limits that bound the work done for one resolution before another
+        subordinate statement is collected.
 
-        :param url: Target URL
-        :param httpc_args: Arguments for the HTTP call.
-        :return: Signed EntityStatement
+        :param seen: The authorities on the path from the leaf, the next one included
+        :param max_superiors: The maximum number of superiors
+        :param resolution: The resolution
+        :return: True if the branch should not be collected
+        """
+        if max_superiors and len(seen) > max_superiors:
+            logger.warning(f"Reached max superiors. The path here was {seen}")
+        elif resolution.timed_out():
+            logger.warning(f"Resolution timed out at {seen[-1]}")
+        elif not resolution.spend():
+            logger.warning(f"Statement budget ({resolution.max_statements}) used up at {seen[-1]}")
+        else:
+            return False
+        resolution.cut()
+        return True
+
+    def violates_constraints(self, entity: str, entity_statement: str, seen: List[str],
+                             resolution: Resolution) -> bool:
         """
+        Apply the constraints in a statement issued by a superior to the part of the path
+        that is already known. A branch that violates them can never verify so there is no
+        point in collecting the rest of it.
+
+        :param entity: The subject of the statement
+        :param entity_statement: A signed subordinate statement
+        :param seen: The authorities on the path from the leaf, the issuer included
+        :param resolution: The resolution
+        :return: True if the constraints are violated
+        """
+        _constraints = parse_statement(entity_statement).payload().get("constraints")
+        if not _constraints:
+            return False
+
+        _subjects = seen[:-1]
+        if resolution.leaf:
+            _subjects.insert(0, resolution.leaf)
+        if entity not in _subjects:
+            _subjects.append(entity)
+        _violation = constraint_violation(_constraints, len(seen) - 1, _subjects)
+        if _violation:
+            logger.warning(f"Pruning branch at {seen[-1]}: {_violation}")
+            resolution.cut()
+            return True
+        return False
+
+    def _get_service(self, service):
+        federation_entity = get_federation_entity(self)
+        return federation_entity.client.get_service(service)
+
+    def get_httpc_params(self) -> dict:
         _keyjar = self.upstream_get('attribute', 'keyjar')
 
         _httpc_params = _keyjar.httpc_params
@@ -109,12 +325,17 @@ class TrustChainCollector(Function):
             logger.debug(f"federation_entity.httpc_params: {_httpc_params}")
 
         logger.debug(f"Using HTTPC Params: {_httpc_params}")
-        try:
-            response = self.upstream_get('attribute', 'httpc')("GET", url, **_httpc_params)
-        except ConnectionError as err:
-            logger.error(f'Could not connect to {url}:{err}')
-            raise
+        return _httpc_params
 
+    def handle_response(self, url: str, response) -> str:
+        """
+        Deal with the HTTP response to a request for an entity configuration or a
+        subordinate statement.
+
+        :param url: Target URL
+        :param response: HTTP response
+        :return: Signed EntityStatement
+        """
         if response.status_code == 200:
             if 'application/entity-statement+jwt' not in response.headers['Content-Type']:
                 logger.warning(f"Wrong Content-Type: {response.headers['Content-Type']}")
@@ -124,6 +345,98 @@ class TrustChainCollector(Function):
         else:
             raise FailedConfigurationRetrieval()
 
+    def request_args(self, url: str) -> dict:
+        """
+        :param url: Target URL
+        :return: Arguments for the HTTP call. Makes the request conditional if there is
+            cached information about the target.
+        """
+        _httpc_params = self.get_httpc_params()
+        _headers = self.http_cache.conditional_headers(url)
+        if _headers:
+            _httpc_params = _httpc_params.copy()
+            _headers.update(_httpc_params.get("headers", {}))
+            _httpc_params["headers"] = _headers
+        return _httpc_params
+
+    def process_response(self, url: str, response) -> str:
+        """
+        Handle a HTTP response and update the HTTP cache.
+
+        :param url: Target URL
+        :param response: HTTP response
+        :return: Signed EntityStatement
+        """
+        if response.status_code == 304:
+            _body = self.http_cache.not_modified(url, response.headers)
+            if _body:
+                logger.debug(f"Not modified: '{url}'")
+                return _body
+
+        _body = self.handle_response(url, response)
+        try:
+            _exp = unverified_entity_statement(_body).get("exp", 0)
+        except Exception:
+            _exp = 0
+        self.http_cache.store(url, _body, response.headers, exp=_exp)
+        return _body
+
+    def get_document(self, url: str):
+        """
+        Concurrent requests for the same URL are coalesced into one.
+
+        :param url: Target URL
+        :return: Signed EntityStatement
+        """
+        return self.fetches.do(url, self.fetch_document, url)
+
+    def fetch_document(self, url: str):
+        # Raises an exception if the URL recently failed or the host is unavailable
+        self.failures.check(url)
+        _httpc_params = self.request_args(url)
+        try:
+            response = self.upstream_get('attribute', 'httpc')("GET", url, **_httpc_params)
+            _document = self.process_response(url, response)
+        except ConnectionError as err:
+            logger.error(f'Could not connect to {url}:{err}')
+            self.failures.record_failure(url, err)
+            raise
+        except Exception as err:
+            # Every failure must be recorded, otherwise a failed probe of a host would
+            # keep its circuit half open for good.
+            self.failures.record_failure(url, err)
+            raise
+
+        self.failures.record_success(url)
+        return _document
+
+    def entity_configuration_urls(self, entity_id: str) -> List[str]:
+        _serv = self._get_service('entity_configuration')
+        _urls = [_serv.get_request_parameters(request_args={"entity_id": entity_id})["url"]]
+        _tres = _serv.get_request_parameters(request_args={"entity_id": entity_id}, tenant=True)
+        if _tres["url"] not in _urls:
+            _urls.append(_tres["url"])
+        return _urls
+
+    def reuse_limit(self, urls: List[str], statement: str, exp: int) -> int:
+        """
+        The time until which a statement may be reused. That is the statement's expiration
+        time unless the HTTP response said something shorter.
+        """
+        for url in urls:
+            _until = self.http_cache.reuse_until(url, statement)
+            if _until:
+                return min(exp, _until)
+        return exp
+
+    def reusable_configuration(self, entity_id: str, entity_config: dict) -> bool:
+        _until = self.reuse_limit(self.entity_configuration_urls(entity_id),
+                                  entity_config.get("_jws", ""), entity_config["exp"])
+        if utc_time_sans_frac() > _until:
+            logger.debug(f"Cached entity configuration for '{entity_id}' must be refreshed")
+            return False
+        return True
+
     def get_entity_configuration(self, entity_id):
         """
         Get configuration information about an entity from itself.
@@ -181,31 +494,58 @@ class TrustChainCollector(Function):
 
         return _ec['metadata']
 
-    def get_federation_fetch_endpoint(self, intermediate: str) -> str:
-        logger.debug(f'--get_federation_fetch_endpoint({intermediate})')
+    def cached_fetch_endpoint(self, intermediate: str) -> Optional[str]:
         # In cache ??
         _entity_config = self.config_cache[intermediate]
-        if _entity_config:
+        if _entity_config and self.reusable_configuration(intermediate, _entity_config):
             logger.debug(f'Cached info: {_entity_config}')
             # will return None if cached information is outdated
-            fed_fetch_endpoint = get_endpoint("fetch", _entity_config)
-        else:
-            fed_fetch_endpoint = None
+            return get_endpoint("fetch", _entity_config)
+        return None
+
+    def cache_entity_configuration(self, entity_id: str, signed_entity_config: str) -> dict:
+        """
+        Verify the self-signed signature of an entity configuration and cache it.
+
+        :param entity_id: Who the entity configuration is about
+        :param signed_entity_config: The entity configuration as a signed JWT
+        :return: The verified entity configuration
+        """
+        entity_config = verify_self_signed_signature(signed_entity_config)
+        logger.debug(f'Verified self signed statement: {entity_config}')
+        entity_config["_jws"] = signed_entity_config
+        # update cache
+        self.config_cache[entity_id] = entity_config
+        return entity_config
+
+    def authority_configuration(self, authority: str) -> Optional[dict]:
+        _entity_config = self.config_cache[authority]
+        if _entity_config is None:
+            # Evicted from the cache, fetching the fetch endpoint will restore it.
+            self.get_federation_fetch_endpoint(authority)
+            _entity_config = self.config_cache[authority]
+        return _entity_config
+
+    def get_federation_fetch_endpoint(self, intermediate: str) -> str:
+        logger.debug(f'--get_federation_fetch_endpoint({intermediate})')
+        fed_fetch_endpoint = self.cached_fetch_endpoint(intermediate)
 
         if not fed_fetch_endpoint:
             signed_entity_config = self.get_entity_configuration(intermediate)
             if signed_entity_config is None:
                 return ''
 
-            entity_config = verify_self_signed_signature(signed_entity_config)
-            logger.debug(f'Verified self signed statement: {entity_config}')
+            entity_config = self.cache_entity_configuration(intermediate, signed_entity_config)
             fed_fetch_endpoint = get_endpoint("fetch", entity_config)
-            # update cache
-            entity_config["_jws"] = signed_entity_config
-            self.config_cache[intermediate] = entity_config
 
         return fed_fetch_endpoint
 
+    def entity_statement_url(self, fetch_endpoint, issuer, subject) -> str:
+        _serv = self._get_service('entity_statement')
+        _res = _serv.get_request_parameters(subject=subject, fetch_endpoint=fetch_endpoint,
+                                            issuer=issuer)
+        return _res['url']
+
     def get_entity_statement(self, fetch_endpoint, issuer, subject):
         """
         Get Entity Statement by one entity about another or about itself
@@ -215,21 +555,18 @@ class TrustChainCollector(Function):
         :param subject: About whom the entity statement should be
         :return: A signed JWT
         """
-        _serv = self._get_service('entity_statement')
-        _res = _serv.get_request_parameters(subject=subject, fetch_endpoint=fetch_endpoint,
-                                            issuer=issuer)
-
         # if self.use_ssc:
         #     signed_entity_statement = self.do_ssc_seq(_url, issuer)
         # else:
-        return self.get_document(_res['url'])
+        return self.get_document(self.entity_statement_url(fetch_endpoint, issuer, subject))
 
     def collect_tree(self,
                      entity_id: str,
                      entity_configuration: Union[dict, Message],
                      seen: Optional[list] = None,
-                     max_superiors: Optional[int] = 1,
-                     stop_at: Optional[str] = "") -> Optional[dict]:
+                     max_superiors: Optional[int] = None,
+                     stop_at: Optional[str] = "",
+                     resolution: Optional[Resolution] = None) -> Optional[dict]:
         """
         Collect superiors one level at the time
 
@@ -237,13 +574,19 @@ class TrustChainCollector(Function):
         :param entity_configuration: Entity Configuration as a dictionary
         :param seen: A list of authorities that this process has seen. This to capture
             loops. Also used to control the allowed depth.
-        :param max_superiors: The maximum number of superiors.
+        :param max_superiors: The maximum number of superiors. Default is the collector's
+            max_superiors.
         :param stop_at: The ID of the trust anchor at which the trust chain should stop.
+        :param resolution: State shared by all branches collected for one entity.
         :return: Dictionary of superiors
         """
         superior = {}
         if seen is None:
             seen = []
+        if max_superiors is None:
+            max_superiors = self.max_superiors
+        if resolution is None:
+            resolution = self.new_resolution(leaf="" if seen else entity_id)
 
         logger.debug(f'Collect superiors to: {entity_id}')
         logger.debug(f'Collect based on: {entity_configuration}')
@@ -254,30 +597,103 @@ class TrustChainCollector(Function):
             logger.debug("Reached trust anchor")
             return superior
 
-        for authority in entity_configuration['authority_hints']:
+        _authorities = self.followed_hints(entity_id, entity_configuration['authority_hints'])
+        for authority in _authorities:
             if authority in seen:  # loop ?!
                 logger.warning(f"Loop detected at {authority}")
+
+        if self.concurrent and len(_authorities) > 1:
+            return self._collect_concurrently(entity_id, _authorities, seen, max_superiors,
+                                              stop_at, resolution)
+
+        for authority in _authorities:
             superior[authority] = self.collect_branch(entity_id, authority, seen,
-                                                      max_superiors, stop_at=stop_at)
+                                                      max_superiors, stop_at=stop_at,
+                                                      resolution=resolution)
 
         return superior
 
-    def _get_entity_statement(self, entity: str, authority: str) -> Optional[str]:
-        # Try to get the entity statement from the cache
-        _cache_key = cache_key(authority, entity)
-        entity_statement = self.entity_statement_cache[_cache_key]
+    def _collect_branch_in_worker(self, entity_id, authority, seen, max_superiors, stop_at,
+                                  resolution):
+        try:
+            return self.collect_branch(entity_id, authority, seen, max_superiors,
+                                       stop_at=stop_at, resolution=resolution)
+        finally:
+            resolution.release()
+
+    def _collect_concurrently(self, entity_id, authorities, seen, max_superiors, stop_at,
+                              resolution) -> dict:
+        """
+        Collect sibling branches in parallel. The first branch is always collected in the
+        calling thread, as are the branches for which no worker slot is available.
+        A branch that has not been picked up by a worker when its result is needed is
+        cancelled and collected in the calling thread instead. That way a thread never waits
+        for work that has not started, so nested collections can not deadlock the pool.
 
+        :return: Dictionary of superiors in the same order as the authorities
+        """
+        _futures = {}
+        for authority in authorities[1:]:
+            if resolution.acquire():
+                _futures[authority] = self._get_executor().submit(
+                    self._collect_branch_in_worker, entity_id, authority, seen, max_superiors,
+                    stop_at, resolution)
+
+        _branch = {}
+        for authority in authorities:
+            if authority not in _futures:
+                _branch[authority] = self.collect_branch(entity_id, authority, seen,
+                                                         max_superiors, stop_at=stop_at,
+                                                         resolution=resolution)
+
+        for authority, future in _futures.items():
+            if future.cancel():
+                resolution.release()
+                _branch[authority] = self.collect_branch(entity_id, authority, seen,
+                                                         max_superiors, stop_at=stop_at,
+                                                         resolution=resolution)
+            else:
+                _branch[authority] = future.result()
+
+        return {authority: _branch[authority] for authority in authorities}
+
+    def cached_entity_statement(self, entity: str, authority: str) -> Optional[str]:
+        # Try to get the entity statement from the cache
+        # The cache will not return statements that are too old
+        entity_statement = self.entity_statement_cache[cache_key(authority, entity)]
         if entity_statement is not None:
+            if not self.fresh_statement(entity, authority, entity_statement):
+                logger.debug("Cached statement must be refreshed")
+                return None
             logger.debug("Have cached statement")
-            # Verify that the cached statement is not too old
-            _now = utc_time_sans_frac()
-            _time_key = time_key(authority, entity)
-            _exp = self.entity_statement_cache[_time_key]
-            if _now > (_exp - self.allowed_delta):
-                logger.debug("Cached entity statement timed out")
-                del self.entity_statement_cache[_cache_key]
-                del self.entity_statement_cache[_time_key]
-                entity_statement = None
+        return entity_statement
+
+    def fresh_statement(self, entity: str, authority: str, entity_statement: str) -> bool:
+        """
+        Whether the HTTP response the statement came in, if it said anything about it,
+        allows the statement to be reused now. Unlike the statement's expiration time, no
+        allowed delta is applied.
+        """
+        _entity_config = self.config_cache[authority]
+        if not _entity_config:
+            return True
+        _fetch_endpoint = get_endpoint("fetch", _entity_config)
+        if not _fetch_endpoint:
+            return True
+        _url = self.entity_statement_url(_fetch_endpoint, authority, entity)
+        _exp = parse_statement(entity_statement).payload()["exp"]
+        return utc_time_sans_frac() <= self.reuse_limit([_url], entity_statement, _exp)
+
+    def cache_entity_statement(self, entity: str, authority: str, entity_statement: str):
+        # entity_statement is a signed JWT. It is cached until it expires, how long the HTTP
+        # response allows it to be reused is checked when it is picked from the cache.
+        statement = unverified_entity_statement(entity_statement)
+        logger.debug(f"Unverified entity statement from {authority} about {entity}: {statement}")
+        self.entity_statement_cache.set(cache_key(authority, entity), entity_statement,
+                                        exp=statement["exp"])
+
+    def _get_entity_statement(self, entity: str, authority: str) -> Optional[str]:
+        entity_statement = self.cached_entity_statement(entity, authority)
 
         if entity_statement is None:
             logger.debug(f"Have not seen '{authority}' before")
@@ -287,18 +703,36 @@ class TrustChainCollector(Function):
             if not fed_fetch_endpoint:
                 return None
             logger.debug(f"Federation fetch endpoint: '{fed_fetch_endpoint}' for '{authority}'")
-            entity_statement = self.get_entity_statement(fed_fetch_endpoint, authority, entity)
-            # entity_statement is a signed JWT
-            statement = unverified_entity_statement(entity_statement)
-            logger.debug(
-                f"Unverified entity statement from {fed_fetch_endpoint} about {entity}: "
-                f"{statement}")
-            self.entity_statement_cache[_cache_key] = entity_statement
-            self.entity_statement_cache[time_key(authority, entity)] = statement["exp"]
+            _url = self.entity_statement_url(fed_fetch_endpoint, authority, entity)
+            entity_statement = self.get_document(_url)
+            self.cache_entity_statement(entity, authority, entity_statement)
 
         return entity_statement
 
-    def collect_branch(self, entity, authority, seen=None, max_superiors=10, stop_at=""):
+    def refresh_entity_statement(self, entity: str, authority: str) -> Optional[str]:
+        """
+        Fetch a new statement by an authority about an entity, ignoring the cached one.
+
+        :return: A signed JWT
+        """
+        _key = cache_key(authority, entity)
+        if _key in self.entity_statement_cache:
+            del self.entity_statement_cache[_key]
+        return self._get_entity_statement(entity, authority)
+
+    def refresh_entity_configuration(self, entity_id: str) -> Optional[str]:
+        """
+        Fetch a new entity configuration, ignoring the cached one.
+
+        :return: A signed JWT
+        """
+        signed_entity_config = self.get_entity_configuration(entity_id)
+        if signed_entity_config:
+            self.cache_entity_configuration(entity_id, signed_entity_config)
+        return signed_entity_config
+
+    def collect_branch(self, entity, authority, seen=None, max_superiors=None, stop_at="",
+                       resolution=None):
         """
         Collect an entity statement about an entity submitted by another entity, the authority.
         This consist of first finding the fed_fetch_endpoint URL for the authority and then
@@ -309,7 +743,9 @@ class TrustChainCollector(Function):
         :param entity: The ID of the entity
         :param seen: A list of authorities that this process has seen. This to capture
             loops. Also used to control the allowed depth.
-        :param max_superiors: The maximum number of superiors allowed.
+        :param max_superiors: The maximum number of superiors allowed. Default is the
+            collector's max_superiors.
+        :param resolution: State shared by all branches collected for one entity.
         :return:
         """
 
@@ -323,23 +759,96 @@ class TrustChainCollector(Function):
         else:
             _seen = seen[:]
 
+        if authority in _seen:
+            logger.warning(f"Loop detected at {authority}, path: {_seen}")
+            # What is pruned depends on the path here, so the subtrees above must not be
+            # reused on other paths
+            if resolution is not None:
+                resolution.cut()
+            return None
+
         _seen.append(authority)
-        # if len(_seen) > max_superiors:
-        #     logger.warning("Reached max superiors. The path here was {}".format(_seen))
-        #     return None
+        if max_superiors is None:
+            max_superiors = self.max_superiors
+        if resolution is None:
+            resolution = self.new_resolution(leaf="" if seen else entity)
+        if self.out_of_budget(_seen, max_superiors, resolution):
+            return None
 
         entity_statement = self._get_entity_statement(entity, authority)
 
         if entity_statement:
-            _entity_configuration = self.config_cache[authority]
-            return entity_statement, self.collect_tree(authority,
-                                                       _entity_configuration,
-                                                       stop_at=stop_at,
-                                                       seen=_seen,
-                                                       max_superiors=max_superiors)
+            if self.violates_constraints(entity, entity_statement, _seen, resolution):
+                return None
+            # How many more superiors there may be above the authority
+            _room = max_superiors - len(_seen) if max_superiors else None
+            _subtree = self.memoized_subtree(authority, stop_at, resolution, room=_room)
+            if _subtree is None:
+                _cuts = resolution.cuts
+                _entity_configuration = self.authority_configuration(authority)
+                _subtree = self.collect_tree(authority,
+                                             _entity_configuration,
+                                             stop_at=stop_at,
+                                             seen=_seen,
+                                             max_superiors=max_superiors,
+                                             resolution=resolution)
+                # A subtree that was pruned depends on the path to it and on the
+                # resolution's budget and must not be reused.
+                if resolution.cuts == _cuts:
+                    self.memoize_subtree(authority, stop_at, _subtree, resolution)
+            return entity_statement, _subtree
         else:
             return None
 
+    def memoized_subtree(self, authority: str, stop_at: str, resolution: Resolution,
+                         room: Optional[int] = None) -> Optional[dict]:
+        """
+        A superior tree of the authority collected before. A tree is only reused if it is
+        no higher than what is allowed where the authority is now reached, it may have
+        been collected closer to a leaf.
+
+        :param room: How many levels of superiors are allowed above the authority. None
+            means no limit.
+        :return: The superior tree or None
+        """
+        _memo = resolution.get_subtree(authority, stop_at)
+        if _memo is None and self.keep_subtrees:
+            _key = cache_key(stop_at, authority)
+            _subtree = self.subtree_cache[_key]
+            if _subtree is not None:
+                resolution.set_subtree(authority, stop_at, _subtree,
+                                       self.subtree_cache.get_exp(_key))
+                _memo = resolution.get_subtree(authority, stop_at)
+        if _memo is None:
+            return None
+        if room is not None and _memo[2] > room:
+            return None
+        return _memo[0]
+
+    def memoize_subtree(self, authority: str, stop_at: str, subtree: dict,
+                        resolution: Resolution):
+        """
+        Remember the superior tree of an authority. Its expiration time is the earliest
+        expiration time of the authority's entity configuration and the statements in the
+        tree.
+        """
+        _exp = []
+        _entity_configuration = self.config_cache[authority]
+        if _entity_configuration:
+            _exp.append(_entity_configuration["exp"])
+        for superior, branch in subtree.items():
+            if branch is None:
+                continue
+            _exp.append(parse_statement(branch[0]).payload()["exp"])
+            _memo = resolution.get_subtree(superior, stop_at)
+            if _memo and _memo[1]:
+                _exp.append(_memo[1])
+        _exp = min(_exp) if _exp else 0
+
+        resolution.set_subtree(authority, stop_at, subtree, _exp)
+        if self.keep_subtrees and _exp:
+            self.subtree_cache.set(cache_key(stop_at, authority), subtree, exp=_exp)
+
     def too_old(self, statement):
         now = time.time()
         if now >= statement["exp"] + self.allowed_delta:
@@ -347,33 +856,51 @@ class TrustChainCollector(Function):
         else:
             return False
 
-    def __call__(self,
-                 entity_id: str,
-                 max_superiors: Optional[int] = 10,
-                 seen: Optional[List[str]] = None,
-                 stop_at: Optional[str] = ''):
+    def cached_entity_configuration(self, entity_id: str) -> Optional[tuple]:
+        """
+        :return: Tuple of verified and signed entity configuration or None if there is no
+            usable cached entity configuration
+        """
         entity_config = self.config_cache.get(entity_id, None)
-        if entity_config and not self.too_old(entity_config):
+        if entity_config and not self.too_old(entity_config) and self.reusable_configuration(
+                entity_id, entity_config):
             signed_entity_config = entity_config.get("_jws")
             if not signed_entity_config:
                 signed_entity_config = getattr(entity_config, "_jws")
-        else:
-            signed_entity_config = None
+            if signed_entity_config:
+                return entity_config, signed_entity_config
+        return None
 
+    def leaf_configuration(self, entity_id: str) -> Optional[tuple]:
+        """
+        :param entity_id: Entity ID
+        :return: A (entity configuration, signed entity configuration) tuple or None
+        """
+        _cached = self.cached_entity_configuration(entity_id)
+        if _cached:
+            return _cached
+
+        # get leaf Entity Configuration
+        signed_entity_config = self.get_entity_configuration(entity_id)
         if not signed_entity_config:
-            # get leaf Entity Configuration
-            signed_entity_config = self.get_entity_configuration(entity_id)
-            if not signed_entity_config:
-                logger.warning(f"Could not find any entity configuration for {entity_id}")
-                return None
-            entity_config = verify_self_signed_signature(signed_entity_config)
-            logger.debug(f'Verified self signed statement: {entity_config}')
-            entity_config['_jws'] = signed_entity_config
-            # update cache
-            self.config_cache[entity_id] = entity_config
+            logger.warning(f"Could not find any entity configuration for {entity_id}")
+            return None
+        return self.cache_entity_configuration(entity_id, signed_entity_config), \
+            signed_entity_config
+
+    def __call__(self,
+                 entity_id: str,
+                 max_superiors: Optional[int] = None,
+                 seen: Optional[List[str]] = None,
+                 stop_at: Optional[str] = '',
+                 resolution: Optional[Resolution] = None):
+        _leaf = self.leaf_configuration(entity_id)
+        if _leaf is None:
+            return None
+        entity_config, signed_entity_config = _leaf
 
         return self.collect_tree(entity_id, entity_config, seen=seen, max_superiors=max_superiors,
-                                 stop_at=stop_at), signed_entity_config
+                                 stop_at=stop_at, resolution=resolution), signed_entity_config
 
     def add_trust_anchor(self, entity_id, jwks):
         if self.keyjar:
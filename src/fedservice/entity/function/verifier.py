@@ -1,28 +1,93 @@
+import copy
+import hashlib
 import logging
 from typing import Callable
+from typing import Dict
 from typing import List
+from typing import Optional
 
 from cryptojwt import KeyBundle
 from cryptojwt.exception import MissingKey
-from cryptojwt.jws.jws import factory
 
 from fedservice.entity.function import Function
 from fedservice.entity.utils import get_federation_entity
+from fedservice.entity_statement.cache import ESCache
 from fedservice.entity_statement.constraints import meets_restrictions
+from fedservice.entity_statement.parse import parse_statement
+from fedservice.entity_statement.parse import verify_with_jwks
 from fedservice.entity_statement.statement import TrustChain
 from fedservice.exception import UnknownTrustAnchor
 
 logger = logging.getLogger(__name__)
 
 
+def chain_digest(chain: List[str]) -> str:
+    _hash = hashlib.sha256()
+    for entity_statement in chain:
+        _hash.update(entity_statement.encode())
+        # Can't be part of a compact JWS
+        _hash.update(b"~")
+    return _hash.hexdigest()
+
+
 class TrustChainVerifier(Function):
 
-    def __init__(self, upstream_get: Callable):
+    def __init__(self, upstream_get: Callable,
+                 cache_size: Optional[int] = 1000,
+                 allowed_delta: Optional[int] = 300):
+        """
+        :param upstream_get: Function to get information from the entity this is part of
+        :param cache_size: Max number of verified trust chains to keep. 0 turns caching off.
+        :param allowed_delta: A verified trust chain is not reused later than this many
+            seconds before it expires.
+        """
         Function.__init__(self, upstream_get)
+        self.cache_size = cache_size
+        self.verified_cache = ESCache(allowed_delta=allowed_delta, max_entries=cache_size)
+
+    def clear_cache(self):
+        self.verified_cache.clear()
+
+    def anchor_keys(self, anchor: str) -> List[str]:
+        """
+        :return: Thumbprints of the keys the key jar has for a trust anchor
+        """
+        _keyjar = self.upstream_get("attribute", "keyjar")
+        try:
+            _keys = _keyjar.get_issuer_keys(anchor)
+        except KeyError:
+            return []
+        return sorted(k.thumbprint("SHA-256").decode() for k in _keys)
+
+    def cached_verification(self, chain: List[str]) -> Optional[list]:
+        if not self.cache_size:
+            return None
+
+        _digest = chain_digest(chain)
+        _cached = self.verified_cache[_digest]
+        if _cached is None:
+            return None
+
+        _anchor = _cached["verified_chain"][0]["iss"]
+        if self.anchor_keys(_anchor) != _cached["anchor_keys"]:
+            logger.debug(f"The keys of the trust anchor '{_anchor}' have changed")
+            del self.verified_cache[_digest]
+            return None
+
+        logger.debug("Using cached verified trust chain")
+        return copy.deepcopy(_cached["verified_chain"])
+
+    def cache_verification(self, chain: List[str], verified_chain: list, exp: int):
+        if not self.cache_size:
+            return
+
+        self.verified_cache.set(chain_digest(chain), {
+            "verified_chain": copy.deepcopy(verified_chain),
+            "anchor_keys": self.anchor_keys(verified_chain[0]["iss"])
+        }, exp=exp)
 
     def trusted_anchor(self, entity_statement):
-        _jwt = factory(entity_statement)
-        payload = _jwt.jwt.payload()
+        payload = parse_statement(entity_statement).payload()
         _federation_entity = get_federation_entity(self)
         if _federation_entity:
             if payload['iss'] not in _federation_entity.keyjar:
@@ -58,50 +123,115 @@ class TrustChainVerifier(Function):
         n = len(entity_statement_list) - 1
         _keyjar = self.upstream_get("attribute", "keyjar")
         for entity_statement in entity_statement_list:
-            _jwt = factory(entity_statement)
-            if _jwt:
-                logger.debug(f"JWS header: {_jwt.jwt.headers}", )
-                logger.debug(f"JWS payload: {_jwt.jwt.payload()}")
-                keys = _keyjar.get_jwt_verify_keys(_jwt.jwt)
+            try:
+                _statement = parse_statement(entity_statement)
+            except ValueError:
+                _statement = None
+            if _statement:
+                logger.debug(f"JWS header: {_statement.headers}", )
+                logger.debug(f"JWS payload: {_statement.payload()}")
+                keys = _keyjar.get_jwt_verify_keys(_statement)
                 if keys == []:
-                    logger.error(f'No keys matching: {_jwt.jwt.headers}')
+                    logger.error(f'No keys matching: {_statement.headers}')
                     logger.debug(f"keyjar contains: {_keyjar}")
-                    raise MissingKey(f'No keys matching: {_jwt.jwt.headers}')
+                    raise MissingKey(f'No keys matching: {_statement.headers}')
 
                 _key_spec = [f'{k.kty}:{k.use}:{k.kid}' for k in keys]
                 logger.debug("Possible verification keys: %s", _key_spec)
-                res = _jwt.verify_compact(keys=keys)
+                res = _statement.verify(keys)
                 logger.debug("Verified entity statement: %s", res)
-                try:
-                    _jwks = res['jwks']
-                except KeyError:
-                    if len(ves) != n:
-                        raise ValueError('Missing signing JWKS')
-                else:
-                    _kb = KeyBundle(keys=_jwks['keys'])
-                    try:
-                        old = _keyjar.get_issuer_keys(res['sub'])
-                    except KeyError:
-                        _keyjar.add_kb(res['sub'], _kb)
-                    else:
-                        new = [k for k in _kb if k not in old]
-                        if new:
-                            _key_spec = [f'{k.kty}:{k.use}:{k.kid}' for k in new]
-                            logger.debug(
-                                "New keys added to the federation key jar for '{}': {}".format(
-                                    res['sub'], _key_spec)
-                            )
-                            # Only add keys to the KeyJar if they are not already there.
-                            _kb.set(new)
-                            _keyjar.add_kb(res['sub'], _kb)
-
-                ves.append(res)
+                if 'jwks' in res:
+                    self.add_subject_keys(_keyjar, res)
+                elif len(ves) != n:
+                    raise ValueError('Missing signing JWKS')
+
+                # The payload, nested claims included, is shared with the parse cache.
+                # Don't let it be modified.
+                ves.append(copy.deepcopy(res))
 
         if ves and meets_restrictions(ves):
             return ves
         else:
             return []
 
+    def add_subject_keys(self, keyjar, statement: dict):
+        _kb = KeyBundle(keys=statement['jwks']['keys'])
+        try:
+            old = keyjar.get_issuer_keys(statement['sub'])
+        except KeyError:
+            keyjar.add_kb(statement['sub'], _kb)
+        else:
+            new = [k for k in _kb if k not in old]
+            if new:
+                _key_spec = [f'{k.kty}:{k.use}:{k.kid}' for k in new]
+                logger.debug(
+                    "New keys added to the federation key jar for '{}': {}".format(
+                        statement['sub'], _key_spec)
+                )
+                # Only add keys to the KeyJar if they are not already there.
+                _kb.set(new)
+                keyjar.add_kb(statement['sub'], _kb)
+
+    def update_trust_chain(self, trust_chain: TrustChain,
+                           links: Dict[int, str]) -> Optional[TrustChain]:
+        """
+        Replace some of the statements in a verified trust chain. Only the new statements,
+        and the statements below a statement that changed the keys of its subject, are
+        verified. The other statements are reused as they are.
+
+        :param trust_chain: A verified TrustChain instance
+        :param links: Signed statements keyed by their index in the chain. The trust
+            anchor's statement has index 0 and the entity configuration the last index.
+        :return: A new TrustChain instance or None if the chain does not verify
+        """
+        _chain = list(trust_chain.chain)
+        _verified = copy.deepcopy(trust_chain.verified_chain)
+        if len(_chain) != len(_verified):
+            return None
+
+        _keyjar = self.upstream_get("attribute", "keyjar")
+        _keys_changed = False
+        for i in range(min(links), len(_chain)):
+            if i in links:
+                _chain[i] = links[i]
+            elif not _keys_changed:
+                continue
+
+            _statement = parse_statement(_chain[i])
+            if i == 0:
+                if not self.trusted_anchor(_chain[0]):
+                    return None
+                res = _statement.verify(_keyjar.get_jwt_verify_keys(_statement))
+            else:
+                # Signed by the subject of the statement above
+                res = verify_with_jwks(_statement, _verified[i - 1]['jwks'])
+            res = copy.deepcopy(res)
+            if res['sub'] != _verified[i]['sub'] or res['iss'] != _verified[i]['iss']:
+                logger.warning(f"Replacement statement is about something else: {res}")
+                return None
+
+            _keys_changed = res.get('jwks') != _verified[i].get('jwks')
+            if 'jwks' in res:
+                self.add_subject_keys(_keyjar, res)
+            _verified[i] = res
+
+        if not meets_restrictions(_verified):
+            return None
+
+        _expires_at = self.trust_chain_expires_at(_verified)
+        self.cache_verification(_chain, _verified, _expires_at)
+        return self.make_trust_chain(_chain, _verified, _expires_at)
+
+    def make_trust_chain(self, chain: List[str], verified_chain: list, exp: int) -> TrustChain:
+        trust_chain = TrustChain(exp=exp, verified_chain=verified_chain)
+
+        iss_path = [x['iss'] for x in verified_chain]
+        trust_chain.anchor = iss_path[0]
+        iss_path.reverse()
+        trust_chain.iss_path = iss_path
+        trust_chain.chain = chain
+        return trust_chain
+
     def trust_chain_expires_at(self, trust_chain):
         exp = -1
         for entity_statement in trust_chain:
@@ -120,19 +250,16 @@ class TrustChainVerifier(Function):
         :returns: A TrustChain instances
         """
         logger.debug("Evaluate trust chain")
-        verified_trust_chain = self.verify_trust_chain(chain)
-
-        if not verified_trust_chain:
-            return None
-
-        _expires_at = self.trust_chain_expires_at(verified_trust_chain)
+        verified_trust_chain = self.cached_verification(chain)
+        if verified_trust_chain:
+            _expires_at = self.trust_chain_expires_at(verified_trust_chain)
+        else:
+            verified_trust_chain = self.verify_trust_chain(chain)
 
-        trust_chain = TrustChain(exp=_expires_at, verified_chain=verified_trust_chain)
+            if not verified_trust_chain:
+                return None
 
-        iss_path = [x['iss'] for x in verified_trust_chain]
-        trust_chain.anchor = iss_path[0]
-        iss_path.reverse()
-        trust_chain.iss_path = iss_path
-        trust_chain.chain = chain
+            _expires_at = self.trust_chain_expires_at(verified_trust_chain)
+            self.cache_verification(chain, verified_trust_chain, _expires_at)
 
-        return trust_chain
+        return self.make_trust_chain(chain, verified_trust_chain, _expires_at)
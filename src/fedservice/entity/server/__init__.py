@@ -6,6 +6,7 @@ from typing import Union
 
 from cryptojwt import KeyJar
 from fedservice.entity.context import FederationServerContext
+from fedservice.entity.server.subordinate_registry import SubordinateRegistry
 from idpyoidc.context import OidcContext
 from idpyoidc.server.client_authn import client_auth_setup
 from idpyoidc.server.configure import ASConfiguration
@@ -80,6 +81,20 @@ class FederationServerEntity(ServerUnit):
                 else:
                     setattr(self, attr, spec)
 
+    @property
+    def subordinate(self) -> SubordinateRegistry:
+        return self._subordinate
+
+    @subordinate.setter
+    def subordinate(self, value):
+        # Whatever the subordinates are kept in, they are reached through an indexed registry
+        if isinstance(value, SubordinateRegistry):
+            if value.upstream_get is None:
+                value.upstream_get = self.unit_get
+        else:
+            value = SubordinateRegistry(store=value, upstream_get=self.unit_get)
+        self._subordinate = value
+
     def get_endpoints(self, *arg):
         return self.endpoint
 
@@ -1,11 +1,9 @@
-from typing import Callable
 from typing import Optional
 from typing import Union
 
 from idpyoidc.message import Message
 
 from fedservice.entity.utils import get_federation_entity
-from fedservice.entity_statement.create import create_entity_statement
 from idpyoidc.message import oauth2
 from idpyoidc.server import Endpoint
 
@@ -25,35 +23,30 @@ class EntityConfiguration(Endpoint):
     provider_info_attributes = None
     auth_method_attribute = ""
 
-    def __init__(self, upstream_get, **kwargs):
+    def __init__(self, upstream_get, refresh_fraction: Optional[float] = 0.5, **kwargs):
+        """
+        :param upstream_get: Function to get information from the entity this is part of
+        :param refresh_fraction: The signed entity configuration is reused until this much
+            of its lifetime has passed, unless what is in it has changed.
+        """
         Endpoint.__init__(self, upstream_get=upstream_get, **kwargs)
+        self.refresh_fraction = refresh_fraction
 
     def process_request(self, request=None, **kwargs):
         _server = self.upstream_get("unit")
         _fed_entity = get_federation_entity(self)
-        _entity_id = _fed_entity.get_attribute('entity_id')
 
         if _fed_entity.upstream_get:
             _metadata = _fed_entity.upstream_get("metadata")
         else:
             _metadata = _fed_entity.get_metadata()
 
-        if _fed_entity.context.trust_marks:
-            if isinstance(_fed_entity.context.trust_marks, Callable):
-                args = {"trust_marks": _fed_entity.context.get_trust_marks()}
-            else:
-                args = {"trust_marks": _fed_entity.context.trust_marks}
-        else:
-            args = {}
-
-        _ec = create_entity_statement(iss=_entity_id,
-                                      sub=_entity_id,
-                                      key_jar=_fed_entity.get_attribute('keyjar'),
-                                      metadata=_metadata,
-                                      authority_hints=_server.upstream_get('authority_hints'),
-                                      **args
-                                      )
-        return {"response": _ec}
+        _ec, _etag = _fed_entity.context.signed_entity_configuration(
+            metadata=_metadata,
+            authority_hints=_server.upstream_get('authority_hints') or [],
+            key_jar=_fed_entity.get_attribute('keyjar'),
+            refresh_fraction=self.refresh_fraction)
+        return {"response": _ec.decode(), "http_headers": [("ETag", _etag)]}
 
     def response_info(
         self,
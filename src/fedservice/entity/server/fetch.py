@@ -1,9 +1,17 @@
+import hashlib
+import json
 import logging
+from typing import List
+from typing import Optional
+from typing import Tuple
 
+from cryptojwt.jwt import utc_time_sans_frac
 from idpyoidc.message import oidc
 from idpyoidc.server.endpoint import Endpoint
 
+from fedservice.entity_statement.cache import ESCache
 from fedservice.entity_statement.create import create_entity_statement
+from fedservice.entity_statement.parse import parse_statement
 from fedservice.exception import UnknownEntity
 from fedservice.message import EntityStatement
 
@@ -18,69 +26,162 @@ class Fetch(Endpoint):
     name = "fetch"
     endpoint_name = "federation_fetch_endpoint"
 
-    def __init__(self, upstream_get, **kwargs):
+    def __init__(self, upstream_get,
+                 lifetime: Optional[int] = 86400,
+                 cache_size: Optional[int] = 1000,
+                 allowed_delta: Optional[int] = 60,
+                 presign: Optional[bool] = False,
+                 **kwargs):
+        """
+        :param upstream_get: Function to get information from the entity this is part of
+        :param lifetime: Lifetime of the signed subordinate statements
+        :param cache_size: Max number of signed statements cached. 0 turns caching off.
+        :param allowed_delta: A cached statement is not used later than this many seconds
+            before it expires.
+        :param presign: Whether statements about all the subordinates should be signed when
+            the entity is set up.
+        """
         Endpoint.__init__(self, upstream_get=upstream_get, **kwargs)
+        self.lifetime = lifetime
+        self.cache_size = cache_size
+        self.presign_statements = presign
+        self.statement_cache = ESCache(allowed_delta=allowed_delta, max_entries=cache_size)
 
     def get_policy(self, entity_id):
         pass
 
+    def _own_statement(self) -> Tuple[str, str, dict]:
+        _server = self.upstream_get("server")
+        _entity = _server.upstream_get('unit')
+        _entity_id = _entity.context.entity_id
+        _authority_hints = self.upstream_get('authority_hints')
+        if callable(_authority_hints):
+            _authority_hints = _authority_hints()
+        return _entity_id, _entity_id, {
+            "metadata": _entity.get_metadata(),
+            "authority_hints": _authority_hints
+        }
+
+    def _subordinate_statement(self, issuer: str, sub: str) -> Tuple[str, str, dict]:
+        _server = self.upstream_get("unit")
+        # Contains jwks and possibly entity type and authority_hints
+        _response = _server.subordinate.get(sub)
+        if not _response:
+            logger.debug(f"Unknown subordinate: {sub}")
+            logger.debug(f"Known subordinates: {list(_server.subordinate.keys())}")
+            raise UnknownEntity(sub)
+
+        # Don't modify what is stored
+        _response = dict(_response)
+        if not 'authority_hints' in _response:
+            # If nothing specified add myself
+            _response["authority_hints"] = [issuer]
+
+        _policy = _server.policy.get(sub)
+        if not _policy:  # No entity specific policy
+            if 'entity_types' in _response:
+                _entity_types = _response['entity_types']
+                _response = {k: v for k, v in _response.items() if k != 'entity_types'}
+                _policy = {'metadata': {}, 'metadata_policy': {}}
+                for entity_type in _entity_types:
+                    _et_policy = _server.policy.get(entity_type)
+                    if not _et_policy:
+                        continue
+                    for _typ in ['metadata', 'metadata_policy']:
+                        if _typ in _et_policy:
+                            try:
+                                _policy[_typ].update({entity_type: _et_policy[_typ]})
+                            except KeyError:
+                                _policy[_typ] = {entity_type: _et_policy[_typ]}
+
+                if _policy == {'metadata': {}, 'metadata_policy': {}}:  # Nothing has changed
+                    _policy = None
+
+        if _policy:
+            _response.update(_policy)
+        return issuer, sub, _response
+
+    def _digest(self, issuer: str, sub: str, statement: dict) -> str:
+        # What goes into the statement and the keys it is signed with
+        _keyjar = self.upstream_get('attribute', 'keyjar')
+        try:
+            _keys = _keyjar.get_issuer_keys("")
+        except KeyError:
+            _keys = []
+        _state = [issuer, sub, statement, sorted(k.thumbprint("SHA-256").decode() for k in _keys)]
+        return hashlib.sha256(json.dumps(_state, sort_keys=True, default=str).encode()).hexdigest()
+
+    def signed_statement(self, issuer: str, sub: str, statement: dict) -> str:
+        """
+        Sign a statement unless an identical one is already cached.
+
+        :param issuer: The issuer of the statement
+        :param sub: The subject of the statement
+        :param statement: The claims apart from iss and sub
+        :return: A signed JWT
+        """
+        _digest = self._digest(issuer, sub, statement) if self.cache_size else ""
+        if _digest:
+            _cached = self.statement_cache[sub]
+            if _cached and _cached["digest"] == _digest:
+                return _cached["jws"]
+
+        _jws = create_entity_statement(iss=issuer, sub=sub,
+                                       key_jar=self.upstream_get('attribute', 'keyjar'),
+                                       lifetime=self.lifetime, **statement)
+        if _digest:
+            _exp = parse_statement(_jws).payload()["exp"]
+            if _exp > utc_time_sans_frac():
+                self.statement_cache.set(sub, {"digest": _digest, "jws": _jws}, exp=_exp)
+        return _jws
+
+    def invalidate(self, sub: Optional[str] = ""):
+        """
+        Remove cached statements. Should be called when a subordinate's information or a
+        policy is changed. If this is not done, the change is still noticed when the
+        statement is next asked for.
+
+        :param sub: The subordinate whose statement should be removed. If not given all
+            cached statements are removed.
+        """
+        if sub:
+            if sub in self.statement_cache:
+                del self.statement_cache[sub]
+        else:
+            self.statement_cache.clear()
+
+    def presign(self, subordinates: Optional[List[str]] = None) -> int:
+        """
+        Sign and cache statements about subordinates.
+
+        :param subordinates: Entity IDs of the subordinates. Default is all of them.
+        :return: The number of statements signed or found in the cache
+        """
+        if not self.cache_size:
+            return 0
+
+        _issuer = self.upstream_get('attribute', 'entity_id')
+        if subordinates is None:
+            subordinates = list(self.upstream_get("unit").subordinate.keys())
+        _count = 0
+        for sub in subordinates[:self.cache_size]:
+            try:
+                self.signed_statement(*self._subordinate_statement(_issuer, sub))
+            except Exception as err:
+                logger.warning(f"Could not presign statement about '{sub}': {err}")
+                continue
+            _count += 1
+        logger.debug(f"Presigned {_count} subordinate statements")
+        return _count
+
     def process_request(self, request=None, **kwargs):
-        _context = self.upstream_get("context")
         _issuer = request.get("iss")
         if not _issuer:
             _issuer = self.upstream_get('attribute','entity_id')
 
         _sub = request.get("sub")
-        _keyjar = self.upstream_get('attribute', 'keyjar')
         if not _sub or _sub == _issuer:
-            _server = self.upstream_get("server")
-            _entity = _server.upstream_get('unit')
-            _metadata = _entity.get_metadata()
-            _es = create_entity_statement(iss=_entity.context.entity_id,
-                                          sub=_entity.context.entity_id,
-                                          key_jar=_keyjar,
-                                          metadata=_metadata,
-                                          authority_hints=self.upstream_get('authority_hints'))
+            _es = self.signed_statement(*self._own_statement())
         else:
-            _server = self.upstream_get("unit")
-            # Contains jwks and possibly entity type and authority_hints
-            _response = _server.subordinate.get(_sub)
-            if not _response:
-                logger.debug(f"Unknown subordinate: {_sub}")
-                logger.debug(f"Known subordinates: {list(_server.subordinate.keys())}")
-                raise UnknownEntity(_sub)
-
-            if not 'authority_hints' in _response:
-                # If nothing specified add myself
-                _response["authority_hints"] = [_issuer]
-
-            _policy = _server.policy.get(_sub)
-            if not _policy:  # No entity specific policy
-                if 'entity_types' in _response:
-                    _entity_types = _response['entity_types']
-                    _response = {k: v for k, v in _response.items() if k != 'entity_types'}
-                    _policy = {'metadata': {}, 'metadata_policy': {}}
-                    for entity_type in _entity_types:
-                        _et_policy = _server.policy.get(entity_type)
-                        if not _et_policy:
-                            continue
-                        for _typ in ['metadata', 'metadata_policy']:
-                            if _typ in _et_policy:
-                                try:
-                                    _policy[_typ].update({entity_type: _et_policy[_typ]})
-                                except KeyError:
-                                    _policy[_typ] = {entity_type: _et_policy[_typ]}
-
-                    if _policy == {'metadata': {}, 'metadata_policy': {}}:  # Nothing has changed
-                        _policy = None
-
-            if _policy:
-                _response.update(_policy)
-
-            _es = create_entity_statement(iss=_issuer,
-                                          sub=_sub,
-                                          key_jar=_keyjar,
-                                          **_response
-                                          )
+            _es = self.signed_statement(*self._subordinate_statement(_issuer, _sub))
         return {"response_msg": _es}
-
@@ -1,15 +1,44 @@
 import json
 import logging
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
 
-from cryptojwt import JWT
-from cryptojwt import KeyJar
-from idpyoidc.key_import import import_jwks
 from idpyoidc.message import oidc
 from idpyoidc.server.endpoint import Endpoint
 
 logger = logging.getLogger(__name__)
 
 
+def as_bool(value) -> bool:
+    # Query parameters arrive as strings
+    if isinstance(value, str):
+        return value.lower() == "true"
+    return bool(value)
+
+
+def stream_json_array(items: Iterable[str], chunk_size: Optional[int] = 1000) -> Iterator[str]:
+    """
+    Write a JSON array of strings piece by piece, without holding all of it in memory.
+
+    :param items: The strings
+    :param chunk_size: How many strings go into each piece
+    :return: Iterator over pieces of the JSON document
+    """
+    _chunk = []
+    _first = True
+    yield "["
+    for item in items:
+        _chunk.append(json.dumps(item))
+        if len(_chunk) >= chunk_size:
+            yield ("" if _first else ",") + ",".join(_chunk)
+            _first = False
+            _chunk = []
+    if _chunk:
+        yield ("" if _first else ",") + ",".join(_chunk)
+    yield "]"
+
+
 class List(Endpoint):
     request_cls = oidc.Message
     # response_cls = EntityIDList
@@ -17,9 +46,40 @@ class List(Endpoint):
     name = "list"
     endpoint_name = 'federation_list_endpoint'
 
-    def __init__(self, upstream_get, extended=False, **kwargs):
+    def __init__(self, upstream_get, extended=False,
+                 page_size: Optional[int] = 0,
+                 max_page_size: Optional[int] = 0,
+                 stream: Optional[bool] = False,
+                 **kwargs):
+        """
+        :param upstream_get: Function to get information from the entity this is part of
+        :param extended: Return the subordinates' entity configurations, not only their IDs
+        :param page_size: Number of entity IDs returned if the request has no 'limit'.
+            0 means all of them.
+        :param max_page_size: Max number of entity IDs returned, whatever 'limit' says.
+            0 means no max.
+        :param stream: Return the entity IDs as an iterator over pieces of the JSON array
+            instead of as one string.
+        """
         Endpoint.__init__(self, upstream_get, **kwargs)
         self.extended = extended
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.stream = stream
+
+    def _limit(self, request) -> int:
+        try:
+            _limit = int(request.get("limit") or self.page_size or 0)
+        except ValueError:
+            _limit = self.page_size or 0
+        if self.max_page_size and (not _limit or _limit > self.max_page_size):
+            return self.max_page_size
+        return max(_limit, 0)
+
+    def _response(self, entity_ids: Iterable[str]) -> dict:
+        if self.stream:
+            return {"response_msg": stream_json_array(entity_ids)}
+        return {"response_msg": json.dumps(list(entity_ids))}
 
     def filter(self,
                subordinates: dict,
@@ -51,44 +111,39 @@ class List(Endpoint):
 
     def process_request(self, request=None, **kwargs):
         _db = self.upstream_get("unit").subordinate
-        if not request or set(request.keys()).issubset({"client_id", "authenticated"}):
-            return {'response_msg': json.dumps(list(_db.keys()))}
-        else:
-            matched_entity_ids = set()
-            subordinate_conf = None
-            # I know about entity_types and intermediate or not from the registration
-            for entity_id, item in _db.items():
-                if "intermediate" in request and request["intermediate"]:
-                    if "intermediate" in item and item["intermediate"]:
-                        matched_entity_ids.add(entity_id)
-                        continue
-                if "entity_type" in request:
-                    if request["entity_type"] in item["entity_type"]:
-                        matched_entity_ids.add(entity_id)
-
-            # I don't expect to know about trust marks from the registration
-            if "trust_marked" in request or "trust_mark_id" in request:
-                subordinate_conf = self.collect_subordinates()
-                matched_entity_ids.update(self.filter(subordinates=subordinate_conf, **request))
-
-            if self.extended and subordinate_conf:
-                return {"response_msg": json.dumps({id: subordinate_conf[id] for id in
-                                                    matched_entity_ids})}
-            else:
-                return {"response_msg": json.dumps(list(matched_entity_ids))}
+        request = request or {}
+        _query = {k: v for k, v in request.items() if
+                  k not in ["client_id", "authenticated", "limit", "from"]}
+        _limit = self._limit(request)
+        _from = request.get("from", "")
+
+        if not _query and not _limit and not _from:
+            return self._response(_db.keys())
+
+        # Answered from the registry's indexes. Trust marks are picked up from the
+        # subordinates' entity configurations in the background. Only those never picked
+        # up are picked up now.
+        if request.get("trust_marked") or request.get("trust_mark_id") or self.extended:
+            _db.refresh_all(_db.missing())
+        _filter = {k: request.get(k) for k in ["entity_type", "trust_mark_id"]}
+        for flag in ["intermediate", "trust_marked"]:
+            _filter[flag] = as_bool(request.get(flag))
+        # Pages are in entity ID order and 'from' is the last entity ID of the previous page
+        matched_entity_ids = _db.page(after=_from, limit=_limit, **_filter)
+
+        if self.extended and ("trust_marked" in request or "trust_mark_id" in request):
+            return {"response_msg": json.dumps(
+                {id: _db.configuration.get(id, {}) for id in matched_entity_ids})}
+        return self._response(matched_entity_ids)
 
     def collect_subordinates(self) -> dict:
-        _server_entity = self.upstream_get("unit")
-        _federation_entity = _server_entity.upstream_get("unit")
-        keyjar = KeyJar()
-        _collector = _federation_entity.function.trust_chain_collector
-        sub = {}
-        for entity_id, conf in _federation_entity.server.subordinate.items():
-            #  get entity configuration for subordinate
-            _entity_configuration = _collector.get_entity_configuration(entity_id)
-            # Verify signature with the keys I have
-            keyjar = import_jwks(keyjar, conf['jwks'], entity_id)
-            _jwt = JWT(key_jar=keyjar)
-            _ec = _jwt.unpack(_entity_configuration)
-            sub[entity_id] = _ec
-        return sub
+        """
+        Pick up the entity configurations of all the subordinates.
+
+        :return: A dictionary with entity IDs as keys and the verified entity configurations
+            as values.
+        """
+        _registry = self.upstream_get("unit").subordinate
+        _registry.refresh_all()
+        return {id: _registry.configuration[id] for id in _registry.keys() if
+                id in _registry.configuration}
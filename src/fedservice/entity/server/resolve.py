@@ -1,7 +1,9 @@
+import hashlib
 import logging
 from typing import Optional
 from typing import Union
 
+from cryptojwt.jwt import utc_time_sans_frac
 from idpyoidc.message import Message
 from idpyoidc.message import oidc
 from idpyoidc.server.endpoint import Endpoint
@@ -10,7 +12,9 @@ from fedservice.entity.function import apply_policies
 from fedservice.entity.function import collect_trust_chains
 from fedservice.entity.function import verify_trust_chains
 from fedservice.entity.utils import get_federation_entity
+from fedservice.entity_statement.cache import ESCache
 from fedservice.entity_statement.create import create_entity_statement
+from fedservice.entity_statement.parse import parse_statement
 
 logger = logging.getLogger(__name__)
 
@@ -22,13 +26,90 @@ class Resolve(Endpoint):
     name = "resolve"
     endpoint_name = 'federation_resolve_endpoint'
 
-    def __init__(self, upstream_get, **kwargs):
+    def __init__(self, upstream_get,
+                 lifetime: Optional[int] = 86400,
+                 cache_size: Optional[int] = 1000,
+                 cache_max_size: Optional[int] = 0,
+                 allowed_delta: Optional[int] = 60,
+                 **kwargs):
+        """
+        :param upstream_get: Function to get information from the entity this is part of
+        :param lifetime: Lifetime of the signed resolve responses
+        :param cache_size: Max number of signed responses cached. 0 turns caching off.
+        :param cache_max_size: Approximate max number of bytes used by the cached responses.
+            0 means no limit.
+        :param allowed_delta: A cached response is not used later than this many seconds
+            before the trust chain it is based on expires.
+        """
         Endpoint.__init__(self, upstream_get, **kwargs)
+        self.lifetime = lifetime
+        self.cache_size = cache_size
+        self.response_cache = ESCache(allowed_delta=allowed_delta, max_entries=cache_size,
+                                      max_size=cache_max_size)
+
+    @staticmethod
+    def cache_key(request: Union[Message, dict], with_ta_ec) -> str:
+        return "!!".join([request["sub"], request["anchor"], str(request.get("type", "")),
+                          str(bool(with_ta_ec))])
+
+    def key_state(self, anchor: str) -> str:
+        """
+        A digest of the resolver's own keys and the keys of the trust anchor. If it changes
+        cached responses are no longer used.
+        """
+        _keyjar = get_federation_entity(self).get_attribute('keyjar')
+        _hash = hashlib.sha256()
+        for issuer in ["", anchor]:
+            try:
+                _keys = _keyjar.get_issuer_keys(issuer)
+            except KeyError:
+                _keys = []
+            for thumbprint in sorted(k.thumbprint("SHA-256").decode() for k in _keys):
+                _hash.update(thumbprint.encode())
+            _hash.update(b"~")
+        return _hash.hexdigest()
+
+    def cached_response(self, key: str, anchor: str) -> Optional[str]:
+        if not self.cache_size:
+            return None
+        _cached = self.response_cache[key]
+        if _cached is None:
+            return None
+        if _cached["keys"] != self.key_state(anchor):
+            logger.debug("Keys have changed, cached resolve response not used")
+            del self.response_cache[key]
+            return None
+        return _cached["jws"]
+
+    def cache_response(self, key: str, anchor: str, jws: str, trust_chain_exp: int):
+        if not self.cache_size:
+            return
+        _exp = min(trust_chain_exp, parse_statement(jws).payload()["exp"])
+        if _exp > utc_time_sans_frac():
+            self.response_cache.set(key, {"jws": jws, "keys": self.key_state(anchor)}, exp=_exp)
+
+    def clear_cache(self, sub: Optional[str] = "", anchor: Optional[str] = ""):
+        """
+        Remove cached responses. All of them or those for a subject and/or a trust anchor.
+        """
+        if not sub and not anchor:
+            self.response_cache.clear()
+            return
+        for key in self.response_cache.keys():
+            _sub, _anchor, _ = key.split("!!", 2)
+            if (not sub or sub == _sub) and (not anchor or anchor == _anchor):
+                del self.response_cache[key]
 
     def process_request(self, request=None, **kwargs):
         _federation_entity = get_federation_entity(self)
         _trust_anchor = request['anchor']
 
+        _key = self.cache_key(request, kwargs.get("with_ta_ec"))
+        _jws = self.cached_response(_key, _trust_anchor)
+        if _jws:
+            logger.debug(f"Using cached resolve response for '{request['sub']}'")
+            return {'response_args': _jws}
+
         # verified trust chains with policy adjusted metadata
         _chains, signed_entity_configuration = collect_trust_chains(_federation_entity,
                                                                     entity_id=request['sub'],
@@ -55,7 +136,9 @@ class Resolve(Endpoint):
                                        sub=request["sub"],
                                        key_jar=_federation_entity.get_attribute('keyjar'),
                                        metadata=metadata,
-                                       trust_chain=trust_chain)
+                                       trust_chain=trust_chain,
+                                       lifetime=self.lifetime)
+        self.cache_response(_key, _trust_anchor, _jws, _chain.exp)
         return {'response_args': _jws}
 
     def response_info(
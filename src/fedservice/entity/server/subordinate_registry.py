@@ -0,0 +1,341 @@
+import bisect
+import copy
+import logging
+import threading
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity_statement.parse import parse_statement
+from fedservice.entity_statement.parse import verify_with_jwks
+
+logger = logging.getLogger(__name__)
+
+# Max number of sets of criteria whose sorted matches are kept
+MAX_SORTED = 64
+
+
+def registered_entity_types(info: dict) -> List[str]:
+    # Registrations use either 'entity_types' or 'entity_type'
+    _types = info.get("entity_types", info.get("entity_type", []))
+    if isinstance(_types, str):
+        return [_types]
+    return list(_types)
+
+
+def get_trust_mark_id(trust_mark) -> str:
+    # Either an object with an 'id' or the signed trust mark itself
+    if isinstance(trust_mark, dict):
+        return trust_mark.get("id", "")
+    try:
+        return parse_statement(trust_mark).payload().get("id", "")
+    except Exception:
+        return ""
+
+
+class SubordinateRegistry(object):
+    """
+    The information about an entity's subordinates together with indexes over entity type,
+    whether a subordinate is an intermediate and which trust marks it has.
+
+    The registrations are kept in `store`, a dictionary or something that behaves like one,
+    and the indexes are updated as they are changed through the registry. Trust marks are
+    not part of the registrations, they are picked up from the subordinates' entity
+    configurations by :py:meth:`refresh`, normally run in the background by the
+    RefreshScheduler. Subordinates whose entity configurations have never been picked up
+    are listed by :py:meth:`missing`. A subordinate that can't be refreshed is not tried
+    again by :py:meth:`missing` until an exponentially growing backoff has passed.
+    """
+
+    def __init__(self, store: Optional[object] = None, upstream_get: Optional[Callable] = None,
+                 server_get: Optional[Callable] = None,
+                 retry_base: Optional[int] = 60,
+                 retry_max: Optional[int] = 3600):
+        """
+        :param store: Where the registrations are kept. Default is a dictionary.
+        :param upstream_get: Function to get information from the server this is part of
+        :param server_get: Same as upstream_get, used when instantiated by the server
+        :param retry_base: Seconds before a subordinate that could not be refreshed is
+            tried again, doubled for every consecutive failure
+        :param retry_max: Max seconds before a subordinate is tried again
+        """
+        self.store = {} if store is None else store
+        self.upstream_get = upstream_get or server_get
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        # Verified entity configurations and when they expire
+        self.configuration = {}
+        # Consecutive failed refreshes and when to try again, per subordinate
+        self._failures = {}
+        self._lock = threading.RLock()
+        self._entity_type = {}
+        self._intermediate = set()
+        self._trust_mark_id = {}
+        self._trust_marked = set()
+        self._indexed = {}
+        # All the entity IDs in sorted order, for paging
+        self._ids = []
+        # Sorted matches per set of criteria, for paging. Cleared when the indexes change.
+        self._sorted = {}
+        self.reindex()
+
+    # The dictionary interface
+
+    def __getitem__(self, entity_id: str) -> dict:
+        return self.store[entity_id]
+
+    def __setitem__(self, entity_id: str, info: dict):
+        with self._lock:
+            self.store[entity_id] = info
+            if entity_id not in self._indexed:
+                bisect.insort(self._ids, entity_id)
+            self._index(entity_id, info)
+
+    def __delitem__(self, entity_id: str):
+        with self._lock:
+            del self.store[entity_id]
+            self._unindex(entity_id)
+            self.configuration.pop(entity_id, None)
+            self._failures.pop(entity_id, None)
+            _pos = bisect.bisect_left(self._ids, entity_id)
+            if _pos < len(self._ids) and self._ids[_pos] == entity_id:
+                del self._ids[_pos]
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self.store
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def get(self, entity_id: str, default: Optional[dict] = None) -> Optional[dict]:
+        return self.store.get(entity_id, default)
+
+    def keys(self):
+        return self.store.keys()
+
+    def items(self):
+        return self.store.items()
+
+    def update(self, info: dict):
+        for entity_id, item in info.items():
+            self[entity_id] = item
+
+    def clear(self):
+        with self._lock:
+            self.store.clear()
+            self.configuration = {}
+            self._failures = {}
+            self.reindex()
+
+    # The indexes
+
+    def _unindex(self, entity_id: str):
+        self._sorted.clear()
+        _indexed = self._indexed.pop(entity_id, None)
+        if not _indexed:
+            return
+        _entity_types, _trust_mark_ids = _indexed
+        for entity_type in _entity_types:
+            _ids = self._entity_type.get(entity_type)
+            if _ids is not None:
+                _ids.discard(entity_id)
+                if not _ids:
+                    del self._entity_type[entity_type]
+        for trust_mark_id in _trust_mark_ids:
+            _ids = self._trust_mark_id.get(trust_mark_id)
+            if _ids is not None:
+                _ids.discard(entity_id)
+                if not _ids:
+                    del self._trust_mark_id[trust_mark_id]
+        self._intermediate.discard(entity_id)
+        self._trust_marked.discard(entity_id)
+
+    def _index(self, entity_id: str, info: dict):
+        self._unindex(entity_id)
+        _entity_types = set(registered_entity_types(info))
+        _intermediate = bool(info.get("intermediate"))
+        _trust_mark_ids = set()
+
+        _configuration = self.configuration.get(entity_id)
+        if _configuration:
+            _metadata = _configuration.get("metadata", {})
+            _entity_types.update(_metadata.keys())
+            if not _intermediate:
+                _intermediate = "federation_fetch_endpoint" in _metadata.get(
+                    "federation_entity", {})
+            for trust_mark in _configuration.get("trust_marks", []):
+                _id = get_trust_mark_id(trust_mark)
+                if _id:
+                    _trust_mark_ids.add(_id)
+            if _configuration.get("trust_marks"):
+                self._trust_marked.add(entity_id)
+
+        for entity_type in _entity_types:
+            self._entity_type.setdefault(entity_type, set()).add(entity_id)
+        for trust_mark_id in _trust_mark_ids:
+            self._trust_mark_id.setdefault(trust_mark_id, set()).add(entity_id)
+        if _intermediate:
+            self._intermediate.add(entity_id)
+        self._indexed[entity_id] = (_entity_types, _trust_mark_ids)
+
+    def reindex(self):
+        """
+        Rebuild the indexes from the store. Needed if the store has been changed other than
+        through the registry.
+        """
+        with self._lock:
+            self._entity_type = {}
+            self._intermediate = set()
+            self._trust_mark_id = {}
+            self._trust_marked = set()
+            self._indexed = {}
+            self._sorted = {}
+            for entity_id, info in self.store.items():
+                self._index(entity_id, info)
+            self._ids = sorted(self._indexed.keys())
+
+    def find(self,
+             entity_type: Optional[str] = "",
+             intermediate: Optional[bool] = None,
+             trust_marked: Optional[bool] = None,
+             trust_mark_id: Optional[str] = "",
+             **kwargs) -> Set[str]:
+        """
+        Find the subordinates that match all the given criteria. Only the indexes are used.
+
+        :param entity_type: Entity type
+        :param intermediate: Whether the subordinates should be intermediates
+        :param trust_marked: Whether the subordinates should have trust marks
+        :param trust_mark_id: The ID of a trust mark the subordinates should have
+        :return: Set of entity IDs
+        """
+        with self._lock:
+            _sets = []
+            if entity_type:
+                _sets.append(self._entity_type.get(entity_type, set()))
+            if intermediate:
+                _sets.append(self._intermediate)
+            if trust_marked:
+                _sets.append(self._trust_marked)
+            if trust_mark_id:
+                _sets.append(self._trust_mark_id.get(trust_mark_id, set()))
+
+            if not _sets:
+                return set(self.store.keys())
+
+            _sets.sort(key=len)
+            _match = set(_sets[0])
+            for _set in _sets[1:]:
+                _match.intersection_update(_set)
+                if not _match:
+                    break
+            return _match
+
+    def page(self, after: Optional[str] = "", limit: Optional[int] = 0, **kwargs) -> List[str]:
+        """
+        A page of subordinates in entity ID order. Takes the same criteria as
+        :py:meth:`find`.
+
+        :param after: Only subordinates with entity IDs after this one
+        :param limit: Max number of entity IDs. 0 means no limit.
+        :return: List of entity IDs
+        """
+        with self._lock:
+            if any(kwargs.values()):
+                _key = tuple(sorted((k, v) for k, v in kwargs.items() if v))
+                _ids = self._sorted.get(_key)
+                if _ids is None:
+                    if len(self._sorted) >= MAX_SORTED:
+                        self._sorted.clear()
+                    _ids = self._sorted[_key] = sorted(self.find(**kwargs))
+            else:
+                _ids = self._ids
+            _start = bisect.bisect_right(_ids, after) if after else 0
+            if limit:
+                return _ids[_start:_start + limit]
+            return _ids[_start:]
+
+    # Refreshing from the subordinates' entity configurations
+
+    def _collector(self):
+        _federation_entity = self.upstream_get("unit").upstream_get("unit")
+        return _federation_entity.function.trust_chain_collector
+
+    def get_exp(self, entity_id: str) -> int:
+        """
+        :return: When the entity configuration of a subordinate that was last picked up
+            expires. 0 if there is none.
+        """
+        _configuration = self.configuration.get(entity_id)
+        if _configuration:
+            return _configuration.get("exp", 0)
+        return 0
+
+    def missing(self, now: Optional[int] = 0) -> List[str]:
+        """
+        :param now: The time to compare with, default is now
+        :return: The subordinates whose entity configurations have never been picked up,
+            except those that recently could not be
+        """
+        now = now or utc_time_sans_frac()
+        with self._lock:
+            return [entity_id for entity_id in self._ids if entity_id not in self.configuration
+                    and self._failures.get(entity_id, (0, 0))[1] <= now]
+
+    def _record_failure(self, entity_id: str):
+        with self._lock:
+            _count = self._failures.get(entity_id, (0, 0))[0] + 1
+            _retry_in = min(self.retry_base * 2 ** (_count - 1), self.retry_max)
+            self._failures[entity_id] = (_count, utc_time_sans_frac() + _retry_in)
+
+    def refresh(self, entity_id: str) -> int:
+        """
+        Get the subordinate's entity configuration, verify it with the keys it was
+        registered with and update the indexes.
+
+        :param entity_id: The subordinate's entity ID
+        :return: When the entity configuration expires
+        """
+        _info = self.store.get(entity_id)
+        if not _info:
+            return 0
+
+        try:
+            _entity_configuration = self._collector().get_entity_configuration(entity_id)
+            _claims = copy.deepcopy(verify_with_jwks(_entity_configuration, _info["jwks"]))
+            if _claims.get("iss") != entity_id or _claims.get("sub") != entity_id:
+                raise ValueError(f"Not an entity configuration for '{entity_id}'")
+        except Exception:
+            self._record_failure(entity_id)
+            raise
+
+        with self._lock:
+            self._failures.pop(entity_id, None)
+            if entity_id in self.store:
+                self.configuration[entity_id] = _claims
+                self._index(entity_id, self.store[entity_id])
+        return _claims.get("exp", 0)
+
+    def refresh_all(self, entity_ids: Optional[Iterable[str]] = None) -> int:
+        """
+        Refresh subordinates one by one.
+
+        :param entity_ids: The subordinates. Default is all of them.
+        :return: The number of subordinates that were refreshed
+        """
+        _count = 0
+        for entity_id in list(self.store.keys() if entity_ids is None else entity_ids):
+            try:
+                self.refresh(entity_id)
+            except Exception as err:
+                logger.warning(f"Could not refresh subordinate '{entity_id}': {err}")
+                continue
+            _count += 1
+        return _count
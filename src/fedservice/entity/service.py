@@ -8,6 +8,7 @@ from fedservice.entity.utils import get_federation_entity
 
 
 class FederationService(Service):
+
     def gather_verify_arguments(
             self,
             response: Optional[Union[dict, Message]] = None,
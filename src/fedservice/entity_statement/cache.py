@@ -1,4 +1,8 @@
+import heapq
 import logging
+import sys
+import threading
+from collections import OrderedDict
 from typing import Any
 from typing import Optional
 
@@ -8,48 +12,287 @@ from idpyoidc.impexp import ImpExp
 logger = logging.getLogger(__name__)
 
 
+def approximate_size(value) -> int:
+    """
+    A cheap estimate of the number of bytes a cached value occupies when serialized.
+    """
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    elif isinstance(value, dict):
+        return sum(len(str(k)) + approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return sum(approximate_size(v) for v in value)
+    else:
+        return sys.getsizeof(value)
+
+
+class CacheEntry(object):
+    __slots__ = ["value", "exp", "size"]
+
+    def __init__(self, value, exp: Optional[int] = 0):
+        self.value = value
+        self.exp = exp
+        self.size = approximate_size(value)
+
+
 class ESCache(ImpExp):
+    """
+    A cache with LRU eviction and proactive removal of expired entries.
+
+    Each entry carries its expiration time. If none is given and the value is a dictionary
+    with an 'exp' claim that is used. Entries without an expiration time never expire but
+    can be evicted.
+
+    If a storage backend is given, the in-process cache works as a first level cache in
+    front of it. Entries are written through to the backend and looked up there when
+    missing locally.
+    """
     parameter = {
         "_db": {},
-        "allowed_delta": 0
+        "_exp": {},
+        "allowed_delta": 0,
+        "max_entries": 0,
+        "max_size": 0
     }
 
-    def __init__(self, allowed_delta=300):
+    def __init__(self, allowed_delta=300, max_entries: Optional[int] = 0,
+                 max_size: Optional[int] = 0, storage: Optional[object] = None):
+        """
+        :param allowed_delta: Entries are regarded as expired this many seconds before their
+            expiration time.
+        :param max_entries: Max number of entries. 0 means no limit.
+        :param max_size: Approximate max number of bytes used by the values. 0 means no limit.
+        :param storage: Shared storage backend, for instance a
+            :py:class:`fedservice.entity_statement.storage.SQLiteStore`
+        """
         ImpExp.__init__(self)
-        self._db = {}
+        self.storage = storage
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        # (expiration time, key) tuples. Entries that are removed or replaced are left in
+        # the heap and skipped when they reach the top.
+        self._expiry = []
+        self.size = 0
         self.allowed_delta = allowed_delta
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
-    def __setitem__(self, key, value):
-        self._db[key] = value
+    @property
+    def _db(self) -> dict:
+        with self._lock:
+            return {k: e.value for k, e in self._entries.items()}
 
-    def __getitem__(self, item):
+    @_db.setter
+    def _db(self, value: dict):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._expiry = []
+            self.size = 0
+            for k, v in value.items():
+                self._add(k, v, None)
+
+    @property
+    def _exp(self) -> dict:
+        with self._lock:
+            return {k: e.exp for k, e in self._entries.items() if e.exp}
+
+    @_exp.setter
+    def _exp(self, value: dict):
+        with self._lock:
+            for k, exp in value.items():
+                _entry = self._entries.get(k)
+                if _entry and _entry.exp != exp:
+                    _entry.exp = exp
+                    if exp:
+                        heapq.heappush(self._expiry, (exp, k))
+
+    def local_load_adjustments(self, **kwargs):
+        self.purge()
+        self._evict()
+
+    def _add(self, key, value, exp):
+        if exp is None and isinstance(value, dict):
+            exp = value.get("exp", 0)
+
+        _old = self._entries.pop(key, None)
+        if _old:
+            self.size -= _old.size
+
+        _entry = CacheEntry(value, exp or 0)
+        self._entries[key] = _entry
+        self.size += _entry.size
+        if _entry.exp:
+            heapq.heappush(self._expiry, (_entry.exp, key))
+
+    def _remove(self, key) -> CacheEntry:
+        _entry = self._entries.pop(key)
+        self.size -= _entry.size
+        return _entry
+
+    def _expired(self, entry: CacheEntry, now: int) -> bool:
+        return entry.exp and now >= (entry.exp - self.allowed_delta)
+
+    def _evict(self):
+        # Never evict the most recently used entry
+        while len(self._entries) > 1 and (
+                (self.max_entries and len(self._entries) > self.max_entries) or
+                (self.max_size and self.size > self.max_size)):
+            _key, _entry = self._entries.popitem(last=False)
+            self.size -= _entry.size
+            self.evictions += 1
+
+    def _compact(self):
+        # Drop heap items that refer to entries that no longer exist or has been replaced.
+        self._expiry = [(exp, key) for exp, key in self._expiry
+                        if key in self._entries and self._entries[key].exp == exp]
+        heapq.heapify(self._expiry)
+
+    def set(self, key, value, exp: Optional[int] = None):
+        """
+        Add or replace an entry.
+
+        :param key: Key
+        :param value: The value to cache
+        :param exp: Expiration time of the entry. If not given the value's 'exp' claim is
+            used if it has one.
+        """
+        with self._lock:
+            self.purge(local_only=True)
+            self._add(key, value, exp)
+            _exp = self._entries[key].exp
+            self._evict()
+            if len(self._expiry) > 2 * len(self._entries) + 64:
+                self._compact()
+
+        if self.storage is not None:
+            try:
+                self.storage.set(key, value, _exp)
+            except Exception as err:
+                logger.error(f"Could not store '{key}': {err}")
+
+    def _from_storage(self, key):
+        if self.storage is None:
+            return None
         try:
-            statement = self._db[item]
-        except KeyError:
+            _stored = self.storage.get(key)
+        except Exception as err:
+            logger.error(f"Could not read '{key}' from storage: {err}")
+            return None
+        if _stored is None:
             return None
-        else:
-            if isinstance(statement, dict):
-                # verify that the statement is recent enough
-                _now = utc_time_sans_frac()
-                if _now < (statement["exp"] - self.allowed_delta):
-                    return statement
-                else:
-                    del self._db[item]
+        _value, _exp = _stored
+        with self._lock:
+            if _exp and utc_time_sans_frac() >= (_exp - self.allowed_delta):
+                return None
+            self._add(key, _value, _exp)
+            self._evict()
+            return self._entries.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, item):
+        with self._lock:
+            _entry = self._entries.get(item)
+            if _entry is not None and self._expired(_entry, utc_time_sans_frac()):
+                self._remove(item)
+                self.expirations += 1
+                _entry = None
+            if _entry is None:
+                # Another process may have fetched it
+                _entry = self._from_storage(item)
+                if _entry is None:
+                    self.misses += 1
                     return None
-            else:
-                return statement
+            self._entries.move_to_end(item)
+            self.hits += 1
+            return _entry.value
+
+    def get(self, key, default: Optional[Any] = None):
+        _value = self[key]
+        if _value is None:
+            return default
+        return _value
+
+    def get_exp(self, key) -> int:
+        """
+        :return: The expiration time of an entry. 0 if it doesn't expire or doesn't exist.
+        """
+        with self._lock:
+            _entry = self._entries.get(key)
+            if _entry is None:
+                return 0
+            return _entry.exp
+
+    def purge(self, now: Optional[int] = None, local_only: Optional[bool] = False) -> int:
+        """
+        Remove all expired entries.
+
+        :param now: The time to compare with. Default is the current time.
+        :param local_only: Only purge the in-process cache, not the storage backend.
+        :return: The number of entries removed from the in-process cache.
+        """
+        if now is None:
+            now = utc_time_sans_frac()
+        _limit = now + self.allowed_delta
+        n = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= _limit:
+                exp, key = heapq.heappop(self._expiry)
+                _entry = self._entries.get(key)
+                if _entry is not None and _entry.exp == exp:
+                    self._remove(key)
+                    self.expirations += 1
+                    n += 1
+
+        if self.storage is not None and not local_only:
+            try:
+                self.storage.purge(_limit)
+            except Exception as err:
+                logger.error(f"Could not purge storage: {err}")
+        return n
 
     def __delitem__(self, key):
-        del self._db[key]
+        with self._lock:
+            if self.storage is None:
+                self._remove(key)
+            else:
+                if key in self._entries:
+                    self._remove(key)
+                self.storage.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry = []
+            self.size = 0
+        if self.storage is not None:
+            self.storage.clear()
 
     def keys(self):
-        return self._db.keys()
+        with self._lock:
+            return list(self._entries.keys())
 
     def __len__(self):
-        return len(self._db)
+        return len(self._entries)
 
     def __contains__(self, item):
-        return item in self._db
+        with self._lock:
+            _entry = self._entries.get(item)
+            if _entry is not None and not self._expired(_entry, utc_time_sans_frac()):
+                return True
+        return self._from_storage(item) is not None
 
-    def get(self, key, default: Optional[Any] = None):
-        return self._db.get(key, default)
+    def statistics(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
@@ -139,6 +139,10 @@ def meets_restrictions(trust_chain: List[EntityStatement]) -> bool:
         try:
             _constraints = statement['constraints']
         except KeyError:
+            if max_assigned:
+                current_max_path_length -= 1
+                if current_max_path_length < 0:
+                    return False
             continue
 
         current_max_path_length = calculate_path_length(_constraints, current_max_path_length,
@@ -146,6 +150,8 @@ def meets_restrictions(trust_chain: List[EntityStatement]) -> bool:
 
         if current_max_path_length < 0:
             return False
+        if 'max_path_length' in _constraints:
+            max_assigned = True
 
         naming_constraints = update_naming_constraints(_constraints, naming_constraints)
 
@@ -172,3 +178,32 @@ def meets_restrictions(trust_chain: List[EntityStatement]) -> bool:
             return False
 
     return True
+
+
+def constraint_violation(constraints: Union[dict, Message], path_length: int,
+                         subjects: List[str]) -> str:
+    """
+    Check the constraints in a subordinate statement against the part of a trust chain that
+    is below the issuer of the statement. Can be used before the rest of the chain is known.
+
+    :param constraints: The constraints in the subordinate statement
+    :param path_length: The number of intermediates between the issuer and the leaf
+    :param subjects: The IDs of the entities below the issuer, the leaf included
+    :return: A description of the violation, an empty string if there is none
+    """
+    if not constraints:
+        return ""
+
+    _max_len = constraints.get('max_path_length')
+    if _max_len is not None and path_length > _max_len:
+        return f"path length {path_length} > max_path_length {_max_len}"
+
+    _naming = constraints.get('naming_constraints') or {}
+    _excluded = _naming.get('excluded')
+    _permitted = _naming.get('permitted')
+    for subject_id in subjects:
+        if _excluded and excluded(subject_id, _excluded):
+            return f"'{subject_id}' is excluded"
+        if _permitted and not permitted(subject_id, _permitted):
+            return f"'{subject_id}' is not permitted"
+    return ""
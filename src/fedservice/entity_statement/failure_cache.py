@@ -0,0 +1,223 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlparse
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.exception import CircuitOpen
+from fedservice.exception import FailedConfigurationRetrieval
+
+logger = logging.getLogger(__name__)
+
+# Seconds a failure is remembered, per exception class name
+DEFAULT_FAILURE_TTL = {
+    "MissingPage": 300,
+    "FailedConfigurationRetrieval": 60,
+    "ConnectionError": 30,
+    "SSLError": 300,
+    "default": 30
+}
+
+# Failures that say something about the health of the host, not just about a URL
+HOST_FAILURES = ["FailedConfigurationRetrieval", "ConnectionError", "SSLError", "Timeout",
+                 "ReadTimeout", "ConnectTimeout"]
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class FailedFetch(object):
+
+    def __init__(self, error: BaseException, until: int):
+        self.error_class = error.__class__
+        self.message = str(error)
+        self.until = until
+
+
+class HostHealth(object):
+
+    def __init__(self):
+        self.failures = 0
+        self.last_failure = 0
+        self.state = CLOSED
+        self.opened = 0
+        self.probing = False
+
+
+class FailureCache(object):
+    """
+    Remembers failed fetches so that they are not repeated for a while, backs off
+    exponentially from hosts that fail and stops contacting a host altogether (opens the
+    circuit) after a number of consecutive failures. After a while one request is let
+    through to probe the host. If it succeeds the circuit is closed again.
+    """
+
+    def __init__(self,
+                 ttl: Optional[dict] = None,
+                 backoff_base: Optional[int] = 1,
+                 backoff_max: Optional[int] = 300,
+                 failure_threshold: Optional[int] = 5,
+                 reset_timeout: Optional[int] = 60,
+                 max_entries: Optional[int] = 10000):
+        """
+        :param ttl: Seconds a failure is remembered per exception class name. The 'default'
+            value is used for other classes. 0 means not remembered.
+        :param backoff_base: Backoff after the first failure, doubled for every consecutive
+            failure.
+        :param backoff_max: Max backoff in seconds
+        :param failure_threshold: Consecutive failures after which the circuit is opened.
+            0 means never.
+        :param reset_timeout: Seconds the circuit stays open before a probe is allowed
+        :param max_entries: Max number of failed URLs remembered
+        """
+        self.ttl = DEFAULT_FAILURE_TTL.copy()
+        if ttl:
+            self.ttl.update(ttl)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._failed = OrderedDict()
+        self._hosts = {}
+
+    def _ttl(self, error: BaseException) -> int:
+        for cls in error.__class__.__mro__:
+            if cls.__name__ in self.ttl:
+                return self.ttl[cls.__name__]
+        return self.ttl["default"]
+
+    @staticmethod
+    def _is_host_failure(error: BaseException) -> bool:
+        return any(cls.__name__ in HOST_FAILURES for cls in error.__class__.__mro__)
+
+    def backoff(self, failures: int) -> int:
+        if failures <= 0:
+            return 0
+        return min(self.backoff_base * 2 ** (failures - 1), self.backoff_max)
+
+    def check(self, url: str):
+        """
+        Raise an exception if the URL should not be fetched right now.
+
+        :param url: The URL that is about to be fetched
+        """
+        _now = utc_time_sans_frac()
+        _host = urlparse(url).netloc
+        with self._lock:
+            _failed = self._failed.get(url)
+            if _failed:
+                if _now < _failed.until:
+                    logger.debug(f"Remembered failure for '{url}'")
+                    try:
+                        _error = _failed.error_class(f"Remembered failure: {_failed.message}")
+                    except TypeError:
+                        _error = FailedConfigurationRetrieval(
+                            f"Remembered failure: {_failed.message}")
+                    raise _error
+                del self._failed[url]
+
+            _health = self._hosts.get(_host)
+            if _health is None or _health.failures == 0:
+                return
+
+            if _health.state == OPEN:
+                if _now < _health.opened + self.reset_timeout:
+                    raise CircuitOpen(f"Circuit open for '{_host}'")
+                _health.state = HALF_OPEN
+
+            if _health.state == HALF_OPEN:
+                if _health.probing:
+                    raise CircuitOpen(f"Waiting for probe of '{_host}'")
+                _health.probing = True
+                return
+
+            _retry_at = _health.last_failure + self.backoff(_health.failures)
+            if _now < _retry_at:
+                raise CircuitOpen(f"Backing off from '{_host}' until {_retry_at}")
+
+    def record_failure(self, url: str, error: BaseException):
+        _now = utc_time_sans_frac()
+        _ttl = self._ttl(error)
+        with self._lock:
+            if _ttl:
+                self._failed[url] = FailedFetch(error, _now + _ttl)
+                self._failed.move_to_end(url)
+                while self.max_entries and len(self._failed) > self.max_entries:
+                    self._failed.popitem(last=False)
+
+            _host = urlparse(url).netloc
+            if not self._is_host_failure(error):
+                # The host did answer
+                self._hosts.pop(_host, None)
+                return
+
+            _health = self._hosts.setdefault(_host, HostHealth())
+            _health.failures += 1
+            _health.last_failure = _now
+            _health.probing = False
+            if _health.state == HALF_OPEN or (
+                    self.failure_threshold and _health.failures >= self.failure_threshold):
+                if _health.state != OPEN:
+                    logger.warning(f"Opening circuit for '{_host}'")
+                _health.state = OPEN
+                _health.opened = _now
+
+    def record_success(self, url: str):
+        _host = urlparse(url).netloc
+        with self._lock:
+            self._failed.pop(url, None)
+            _health = self._hosts.pop(_host, None)
+            if _health and _health.state != CLOSED:
+                logger.info(f"Closing circuit for '{_host}'")
+
+    def release(self, url: str):
+        """
+        Give up a fetch without an answer, as when it is cancelled. If it was the probe of
+        a host another request may probe it.
+        """
+        _host = urlparse(url).netloc
+        with self._lock:
+            _health = self._hosts.get(_host)
+            if _health:
+                _health.probing = False
+
+    def forget(self, url: Optional[str] = "", host: Optional[str] = ""):
+        """
+        Forget remembered failures for a URL and/or a host.
+        """
+        with self._lock:
+            if url:
+                self._failed.pop(url, None)
+            if host:
+                self._hosts.pop(host, None)
+
+    def clear(self):
+        with self._lock:
+            self._failed.clear()
+            self._hosts.clear()
+
+    def status(self) -> dict:
+        """
+        :return: Remembered failures per URL and the health of the hosts that have failed.
+        """
+        _now = utc_time_sans_frac()
+        with self._lock:
+            _urls = {
+                url: {"error": f.error_class.__name__, "message": f.message, "until": f.until}
+                for url, f in self._failed.items() if f.until > _now
+            }
+            _hosts = {}
+            for host, h in self._hosts.items():
+                if h.state == OPEN:
+                    _retry_at = h.opened + self.reset_timeout
+                elif h.state == HALF_OPEN:
+                    _retry_at = _now
+                else:
+                    _retry_at = h.last_failure + self.backoff(h.failures)
+                _hosts[host] = {"state": h.state, "failures": h.failures, "retry_at": _retry_at}
+        return {"urls": _urls, "hosts": _hosts}
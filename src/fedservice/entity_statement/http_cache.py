@@ -0,0 +1,179 @@
+import logging
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cache_control(value: str) -> dict:
+    """
+    Parse a Cache-Control header value into a dictionary. Directives without a value
+    are given the value True.
+    """
+    res = {}
+    if not value:
+        return res
+
+    for directive in value.split(","):
+        directive = directive.strip()
+        if not directive:
+            continue
+        if "=" in directive:
+            name, val = directive.split("=", 1)
+            val = val.strip().strip('"')
+            try:
+                res[name.strip().lower()] = int(val)
+            except ValueError:
+                res[name.strip().lower()] = val
+        else:
+            res[directive.lower()] = True
+    return res
+
+
+def _http_date(value: str) -> Optional[int]:
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class CachedResponse(object):
+
+    def __init__(self, body: str, exp: Optional[int] = 0):
+        self.body = body
+        # The expiration time of the statement in the body
+        self.exp = exp
+        self.etag = ""
+        self.last_modified = ""
+        # Upper bound on reuse set by Cache-Control max-age or Expires. 0 means no bound.
+        self.reuse_until = 0
+
+    def update(self, headers):
+        """
+        Update validators and freshness from the headers of a 200 or 304 response.
+        Per RFC 9111 a 304 response carries the validators and freshness information
+        that should replace the stored ones.
+        """
+        _etag = headers.get("ETag")
+        if _etag:
+            self.etag = _etag
+        _last_modified = headers.get("Last-Modified")
+        if _last_modified:
+            self.last_modified = _last_modified
+
+        _now = utc_time_sans_frac()
+        _cache_control = parse_cache_control(headers.get("Cache-Control", ""))
+        if "no-cache" in _cache_control:
+            # May be stored but must be revalidated before each reuse
+            self.reuse_until = _now
+        elif isinstance(_cache_control.get("max-age"), int):
+            try:
+                _age = int(headers.get("Age", 0))
+            except ValueError:
+                _age = 0
+            self.reuse_until = _now + max(_cache_control["max-age"] - _age, 0)
+        elif headers.get("Expires"):
+            _expires = _http_date(headers["Expires"])
+            _date = _http_date(headers.get("Date", "")) or _now
+            if _expires is None:  # An invalid date means already expired
+                self.reuse_until = _now
+            else:
+                self.reuse_until = _now + max(_expires - _date, 0)
+
+    def conditional_headers(self) -> dict:
+        _headers = {}
+        if self.etag:
+            _headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            _headers["If-Modified-Since"] = self.last_modified
+        return _headers
+
+
+class ConditionalCache(object):
+    """
+    Keeps the HTTP validators (ETag/Last-Modified) and freshness information next to the
+    signed statements fetched from a URL. Used to send conditional requests when a
+    statement is refreshed and to bound how long a statement may be reused.
+    """
+
+    def __init__(self, max_entries: Optional[int] = 10000):
+        self.max_entries = max_entries
+        self._db = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, url):
+        return url in self._db
+
+    def __len__(self):
+        return len(self._db)
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        with self._lock:
+            _entry = self._db.get(url)
+            if _entry:
+                self._db.move_to_end(url)
+            return _entry
+
+    def conditional_headers(self, url: str) -> dict:
+        """
+        :return: Headers to add to a request for the URL. Validators are only used as long as
+            the cached statement has not expired.
+        """
+        _entry = self.get(url)
+        if _entry is None:
+            return {}
+        if _entry.exp and _entry.exp <= utc_time_sans_frac():
+            return {}
+        return _entry.conditional_headers()
+
+    def store(self, url: str, body: str, headers, exp: Optional[int] = 0):
+        _cache_control = parse_cache_control(headers.get("Cache-Control", ""))
+        if "no-store" in _cache_control:
+            self.remove(url)
+            return None
+
+        _entry = CachedResponse(body, exp)
+        _entry.update(headers)
+        with self._lock:
+            self._db[url] = _entry
+            self._db.move_to_end(url)
+            while self.max_entries and len(self._db) > self.max_entries:
+                self._db.popitem(last=False)
+        return _entry
+
+    def not_modified(self, url: str, headers) -> Optional[str]:
+        """
+        Deal with a 304 Not Modified response.
+
+        :return: The cached body or None if nothing is cached for the URL.
+        """
+        _entry = self.get(url)
+        if _entry is None:
+            return None
+        _entry.update(headers)
+        return _entry.body
+
+    def reuse_until(self, url: str, body: Optional[str] = "") -> int:
+        """
+        :param url: The URL the statement was fetched from
+        :param body: If given, only return a bound if the cached body is the same
+        :return: Upper bound on reuse of the statement. 0 means no bound.
+        """
+        _entry = self.get(url)
+        if _entry is None:
+            return 0
+        if body and _entry.body != body:
+            return 0
+        return _entry.reuse_until
+
+    def remove(self, url: str):
+        with self._lock:
+            self._db.pop(url, None)
+
+    def clear(self):
+        with self._lock:
+            self._db.clear()
@@ -0,0 +1,172 @@
+import copy
+import json
+import logging
+from functools import lru_cache
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from cryptojwt import as_unicode
+from cryptojwt import KeyBundle
+from cryptojwt.exception import BadSignature
+from cryptojwt.exception import MissingKey
+from cryptojwt.exception import VerificationError
+from cryptojwt.jwk.asym import AsymmetricKey
+from cryptojwt.jws.exception import SignerAlgError
+from cryptojwt.jws.jws import SIGNER_ALGS
+from cryptojwt.jws.jws import factory
+from cryptojwt.jws.utils import alg2keytype
+from cryptojwt.jwt import utc_time_sans_frac
+
+logger = logging.getLogger(__name__)
+
+# Allowed clock skew in seconds when checking exp and nbf, same as cryptojwt's JWT
+ALLOWED_DELTA = 15
+
+
+class ParsedStatement(object):
+    """
+    A signed statement that has been split and decoded once. Has the `headers` attribute
+    and the `payload()` method of a parsed JWT so it can be used with
+    `KeyJar.get_jwt_verify_keys`.
+
+    Instances are shared. The header and payload must not be modified, use `claims()` to
+    get a copy that can be.
+    """
+
+    __slots__ = ["jws", "headers", "_payload", "signing_input", "signature"]
+
+    def __init__(self, jws: str):
+        _jws = factory(jws)
+        if not _jws:
+            raise ValueError(f"Not a proper signed JWT: {jws}")
+        self.jws = jws
+        self.headers = _jws.jwt.headers
+        self._payload = _jws.jwt.payload()
+        self.signing_input = _jws.jwt.sign_input()
+        self.signature = _jws.jwt.signature()
+
+    def payload(self) -> dict:
+        return self._payload
+
+    def claims(self) -> dict:
+        """
+        :return: A copy of the payload, nested claims included
+        """
+        return copy.deepcopy(self._payload)
+
+    def check_time(self, allowed_delta: Optional[int] = ALLOWED_DELTA,
+                   timestamp: Optional[int] = 0):
+        """
+        Check that the statement has not expired and is already valid.
+
+        :param allowed_delta: Allowed clock skew in seconds
+        :param timestamp: The time to check against, default is now
+        """
+        timestamp = timestamp or utc_time_sans_frac()
+        if "nbf" in self._payload:
+            if timestamp < int(self._payload["nbf"]) - allowed_delta:
+                raise VerificationError("Token not yet valid")
+        if "exp" in self._payload:
+            if timestamp >= int(self._payload["exp"]) + allowed_delta:
+                raise VerificationError("Token expired")
+
+    def verify(self, keys: List, allowed_delta: Optional[int] = ALLOWED_DELTA) -> dict:
+        """
+        Verify the signature and that the statement is valid now.
+
+        :param keys: Keys that may have been used to sign the statement
+        :param allowed_delta: Allowed clock skew in seconds when checking exp and nbf
+        :return: The payload
+        """
+        _alg = self.headers.get("alg")
+        if not _alg or _alg.lower() == "none":
+            raise SignerAlgError("none not allowed")
+        try:
+            _verifier = SIGNER_ALGS[_alg]
+        except KeyError:
+            raise SignerAlgError(f"Unknown signing algorithm: {_alg}")
+
+        for key in keys:
+            _key = key.public_key() if isinstance(key, AsymmetricKey) else key.key
+            try:
+                if _verifier.verify(self.signing_input, self.signature, _key):
+                    self.check_time(allowed_delta)
+                    return self._payload
+            except (BadSignature, IndexError):
+                pass
+            except (ValueError, TypeError) as err:
+                logger.warning(f'Exception "{err}" caught')
+
+        raise BadSignature("Could not verify signature")
+
+
+@lru_cache(maxsize=4096)
+def _parse_statement(jws: str) -> ParsedStatement:
+    return ParsedStatement(jws)
+
+
+def parse_statement(jws) -> ParsedStatement:
+    """
+    Parse a signed statement. The result is cached so parsing the same statement again is
+    cheap.
+
+    :param jws: A signed JWT
+    :return: A ParsedStatement instance
+    """
+    return _parse_statement(as_unicode(jws))
+
+
+@lru_cache(maxsize=1024)
+def _keys_from_jwks(canonical_jwks: str) -> Tuple:
+    _kb = KeyBundle(keys=json.loads(canonical_jwks)["keys"])
+    return tuple(k for k in _kb.keys() if k.use in ["", "sig"])
+
+
+def jwks_keys(jwks: dict) -> Tuple:
+    """
+    Verification keys from a JWKS. Key objects are cached per JWKS so the keys in a JWKS
+    are only parsed once.
+
+    :param jwks: A JWKS as a dictionary
+    :return: Key instances
+    """
+    return _keys_from_jwks(json.dumps(jwks, sort_keys=True))
+
+
+def verify_with_jwks(statement, jwks: dict, allowed_delta: Optional[int] = ALLOWED_DELTA) -> dict:
+    """
+    Verify the signature of a statement using the keys in a JWKS.
+    Will raise an exception if signature verification fails or the statement has expired.
+
+    :param statement: A signed JWT or a ParsedStatement instance
+    :param jwks: A JWKS as a dictionary
+    :param allowed_delta: Allowed clock skew in seconds when checking exp and nbf
+    :return: The payload. Must not be modified.
+    """
+    if not isinstance(statement, ParsedStatement):
+        statement = parse_statement(statement)
+
+    _keys = jwks_keys(jwks)
+    _kty = alg2keytype(statement.headers.get("alg", ""))
+    _kid = statement.headers.get("kid")
+    _keys = [k for k in _keys if k.kty == _kty and (not _kid or k.kid == _kid)]
+    if not _keys:
+        raise MissingKey(f"No keys matching: {statement.headers}")
+    return statement.verify(_keys, allowed_delta)
+
+
+def verify_self_signed(statement, allowed_delta: Optional[int] = ALLOWED_DELTA) -> dict:
+    """
+    Verify the signature of a statement using only the keys in the statement's own 'jwks'
+    claim. Will raise an exception if signature verification fails or the statement has
+    expired.
+
+    :param statement: A signed JWT or a ParsedStatement instance
+    :param allowed_delta: Allowed clock skew in seconds when checking exp and nbf
+    :return: The payload. Must not be modified.
+    """
+    if not isinstance(statement, ParsedStatement):
+        statement = parse_statement(statement)
+
+    return verify_with_jwks(statement, statement.payload()["jwks"], allowed_delta)
@@ -1,4 +1,5 @@
 import logging
+from typing import List
 from typing import Optional
 
 from cryptojwt.jwt import utc_time_sans_frac
@@ -53,7 +54,8 @@ class TrustChain(ImpExp):
         self.metadata = metadata or {}
         self.exp = exp
         self.verified_chain = verified_chain
-        self.combined_policy = {}
+        self.chain = chain or []
+        self.combined_policy = combined_policy or {}
 
     def keys(self):
         return self.metadata.keys()
@@ -81,6 +83,22 @@ class TrustChain(ImpExp):
         else:
             return False
 
+    def limiting_link(self) -> int:
+        """
+        :return: The index in the verified chain of the statement that expires first and so
+            determines when the trust chain expires.
+        """
+        _exp = [statement["exp"] for statement in self.verified_chain]
+        return _exp.index(min(_exp))
+
+    def expiring_links(self, when: int) -> List[int]:
+        """
+        :param when: A time
+        :return: The indexes in the verified chain of the statements that have expired at
+            that time. Trust anchor first.
+        """
+        return [i for i, statement in enumerate(self.verified_chain) if statement["exp"] <= when]
+
     def export_chain(self):
         """
         Exports the verified chain in such a way that it can be used as value on the
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStore(object):
+    """
+    Statement storage in a SQLite database in WAL mode. Can be shared by all the processes
+    on a host, for instance the workers of a gunicorn server, so that a statement fetched by
+    one of them can be used by all.
+
+    Values must be JSON serializable. Message instances are stored as dictionaries.
+    """
+
+    def __init__(self, path: str, namespace: Optional[str] = "", timeout: Optional[float] = 5.0):
+        """
+        :param path: Path to the database file
+        :param namespace: Allows several caches to use the same database file
+        :param timeout: How long to wait for a lock held by another process
+        """
+        self.path = path
+        self.namespace = namespace
+        self.timeout = timeout
+        self._local = threading.local()
+        _dir = os.path.dirname(path)
+        if _dir and not os.path.isdir(_dir):
+            os.makedirs(_dir)
+        _con = self._connection()
+        _con.execute("CREATE TABLE IF NOT EXISTS statement ("
+                     "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                     "exp INTEGER NOT NULL, PRIMARY KEY (namespace, key))")
+        _con.execute("CREATE INDEX IF NOT EXISTS statement_exp ON statement (exp)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections are neither shared between threads nor inherited over a fork.
+        _con = getattr(self._local, "connection", None)
+        if _con is None or self._local.pid != os.getpid():
+            _con = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            _con.execute("PRAGMA journal_mode=WAL")
+            _con.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = _con
+            self._local.pid = os.getpid()
+        return _con
+
+    def get(self, key: str) -> Optional[Tuple[object, int]]:
+        """
+        :return: A (value, expiration time) tuple or None if there is no such entry.
+        """
+        _row = self._connection().execute(
+            "SELECT value, exp FROM statement WHERE namespace = ? AND key = ?",
+            (self.namespace, key)).fetchone()
+        if _row is None:
+            return None
+        return json.loads(_row[0]), _row[1]
+
+    def set(self, key: str, value, exp: Optional[int] = 0):
+        if hasattr(value, "to_dict"):
+            value = value.to_dict()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO statement (namespace, key, value, exp) VALUES (?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value), exp or 0))
+
+    def delete(self, key: str):
+        self._connection().execute("DELETE FROM statement WHERE namespace = ? AND key = ?",
+                                   (self.namespace, key))
+
+    def purge(self, limit: int) -> int:
+        """
+        Remove entries that expire at or before limit.
+
+        :return: Number of removed entries
+        """
+        _cur = self._connection().execute(
+            "DELETE FROM statement WHERE namespace = ? AND exp != 0 AND exp <= ?",
+            (self.namespace, limit))
+        return _cur.rowcount
+
+    def keys(self) -> List[str]:
+        return [r[0] for r in self._connection().execute(
+            "SELECT key FROM statement WHERE namespace = ?", (self.namespace,))]
+
+    def clear(self):
+        self._connection().execute("DELETE FROM statement WHERE namespace = ?", (self.namespace,))
+
+    def __len__(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM statement WHERE namespace = ?", (self.namespace,)).fetchone()[0]
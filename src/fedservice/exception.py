@@ -50,4 +50,8 @@ class FailedInformationRetrieval(Exception):
     pass
 
 class UnknownTrustAnchor(UnknownEntity):
-    pass
\ No newline at end of file
+    pass
+
+
+class CircuitOpen(FailedConfigurationRetrieval):
+    pass
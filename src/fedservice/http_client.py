@@ -0,0 +1,114 @@
+import logging
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStatistics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Counts from connection pools that have been evicted
+        self.retired_connections = 0
+        self.retired_requests = 0
+
+    def retire(self, pool):
+        with self.lock:
+            self.retired_connections += getattr(pool, "num_connections", 0)
+            self.retired_requests += getattr(pool, "num_requests", 0)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """
+    A HTTPAdapter that keeps track of the connections opened by the connection pools it has
+    evicted. Pools that are still alive keep their own counts.
+    """
+
+    def __init__(self, statistics: PoolStatistics, **kwargs):
+        self.statistics = statistics
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        _pools = self.poolmanager.pools
+        _dispose = _pools.dispose_func
+
+        def dispose(pool):
+            self.statistics.retire(pool)
+            if _dispose:
+                _dispose(pool)
+
+        _pools.dispose_func = dispose
+
+    def live_pools(self):
+        _pools = self.poolmanager.pools
+        return [_pools[key] for key in list(_pools.keys()) if key in _pools]
+
+
+class HTTPClient(object):
+    """
+    A session based HTTP client that keeps per host keep-alive connection pools.
+    Instances are callable with the same signature as `requests.request` so they can be used
+    wherever a httpc is expected.
+    """
+
+    def __init__(self,
+                 pool_connections: Optional[int] = 10,
+                 pool_maxsize: Optional[int] = 10,
+                 pool_block: Optional[bool] = False,
+                 max_retries: Optional[int] = 0,
+                 timeout: Optional[float] = None,
+                 **kwargs):
+        """
+        :param pool_connections: The number of hosts to keep connection pools for
+        :param pool_maxsize: The max number of connections kept per host
+        :param pool_block: Whether to block when no free connection is available
+        :param max_retries: The number of retries on failed connections
+        :param timeout: Default timeout used if none is given with a request
+        """
+        self.timeout = timeout
+        self.statistics = PoolStatistics()
+        self.session = requests.Session()
+        # Behave like requests.request, don't carry cookies between requests.
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.adapter = CountingHTTPAdapter(self.statistics,
+                                           pool_connections=pool_connections,
+                                           pool_maxsize=pool_maxsize,
+                                           pool_block=pool_block,
+                                           max_retries=max_retries)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def __call__(self, method, url, **kwargs):
+        if self.timeout is not None and kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        with self._lock:
+            self.requests += 1
+        return self.session.request(method, url, **kwargs)
+
+    def connection_statistics(self) -> dict:
+        """
+        :return: Dictionary with the number of requests sent, connections opened and requests
+            that reused an already open connection.
+        """
+        connections = self.statistics.retired_connections
+        pool_requests = self.statistics.retired_requests
+        for pool in self.adapter.live_pools():
+            connections += getattr(pool, "num_connections", 0)
+            pool_requests += getattr(pool, "num_requests", 0)
+
+        return {
+            "requests": self.requests,
+            "connections": connections,
+            "reused": max(pool_requests - connections, 0)
+        }
+
+    def close(self):
+        self.session.close()
@@ -520,7 +520,9 @@ class ListRequest(Message):
         "entity_type": SINGLE_OPTIONAL_STRING,
         "trust_marked": SINGLE_OPTIONAL_BOOLEAN,
         "trust_mark_id": SINGLE_OPTIONAL_STRING,
-        "intermediate": SINGLE_OPTIONAL_BOOLEAN
+        "intermediate": SINGLE_OPTIONAL_BOOLEAN,
+        "limit": SINGLE_OPTIONAL_INT,
+        "from": SINGLE_OPTIONAL_STRING
     }
 
 
@@ -594,5 +596,6 @@ class WhoRequest(Message):
 
 class WhoResponse(Message):
     c_param = {
-        "entities_to_use": REQUIRED_LIST_OF_STRINGS
+        "entities_to_use": REQUIRED_LIST_OF_STRINGS,
+        "index_updated": SINGLE_OPTIONAL_INT
     }
@@ -0,0 +1,113 @@
+import asyncio
+import copy
+import logging
+import threading
+from typing import Callable
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiting = 0
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key. The first caller does the work while
+    callers arriving before it is done wait for, and share, its result or exception.
+    """
+
+    def __init__(self, copy_shared: Optional[bool] = False):
+        """
+        :param copy_shared: Whether callers that waited get a deep copy of the result.
+            Use this if the result may be modified by the callers.
+        """
+        self.copy_shared = copy_shared
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, func: Callable, *args, **kwargs):
+        with self._lock:
+            _call = self._calls.get(key)
+            if _call is None:
+                _call = Call()
+                self._calls[key] = _call
+                leader = True
+            else:
+                _call.waiting += 1
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            logger.debug(f"Waiting for in-flight call: {key}")
+            _call.event.wait()
+            if _call.error is not None:
+                raise _call.error
+            if self.copy_shared:
+                return copy.deepcopy(_call.result)
+            return _call.result
+
+        try:
+            _call.result = func(*args, **kwargs)
+        except BaseException as err:
+            _call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            _call.event.set()
+        return _call.result
+
+    def in_flight(self) -> list:
+        with self._lock:
+            return list(self._calls.keys())
+
+
+class AsyncSingleFlight(object):
+    """
+    The asyncio version of :py:class:`SingleFlight`. Must only be used from one event loop
+    at the time.
+    """
+
+    def __init__(self, copy_shared: Optional[bool] = False):
+        self.copy_shared = copy_shared
+        self._calls = {}
+        self.shared = 0
+
+    async def do(self, key, func: Callable, *args, **kwargs):
+        _future = self._calls.get(key)
+        if _future is not None:
+            self.shared += 1
+            logger.debug(f"Waiting for in-flight call: {key}")
+            _result = await asyncio.shield(_future)
+            if self.copy_shared:
+                return copy.deepcopy(_result)
+            return _result
+
+        _future = asyncio.get_running_loop().create_future()
+        self._calls[key] = _future
+        try:
+            _result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            _future.cancel()
+            raise
+        except BaseException as err:
+            _future.set_exception(err)
+            # Don't complain if there was no one waiting
+            _future.exception()
+            raise
+        else:
+            _future.set_result(_result)
+            return _result
+        finally:
+            del self._calls[key]
+
+    def in_flight(self) -> list:
+        return list(self._calls.keys())
@@ -1,9 +1,41 @@
 import json
+import logging
 import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List
 from typing import Optional
 
 from cryptojwt.jwt import utc_time_sans_frac
 
+try:
+    import fcntl
+except ImportError:  # Not on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def _locked(file_name: str, mode: str):
+    """
+    Open a file and, where that can be done, hold an exclusive lock on it until it is
+    closed. If the file was replaced while waiting for the lock the new one is opened.
+    """
+    while True:
+        fp = open(file_name, mode)
+        if fcntl is None:
+            break
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        if os.fstat(fp.fileno()).st_ino == os.stat(file_name).st_ino:
+            break
+        fp.close()
+    try:
+        yield fp
+    finally:
+        fp.close()
+
 
 class FileDB(object):
 
@@ -91,6 +123,271 @@ class FileDB(object):
         return res
 
 
+class IndexedFileDB(object):
+    """
+    Keeps the issued trust marks in append-only files, one per trust mark ID, like FileDB.
+    What was last issued to each subject is also kept in memory so finding and listing
+    don't have to read the files. Only what has been added to a file since it was last
+    read is read before a question is answered.
+
+    Unlike FileDB only the trust mark last issued to a subject is kept. One that was issued
+    earlier is no longer found, even if it has not expired.
+
+    Expired trust marks are purged from memory, by a background thread if
+    `purge_interval` is given. When a file contains more than `compact_ratio` times as
+    many lines as there are live trust marks, and at least `compact_min` lines that are not
+    needed, it is rewritten with only the live ones.
+
+    Several processes may share the files. Appending and compacting are done holding a
+    lock on the file and a file is read again before it is compacted, so nothing another
+    process has added is lost. Where file locking is not available (:py:mod:`fcntl` is
+    missing) only one process may write to a file.
+    """
+
+    def __init__(self,
+                 purge_interval: Optional[int] = 0,
+                 compact_ratio: Optional[float] = 2.0,
+                 compact_min: Optional[int] = 100,
+                 **kwargs):
+        """
+        :param purge_interval: Seconds between purges. 0 means no background purging.
+        :param compact_ratio: When to compact a file. 0 means never.
+        :param compact_min: Min number of lines that are not needed before a file is
+            compacted
+        :param kwargs: Trust mark IDs as keys and file names as values
+        """
+        self.config = kwargs
+        self.purge_interval = purge_interval
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        # Per trust mark ID, the last issued per subject. Least recently issued first.
+        self._index = {}
+        # Number of lines in each file
+        self._lines = {}
+        # How far into each file has been read and which file that was
+        self._offset = {}
+        self._inode = {}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        for trust_mark_id, file_name in self.config.items():
+            self._load_file(trust_mark_id, file_name)
+
+        if purge_interval:
+            self.start()
+
+    def _read(self, fp, index: OrderedDict) -> int:
+        """
+        Read the complete lines from where a file, opened in binary mode, is positioned.
+        A line another process is still writing is left for later and the file is
+        positioned at its start.
+
+        :return: The number of lines read
+        """
+        _lines = 0
+        _pos = fp.tell()
+        for line in fp:
+            if not line.endswith(b"\n"):
+                break
+            _pos += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            self._set(index, json.loads(line))
+            _lines += 1
+        fp.seek(_pos)
+        return _lines
+
+    def _load_file(self, trust_mark_id: str, file_name: str):
+        if not os.path.exists(file_name):
+            # Only need to touch it
+            fp = open(file_name, "w")
+            fp.close()
+        self._index[trust_mark_id] = OrderedDict()
+        self._lines[trust_mark_id] = 0
+        self._offset[trust_mark_id] = 0
+        self._inode[trust_mark_id] = None
+        self._sync(trust_mark_id)
+
+    def _sync(self, trust_mark_id: str):
+        """
+        Read what has been added to a file since it was last read, by this or another
+        process. A file that another process has compacted is read from the start.
+        """
+        _file_name = self.config[trust_mark_id]
+        with self._lock:
+            _stat = os.stat(_file_name)
+            if (_stat.st_ino == self._inode[trust_mark_id]
+                    and _stat.st_size == self._offset[trust_mark_id]):
+                return
+            with open(_file_name, "rb") as fp:
+                _stat = os.fstat(fp.fileno())
+                if (_stat.st_ino != self._inode[trust_mark_id]
+                        or _stat.st_size < self._offset[trust_mark_id]):
+                    self._index[trust_mark_id] = OrderedDict()
+                    self._lines[trust_mark_id] = 0
+                    self._offset[trust_mark_id] = 0
+                    self._inode[trust_mark_id] = _stat.st_ino
+                fp.seek(self._offset[trust_mark_id])
+                self._lines[trust_mark_id] += self._read(fp, self._index[trust_mark_id])
+                self._offset[trust_mark_id] = fp.tell()
+
+    @staticmethod
+    def _set(index: OrderedDict, tm_info: dict):
+        index[tm_info["sub"]] = tm_info
+        index.move_to_end(tm_info["sub"])
+
+    @staticmethod
+    def _expired(tm_info: dict, now: int) -> bool:
+        return "exp" in tm_info and now > tm_info["exp"]
+
+    def add(self, tm_info: dict):
+        trust_mark_id = tm_info['id']
+        with self._lock:
+            # adds a line with info about a trust mark info to the end of a file
+            with _locked(self.config[trust_mark_id], "a") as fp:
+                fp.write(json.dumps(tm_info) + '\n')
+            # Picks up the new line together with anything other processes have added
+            self._sync(trust_mark_id)
+            self._maybe_compact(trust_mark_id)
+
+    def find(self, trust_mark_id: str, sub: str, iat: Optional[int] = 0) -> bool:
+        """
+        Whether the trust mark last issued to the subject is still valid. If `iat` is given
+        it must also be the one issued then.
+        """
+        if trust_mark_id not in self.config:
+            return False
+        self._sync(trust_mark_id)
+        _tmi = self._index[trust_mark_id].get(sub)
+        if not _tmi or self._expired(_tmi, utc_time_sans_frac()):
+            return False
+        if iat and iat != _tmi["iat"]:
+            return False
+        return True
+
+    def list(self, trust_mark_id: str, sub: Optional[str] = "") -> List[str]:
+        """
+        :return: The subjects with valid trust marks, most recently issued first
+        """
+        if trust_mark_id not in self.config:
+            return []
+        if sub:
+            return [sub] if self.find(trust_mark_id, sub) else []
+        _now = utc_time_sans_frac()
+        with self._lock:
+            self._sync(trust_mark_id)
+            _index = self._index[trust_mark_id]
+            return [s for s, _tmi in reversed(_index.items()) if not self._expired(_tmi, _now)]
+
+    def purge(self) -> int:
+        """
+        Remove expired trust marks from memory and compact the files where that is
+        worthwhile.
+
+        :return: The number of trust marks removed
+        """
+        _now = utc_time_sans_frac()
+        _count = 0
+        with self._lock:
+            for trust_mark_id in self.config.keys():
+                self._sync(trust_mark_id)
+                _index = self._index[trust_mark_id]
+                for sub in [s for s, _tmi in _index.items() if self._expired(_tmi, _now)]:
+                    del _index[sub]
+                    _count += 1
+                self._maybe_compact(trust_mark_id)
+        return _count
+
+    def _maybe_compact(self, trust_mark_id: str):
+        if not self.compact_ratio:
+            return
+        _lines = self._lines[trust_mark_id]
+        _live = len(self._index[trust_mark_id])
+        if _lines - _live >= self.compact_min and _lines > self.compact_ratio * _live:
+            self.compact(trust_mark_id)
+
+    def compact(self, trust_mark_id: Optional[str] = ""):
+        """
+        Rewrite files so they only contain the last issued trust mark per subject that has
+        not expired. The file is read again first, so what other processes have added is
+        kept.
+
+        :param trust_mark_id: Which file to rewrite. Default is all of them.
+        """
+        _now = utc_time_sans_frac()
+        with self._lock:
+            for _id in [trust_mark_id] if trust_mark_id else list(self.config.keys()):
+                _file_name = self.config[_id]
+                _index = OrderedDict()
+                with _locked(_file_name, "rb") as fp:
+                    self._read(fp, _index)
+                    for sub in [s for s, _tmi in _index.items() if self._expired(_tmi, _now)]:
+                        del _index[sub]
+                    _tmp = f"{_file_name}.tmp"
+                    with open(_tmp, "wb") as _fp:
+                        for _tmi in _index.values():
+                            _fp.write((json.dumps(_tmi) + '\n').encode())
+                        # Others may append to the new file as soon as it is in place
+                        _offset = _fp.tell()
+                        _inode = os.fstat(_fp.fileno()).st_ino
+                    os.replace(_tmp, _file_name)
+                self._index[_id] = _index
+                self._lines[_id] = len(_index)
+                self._offset[_id] = _offset
+                self._inode[_id] = _inode
+
+    def _run(self):
+        while not self._stop.wait(self.purge_interval):
+            try:
+                _count = self.purge()
+            except Exception as err:
+                logger.warning(f"Could not purge trust marks: {err}")
+            else:
+                logger.debug(f"Purged {_count} expired trust marks")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="trust_mark_purger",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __contains__(self, item):
+        return item in self.config
+
+    def id_keys(self):
+        return self.config.keys()
+
+    def dump(self):
+        res = {}
+        with self._lock:
+            for trust_mark_id in self.config.keys():
+                self._sync(trust_mark_id)
+                res[trust_mark_id] = [json.dumps(_tmi) for _tmi in
+                                      self._index[trust_mark_id].values()]
+        return res
+
+    def dumps(self):
+        return json.dumps(self.dump())
+
+    def load(self, info):
+        for trust_mark_id in self.config.keys():
+            for tm_info in info.get(trust_mark_id, []):
+                self.add(json.loads(tm_info))
+
+    def loads(self, str):
+        self.load(json.loads(str))
+
+
 class SimpleDB(object):
 
     def __init__(self):
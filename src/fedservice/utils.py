@@ -101,6 +101,13 @@ def build_entity_config(entity_id: str,
     return entity.conf
 
 
+def presign_subordinate_statements(federation_entity):
+    # Only done if the fetch endpoint is configured to do it
+    _fetch = federation_entity.server.get_endpoint("fetch")
+    if _fetch and getattr(_fetch, "presign_statements", False):
+        _fetch.presign()
+
+
 def make_federation_entity(entity_id: str,
                            key_config: Optional[dict] = None,
                            authority_hints: Optional[List[str]] = None,
@@ -155,6 +162,8 @@ def make_federation_entity(entity_id: str,
         for id, info in metadata_policy.items():
             fe.server.policy[id] = info
 
+    presign_subordinate_statements(fe)
+
     if trust_marks:
         fe.context.trust_marks = trust_marks
 
@@ -247,6 +256,8 @@ def make_federation_combo(entity_id: str,
         for id, info in metadata_policy.items():
             federation_entity.server.policy[id] = info
 
+    presign_subordinate_statements(federation_entity)
+
     if trust_marks:
         if "class" in trust_marks:
             federation_entity.context.trust_marks = execute(trust_marks)
@@ -0,0 +1,88 @@
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity_statement.cache import ESCache
+from fedservice.entity_statement.storage import SQLiteStore
+
+
+def test_expiration():
+    now = utc_time_sans_frac()
+    cache = ESCache(allowed_delta=0)
+    cache["a"] = {"iss": "https://a.example.org", "exp": now + 100}
+    cache.set("b", "jws", exp=now + 10)
+    cache["c"] = "no expiration"
+    assert "a" in cache
+    assert cache["b"] == "jws"
+    assert cache.get_exp("b") == now + 10
+
+    assert cache.purge(now + 50) == 1
+    assert "b" not in cache
+    assert cache["b"] is None
+    assert set(cache.keys()) == {"a", "c"}
+
+    cache.set("a", "replaced", exp=now + 1000)
+    assert cache.purge(now + 500) == 0
+    assert cache["a"] == "replaced"
+
+
+def test_lru_eviction():
+    cache = ESCache(max_entries=2)
+    cache["a"] = "1"
+    cache["b"] = "2"
+    assert cache["a"] == "1"
+    cache["c"] = "3"
+    assert set(cache.keys()) == {"a", "c"}
+    assert cache.statistics()["evictions"] == 1
+
+    cache = ESCache(max_size=10)
+    cache["a"] = "12345"
+    cache["b"] = "12345"
+    cache["c"] = "12345"
+    assert set(cache.keys()) == {"b", "c"}
+    assert cache.size == 10
+
+
+def test_counters():
+    cache = ESCache()
+    cache["a"] = "1"
+    assert cache["a"] == "1"
+    assert cache["b"] is None
+    _stats = cache.statistics()
+    assert _stats["hits"] == 1
+    assert _stats["misses"] == 1
+
+
+def test_dump_load():
+    now = utc_time_sans_frac()
+    cache = ESCache(allowed_delta=0)
+    cache["a"] = {"iss": "https://a.example.org", "exp": now + 100}
+    cache.set("b", "jws", exp=now + 10)
+    _dump = cache.dump()
+    assert set(_dump["_db"].keys()) == {"a", "b"}
+
+    cache2 = ESCache().load(_dump)
+    assert cache2["a"]["iss"] == "https://a.example.org"
+    assert cache2.get_exp("b") == now + 10
+    assert cache2.purge(now + 50) == 1
+    assert len(cache2) == 1
+
+
+def test_shared_storage(tmp_path):
+    now = utc_time_sans_frac()
+    _path = str(tmp_path / "cache.db")
+    worker1 = ESCache(allowed_delta=0, storage=SQLiteStore(_path, namespace="statement"))
+    worker2 = ESCache(allowed_delta=0, storage=SQLiteStore(_path, namespace="statement"))
+    other = ESCache(allowed_delta=0, storage=SQLiteStore(_path, namespace="config"))
+
+    worker1.set("a!!b", "jws", exp=now + 100)
+    worker1["c"] = {"iss": "https://c.example.org", "exp": now + 10}
+    assert "a!!b" in worker2
+    assert worker2["a!!b"] == "jws"
+    assert worker2.get_exp("a!!b") == now + 100
+    assert worker2["c"]["iss"] == "https://c.example.org"
+    assert other["a!!b"] is None
+
+    del worker2["a!!b"]
+    assert worker1.storage.get("a!!b") is None
+
+    worker1.purge(now + 50)
+    assert worker2.storage.keys() == []
@@ -0,0 +1,66 @@
+import pytest
+from idpyoidc.exception import MissingPage
+from requests.exceptions import ConnectionError
+
+from fedservice.entity_statement.failure_cache import FailureCache
+from fedservice.exception import CircuitOpen
+
+URL = "https://im.example.org/fetch?sub=https://rp.example.org"
+
+
+def test_remembered_failure():
+    cache = FailureCache()
+    cache.check(URL)
+    cache.record_failure(URL, MissingPage("No such page"))
+    with pytest.raises(MissingPage):
+        cache.check(URL)
+    # A missing page doesn't affect other URLs on the same host
+    cache.check("https://im.example.org/.well-known/openid-federation")
+    assert list(cache.status()["urls"].keys()) == [URL]
+    assert cache.status()["hosts"] == {}
+
+    cache.forget(url=URL)
+    cache.check(URL)
+
+
+def test_backoff():
+    cache = FailureCache(ttl={"ConnectionError": 0}, backoff_base=10)
+    cache.record_failure(URL, ConnectionError("Connection refused"))
+    with pytest.raises(CircuitOpen):
+        cache.check("https://im.example.org/list")
+    _host = cache.status()["hosts"]["im.example.org"]
+    assert _host["state"] == "closed"
+    assert _host["failures"] == 1
+    assert cache.backoff(3) == 40
+
+    cache.forget(host="im.example.org")
+    cache.check("https://im.example.org/list")
+
+
+def test_circuit_breaker():
+    cache = FailureCache(ttl={"ConnectionError": 0}, backoff_base=0, failure_threshold=2,
+                         reset_timeout=0)
+    cache.record_failure(URL, ConnectionError("Connection refused"))
+    cache.record_failure(URL, ConnectionError("Connection refused"))
+    assert cache.status()["hosts"]["im.example.org"]["state"] == "open"
+
+    # After reset_timeout one probe is let through
+    cache.check(URL)
+    with pytest.raises(CircuitOpen):
+        cache.check(URL)
+    cache.record_success(URL)
+    assert cache.status()["hosts"] == {}
+    cache.check(URL)
+
+
+def test_released_probe():
+    cache = FailureCache(ttl={"ConnectionError": 0}, backoff_base=0, failure_threshold=1,
+                         reset_timeout=0)
+    cache.record_failure(URL, ConnectionError("Connection refused"))
+    cache.check(URL)
+    with pytest.raises(CircuitOpen):
+        cache.check(URL)
+    # The probe was given up without an answer
+    cache.release(URL)
+    cache.check(URL)
+    assert cache.status()["hosts"]["im.example.org"]["state"] == "half-open"
@@ -0,0 +1,45 @@
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity_statement.http_cache import ConditionalCache
+from fedservice.entity_statement.http_cache import parse_cache_control
+
+URL = "https://ta.example.org/fetch?sub=https://leaf.example.org"
+
+
+def test_parse_cache_control():
+    res = parse_cache_control('max-age=3600, no-transform, private="x"')
+    assert res == {"max-age": 3600, "no-transform": True, "private": "x"}
+    assert parse_cache_control("") == {}
+
+
+def test_conditional_headers():
+    cache = ConditionalCache()
+    exp = utc_time_sans_frac() + 3600
+    cache.store(URL, "jws", {"ETag": '"abc"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"},
+                exp=exp)
+    assert cache.conditional_headers(URL) == {
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"
+    }
+    assert cache.not_modified(URL, {"Cache-Control": "max-age=60"}) == "jws"
+    _until = cache.reuse_until(URL, "jws")
+    assert utc_time_sans_frac() + 55 <= _until <= utc_time_sans_frac() + 60
+    # Another body means the bound doesn't apply
+    assert cache.reuse_until(URL, "other") == 0
+
+
+def test_expired_and_no_store():
+    cache = ConditionalCache()
+    cache.store(URL, "jws", {"ETag": '"abc"'}, exp=utc_time_sans_frac() - 1)
+    assert cache.conditional_headers(URL) == {}
+
+    cache.store(URL, "jws", {"ETag": '"abc"', "Cache-Control": "no-store"})
+    assert URL not in cache
+
+
+def test_max_entries():
+    cache = ConditionalCache(max_entries=2)
+    for i in range(3):
+        cache.store(f"{URL}{i}", "jws", {"ETag": str(i)})
+    assert len(cache) == 2
+    assert f"{URL}0" not in cache
@@ -0,0 +1,65 @@
+from fedservice.combo import FederationCombo
+from fedservice.entity import FederationEntity
+from fedservice.http_client import HTTPClient
+from fedservice.utils import build_entity_config
+from fedservice.utils import make_federation_entity
+
+KEYDEFS = [
+    {"type": "RSA", "key": "", "use": ["sig"]},
+    {"type": "EC", "crv": "P-256", "use": ["sig"]},
+]
+
+
+def test_connection_reuse(httpserver):
+    httpserver.serve_content("OK", 200)
+
+    client = HTTPClient(timeout=5)
+    for _ in range(3):
+        resp = client("GET", httpserver.url)
+        assert resp.status_code == 200
+        assert resp.text == "OK"
+
+    assert client.connection_statistics() == {"requests": 3, "connections": 1, "reused": 2}
+    client.close()
+
+
+def test_no_cookies_kept(httpserver):
+    httpserver.serve_content("OK", 200, headers={"Set-Cookie": "session=abc; Path=/"})
+
+    client = HTTPClient()
+    client("GET", httpserver.url)
+    assert len(client.session.cookies) == 0
+
+
+def test_entity_close(httpserver):
+    httpserver.serve_content("OK", 200)
+
+    _entity = make_federation_entity("https://entity.example.org",
+                                     key_config={"key_defs": KEYDEFS},
+                                     endpoints=["entity_configuration"])
+    # The services use the entity's client
+    assert _entity.client.httpc is _entity.httpc
+    _entity.httpc("GET", httpserver.url)
+    assert _entity.httpc.adapter.live_pools()
+    _entity.close()
+    assert _entity.httpc.adapter.live_pools() == []
+
+
+def test_combo_close(httpserver):
+    httpserver.serve_content("OK", 200)
+
+    _config = build_entity_config(entity_id="https://entity.example.org",
+                                  key_config={"key_defs": KEYDEFS},
+                                  endpoints=["entity_configuration"])
+    _combo = FederationCombo({"entity_id": "https://entity.example.org",
+                              "federation_entity": {"class": FederationEntity,
+                                                    "kwargs": _config}})
+    _federation_entity = _combo["federation_entity"]
+    assert _federation_entity.httpc is _combo.httpc
+    assert _federation_entity.client.httpc is _combo.httpc
+    _combo.httpc("GET", httpserver.url)
+    # The client belongs to the combo
+    _federation_entity.close()
+    assert _combo.httpc.adapter.live_pools()
+    _combo.close()
+    assert _combo.httpc.adapter.live_pools() == []
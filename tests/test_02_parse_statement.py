@@ -0,0 +1,84 @@
+import pytest
+from cryptojwt.exception import BadSignature
+from cryptojwt.exception import MissingKey
+from cryptojwt.exception import VerificationError
+from cryptojwt.jwt import JWT
+from cryptojwt.jwt import utc_time_sans_frac
+from cryptojwt.key_jar import build_keyjar
+
+from fedservice.entity_statement.parse import jwks_keys
+from fedservice.entity_statement.parse import parse_statement
+from fedservice.entity_statement.parse import verify_self_signed
+
+KEYSPEC = [{"type": "EC", "crv": "P-256", "use": ["sig"]}]
+ENTITY_ID = "https://op.example.org"
+
+
+@pytest.fixture
+def keyjar():
+    _keyjar = build_keyjar(KEYSPEC)
+    _keyjar.import_jwks(_keyjar.export_jwks(private=True), ENTITY_ID)
+    return _keyjar
+
+
+def test_parse_once(keyjar):
+    _jws = JWT(key_jar=keyjar, iss=ENTITY_ID, sign_alg="ES256").pack(
+        {"sub": ENTITY_ID, "metadata": {"federation_entity": {"organization_name": "OP"}}},
+        issuer_id=ENTITY_ID)
+    _statement = parse_statement(_jws)
+    assert parse_statement(_jws) is _statement
+    assert _statement.payload()["sub"] == ENTITY_ID
+    assert _statement.headers["alg"] == "ES256"
+
+    _claims = _statement.claims()
+    _claims["sub"] = "https://other.example.org"
+    _claims["metadata"]["federation_entity"].clear()
+    assert _statement.payload()["sub"] == ENTITY_ID
+    assert _statement.payload()["metadata"]["federation_entity"] == {"organization_name": "OP"}
+
+
+def test_verify(keyjar):
+    _jws = JWT(key_jar=keyjar, iss=ENTITY_ID, sign_alg="ES256").pack({"sub": ENTITY_ID}, issuer_id=ENTITY_ID)
+    _statement = parse_statement(_jws)
+    keys = keyjar.get_jwt_verify_keys(_statement)
+    assert _statement.verify(keys)["iss"] == ENTITY_ID
+
+    _other = build_keyjar(KEYSPEC)
+    with pytest.raises(BadSignature):
+        _statement.verify(_other.get_verify_key(issuer_id=""))
+
+
+def test_not_signed():
+    with pytest.raises(ValueError):
+        parse_statement("not.a.jws")
+
+
+def test_verify_self_signed(keyjar):
+    _jwks = keyjar.export_jwks()
+    _jws = JWT(key_jar=keyjar, iss=ENTITY_ID, sign_alg="ES256").pack(
+        {"sub": ENTITY_ID, "jwks": _jwks}, issuer_id=ENTITY_ID)
+    assert verify_self_signed(_jws)["sub"] == ENTITY_ID
+    # Key objects are built once per JWKS
+    assert jwks_keys(_jwks) is jwks_keys(dict(_jwks))
+
+    _other = build_keyjar(KEYSPEC)
+    _jws = JWT(key_jar=keyjar, iss=ENTITY_ID, sign_alg="ES256").pack(
+        {"sub": ENTITY_ID, "jwks": _other.export_jwks()}, issuer_id=ENTITY_ID)
+    with pytest.raises((BadSignature, MissingKey)):
+        verify_self_signed(_jws)
+
+
+def test_verify_expired(keyjar):
+    _jwks = keyjar.export_jwks()
+    _now = utc_time_sans_frac()
+    _jws = JWT(key_jar=keyjar, iss=ENTITY_ID, sign_alg="ES256").pack(
+        {"sub": ENTITY_ID, "jwks": _jwks, "exp": _now - 500}, issuer_id=ENTITY_ID)
+    with pytest.raises(VerificationError):
+        verify_self_signed(_jws)
+    # Within the allowed clock skew
+    assert verify_self_signed(_jws, allowed_delta=600)["sub"] == ENTITY_ID
+
+    _jws = JWT(key_jar=keyjar, iss=ENTITY_ID, sign_alg="ES256").pack(
+        {"sub": ENTITY_ID, "jwks": _jwks, "nbf": _now + 500}, issuer_id=ENTITY_ID)
+    with pytest.raises(VerificationError):
+        verify_self_signed(_jws)
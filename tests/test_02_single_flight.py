@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from fedservice.single_flight import AsyncSingleFlight
+from fedservice.single_flight import SingleFlight
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def fetch(url):
+        calls.append(url)
+        started.set()
+        time.sleep(0.2)
+        return f"response from {url}"
+
+    results = []
+
+    def worker():
+        results.append(flight.do("https://example.org", fetch, "https://example.org"))
+
+    first = threading.Thread(target=worker)
+    first.start()
+    started.wait()
+    others = [threading.Thread(target=worker) for _ in range(4)]
+    for t in others:
+        t.start()
+    for t in [first] + others:
+        t.join()
+
+    assert calls == ["https://example.org"]
+    assert results == ["response from https://example.org"] * 5
+    assert flight.shared == 4
+    assert flight.in_flight() == []
+
+
+def test_single_flight_error():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("Failed")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    # The failure is not remembered
+    assert flight.do("key", lambda: 1) == 1
+
+
+def test_async_single_flight():
+    flight = AsyncSingleFlight(copy_shared=True)
+    calls = []
+
+    async def fetch(url):
+        calls.append(url)
+        await asyncio.sleep(0.1)
+        return [url]
+
+    async def run():
+        return await asyncio.gather(*[flight.do("key", fetch, "https://example.org")
+                                      for _ in range(5)])
+
+    results = asyncio.run(run())
+    assert calls == ["https://example.org"]
+    assert results == [["https://example.org"]] * 5
+    # Callers that waited got copies
+    assert results[1] is not results[0]
+    assert flight.shared == 4
@@ -1,3 +1,4 @@
+from fedservice.entity.function import iter_chains
 from fedservice.entity.function import tree2chains
 
 
@@ -93,3 +94,38 @@ def test_tree2chains_5():
     assert chains[0] == ["statement3", "statement2", "statement1"]
     assert chains[1] == ["statement4", "statement1"]
 
+
+
+def test_tree2chains_shared_subtree():
+    # Both intermediates have the same superior
+    anchor = {"https://example.com/anchor": ("statement4", {})}
+    tree = {
+        "https://example.com/intermediate1": (
+            'statement1', {"https://example.com/federation": ('statement2', anchor)}),
+        "https://example.com/intermediate2": (
+            'statement5', {"https://example.com/federation": ('statement3', anchor)})
+    }
+
+    chains = tree2chains(tree)
+    assert chains == [["statement4", "statement2", "statement1"],
+                      ["statement4", "statement3", "statement5"]]
+    # Chains built from the shared subtree are independent lists
+    assert chains[0] is not chains[1]
+
+
+def test_iter_chains_priority():
+    tree = {
+        "https://example.com/intermediate": (
+            'statement1', {"https://example.com/anchor1": ("statement2", {})}),
+        "https://example.com/anchor2": ("statement3", {}),
+        "https://example.com/unreachable": None
+    }
+
+    # Shortest first
+    assert list(iter_chains(tree)) == [["statement3"], ["statement2", "statement1"]]
+    # Priority before length
+    assert list(iter_chains(tree, ["https://example.com/anchor1"])) == [
+        ["statement2", "statement1"], ["statement3"]]
+
+    _iter = iter_chains(tree)
+    assert next(_iter) == ["statement3"]
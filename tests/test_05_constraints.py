@@ -2,7 +2,9 @@ from cryptojwt.jwt import utc_time_sans_frac
 import pytest
 
 from fedservice.entity_statement.constraints import calculate_path_length
+from fedservice.entity_statement.constraints import constraint_violation
 from fedservice.entity_statement.constraints import excluded
+from fedservice.entity_statement.constraints import meets_restrictions
 from fedservice.entity_statement.constraints import permitted
 from fedservice.entity_statement.constraints import update_naming_constraints
 from fedservice.exception import UnknownCriticalExtension
@@ -302,3 +304,32 @@ def test_policy_language_crit_not_supported():
 
     with pytest.raises(UnknownCriticalExtension):
         _statement.verify()
+
+
+def test_constraint_violation():
+    constraints = Constraints(max_path_length=1,
+                              naming_constraints=NamingConstraints(
+                                  permitted=["https://.example.com"],
+                                  excluded=["https://east.example.com"]))
+
+    assert constraint_violation(constraints, 1, ["https://rp.example.com",
+                                                 "https://im.example.com"]) == ""
+    # Too many intermediates
+    assert constraint_violation(constraints, 2, ["https://rp.example.com"])
+    # Not permitted
+    assert constraint_violation(constraints, 0, ["https://rp.example.org"])
+    # Excluded
+    assert constraint_violation(constraints, 0, ["https://east.example.com"])
+    assert constraint_violation({}, 5, ["https://rp.example.org"]) == ""
+
+
+def test_meets_restrictions_path_length():
+    _ta = {"iss": "https://ta.example.com", "sub": "https://im1.example.com",
+           "constraints": {"max_path_length": 1}}
+    _im1 = {"iss": "https://im1.example.com", "sub": "https://im2.example.com"}
+    _im2 = {"iss": "https://im2.example.com", "sub": "https://rp.example.com"}
+    _leaf = {"iss": "https://rp.example.com", "sub": "https://rp.example.com"}
+
+    assert meets_restrictions([_ta, _im2, _leaf])
+    # Two intermediates below the trust anchor
+    assert meets_restrictions([_ta, _im1, _im2, _leaf]) is False
@@ -3,6 +3,7 @@ import os
 from cryptojwt.jwt import utc_time_sans_frac
 
 from fedservice.trust_mark_entity import FileDB
+from fedservice.trust_mark_entity import IndexedFileDB
 
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
 
@@ -26,3 +27,71 @@ def test_add_and_find():
 
     res = _db.find(trust_mark_id="https://refeds.org/sirtfi", sub="https://example.com")
     assert res
+
+
+def test_indexed_add_find_and_list():
+    file_name = os.path.join(BASE_PATH, 'sirtfi_indexed')
+    try:
+        os.unlink(file_name)
+    except FileNotFoundError:
+        pass
+
+    _id = "https://refeds.org/sirtfi"
+    _db = IndexedFileDB(compact_min=2, **{_id: file_name})
+    _now = utc_time_sans_frac()
+    _db.add({'id': _id, "sub": "https://example.com", 'iat': _now - 10})
+    _db.add({'id': _id, "sub": "https://example.org", 'iat': _now, 'exp': _now - 1})
+    _db.add({'id': _id, "sub": "https://example.com", 'iat': _now})
+
+    assert _db.find(trust_mark_id=_id, sub="https://example.com")
+    assert _db.find(trust_mark_id=_id, sub="https://example.com", iat=_now)
+    # Replaced by the one issued later
+    assert _db.find(trust_mark_id=_id, sub="https://example.com", iat=_now - 10) is False
+    # Expired
+    assert _db.find(trust_mark_id=_id, sub="https://example.org") is False
+    assert _db.list(_id) == ["https://example.com"]
+
+    # Read back from the file
+    _db2 = IndexedFileDB(**{_id: file_name})
+    assert _db2.list(_id) == ["https://example.com"]
+
+    # The expired one is purged and the file compacted
+    assert _db.purge() == 1
+    with open(file_name) as fp:
+        assert len(fp.readlines()) == 1
+    assert IndexedFileDB(**{_id: file_name}).list(_id) == ["https://example.com"]
+    os.unlink(file_name)
+
+
+def test_indexed_shared_file():
+    file_name = os.path.join(BASE_PATH, 'sirtfi_shared')
+    try:
+        os.unlink(file_name)
+    except FileNotFoundError:
+        pass
+
+    _id = "https://refeds.org/sirtfi"
+    _now = utc_time_sans_frac()
+    _db = IndexedFileDB(compact_ratio=0, **{_id: file_name})
+    # Another process using the same file
+    _other = IndexedFileDB(compact_ratio=0, **{_id: file_name})
+    _db.add({'id': _id, "sub": "https://example.com", 'iat': _now})
+    _other.add({'id': _id, "sub": "https://example.org", 'iat': _now})
+    # What the other one issued is found at once
+    assert _db.find(trust_mark_id=_id, sub="https://example.org")
+    assert _other.find(trust_mark_id=_id, sub="https://example.com")
+
+    # Compacting keeps what the other one added
+    _db.add({'id': _id, "sub": "https://example.com", 'iat': _now + 1})
+    _db.compact(_id)
+    assert _db.list(_id) == ["https://example.com", "https://example.org"]
+    with open(file_name) as fp:
+        assert len(fp.readlines()) == 2
+
+    # The other one notices the file was compacted
+    _other.add({'id': _id, "sub": "https://example.net", 'iat': _now})
+    assert _other.list(_id) == ["https://example.net", "https://example.com",
+                                "https://example.org"]
+    assert _db.find(trust_mark_id=_id, sub="https://example.net")
+    assert _other.find(trust_mark_id=_id, sub="https://example.com", iat=_now + 1)
+    os.unlink(file_name)
@@ -1,19 +1,36 @@
+import asyncio
+import json
 import os
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
 
 from cryptojwt.jws.jws import factory
+from cryptojwt.jwt import utc_time_sans_frac
 import pytest
 import responses
+from requests.exceptions import ConnectionError
+from requests.exceptions import ReadTimeout
 
 from fedservice import get_trust_chain
 from fedservice import save_trust_chains
 from fedservice.entity.function import collect_trust_chains
+from fedservice.entity.function import get_first_verified_trust_chain
 from fedservice.entity.function import get_verified_trust_chains
+from fedservice.entity.function import refresh_trust_chain
 from fedservice.entity.function import verify_trust_chains
+from fedservice.entity.function.async_trust_chain_collector import AsyncTrustChainCollector
+from fedservice.entity.function.crawler import Crawler
+from fedservice.entity.function.crawler import FederationGraph
+from fedservice.entity.function.federation_index import FederationIndex
 from fedservice.entity.function.policy import TrustChainPolicy
+from fedservice.entity.function.refresh_scheduler import RefreshScheduler
 from fedservice.entity.function.trust_chain_collector import TrustChainCollector
 from fedservice.entity.function.trust_chain_collector import verify_self_signed_signature
 from fedservice.entity.function.trust_mark_verifier import TrustMarkVerifier
 from fedservice.entity.function.verifier import TrustChainVerifier
+from fedservice.entity.server.subordinate_registry import SubordinateRegistry
+from fedservice.entity_statement.failure_cache import FailureCache
+from fedservice.entity_statement.parse import parse_statement
 from fedservice.message import EntityStatement
 from fedservice.message import ResolveResponse
 from tests import create_trust_chain_messages
@@ -195,12 +212,37 @@ class TestServer():
         _endpoint = self.leaf["federation_entity"].get_endpoint('entity_configuration')
         _req = _endpoint.parse_request({})
         _resp_args = _endpoint.process_request(_req)
-        assert set(_resp_args.keys()) == {'response'}
+        assert set(_resp_args.keys()) == {'response', 'http_headers'}
         entity_configuration = verify_self_signed_signature(_resp_args['response'])
         assert entity_configuration['iss'] == self.leaf.entity_id
         assert entity_configuration['sub'] == self.leaf.entity_id
         assert set(entity_configuration['metadata']['federation_entity'].keys()) == set()
 
+    def test_entity_configuration_cached(self):
+        _endpoint = self.leaf["federation_entity"].get_endpoint('entity_configuration')
+        _resp_args = _endpoint.process_request(_endpoint.parse_request({}))
+        _etag = dict(_resp_args['http_headers'])['ETag']
+        # Nothing has changed so the same signed entity configuration is returned
+        _again = _endpoint.process_request(_endpoint.parse_request({}))
+        assert _again['response'] == _resp_args['response']
+        assert dict(_again['http_headers'])['ETag'] == _etag
+
+        _context = self.leaf["federation_entity"].context
+        _context.trust_marks = ['eyJhbGciOiJSUzI1NiJ9.eyJpZCI6ICJ4In0.c2ln']
+        try:
+            _changed = _endpoint.process_request(_endpoint.parse_request({}))
+        finally:
+            _context.trust_marks = []
+        assert _changed['response'] != _resp_args['response']
+        assert dict(_changed['http_headers'])['ETag'] != _etag
+        _payload = verify_self_signed_signature(_changed['response'])
+        assert _payload['trust_marks'] == ['eyJhbGciOiJSUzI1NiJ9.eyJpZCI6ICJ4In0.c2ln']
+
+        # Signed again once too much of the lifetime has passed
+        _endpoint.refresh_fraction = 0
+        _resigned = _endpoint.process_request(_endpoint.parse_request({}))
+        assert verify_self_signed_signature(_resigned['response'])['iss'] == self.leaf.entity_id
+
     def test_fetch(self):
         _endpoint = self.ta.get_endpoint('fetch')
         _req = _endpoint.parse_request({"sub": self.intermediate.entity_id})
@@ -215,6 +257,26 @@ class TestServer():
         assert entity_statement['sub'] == self.intermediate.entity_id
         assert entity_statement['authority_hints'] == [self.ta.entity_id]
 
+    def test_fetch_cached(self):
+        _endpoint = self.ta.get_endpoint('fetch')
+        _req = _endpoint.parse_request({"sub": self.intermediate.entity_id})
+        _jws = _endpoint.process_request(_req)["response_msg"]
+        assert _endpoint.process_request(_req)["response_msg"] == _jws
+
+        # A change is noticed without the cache being invalidated
+        _info = self.ta.server.subordinate[self.intermediate.entity_id]
+        self.ta.server.subordinate[self.intermediate.entity_id] = dict(
+            _info, constraints={"max_path_length": 1})
+        _changed = _endpoint.process_request(_req)["response_msg"]
+        assert _changed != _jws
+        assert factory(_changed).jwt.payload()["constraints"] == {"max_path_length": 1}
+
+        _endpoint.invalidate(self.intermediate.entity_id)
+        assert self.intermediate.entity_id not in _endpoint.statement_cache
+        assert _endpoint.presign() == 1
+        assert _endpoint.process_request(_req)["response_msg"] == _endpoint.statement_cache[
+            self.intermediate.entity_id]["jws"]
+
     def test_list(self):
         _endpoint = self.ta.get_endpoint('list')
         _req = _endpoint.parse_request({})
@@ -222,6 +284,165 @@ class TestServer():
         assert _resp_args
         assert _resp_args['response_msg'] == f'["{self.intermediate.entity_id}"]'
 
+    def test_list_filtered(self):
+        _registry = self.ta.server.subordinate
+        assert isinstance(_registry, SubordinateRegistry)
+        _endpoint = self.ta.get_endpoint('list')
+
+        def _list(**kwargs):
+            _resp_args = _endpoint.process_request(_endpoint.parse_request(kwargs))
+            return json.loads(_resp_args['response_msg'])
+
+        # From the registration
+        assert _list(entity_type="federation_entity") == [INTERMEDIATE_ID]
+        assert _list(entity_type="openid_provider") == []
+        assert _list(intermediate="true") == []
+
+        # From the subordinates' entity configurations
+        _unreachable = "https://unreachable.example.org"
+        _registry[_unreachable] = {"jwks": {"keys": []}, "entity_types": ["openid_provider"]}
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta)
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+            # Those never picked up are picked up when asked for
+            assert _registry.missing() == [INTERMEDIATE_ID, _unreachable]
+            assert _list(trust_marked="true") == []
+            # The one that failed isn't tried again for a while
+            assert _registry.missing() == []
+            _calls = len(rsps.calls)
+            assert _list(trust_marked="true") == []
+            assert len(rsps.calls) == _calls
+            assert _registry.refresh_all([INTERMEDIATE_ID]) == 1
+        del _registry[_unreachable]
+
+        assert _list(intermediate="true") == [INTERMEDIATE_ID]
+        assert _list(intermediate="true", entity_type="openid_provider") == []
+        assert _list(trust_marked="true") == []
+
+        _registry.configuration[INTERMEDIATE_ID]["trust_marks"] = [
+            {"id": "https://tm.example.org/tm", "trust_mark": "eyJ..."}]
+        _registry.reindex()
+        assert _list(trust_mark_id="https://tm.example.org/tm") == [INTERMEDIATE_ID]
+        assert _list(trust_marked="true", intermediate="true") == [INTERMEDIATE_ID]
+
+        del _registry[INTERMEDIATE_ID]
+        assert _list(trust_marked="true") == []
+        assert _list(entity_type="federation_entity") == []
+
+    def test_list_paged(self):
+        _subordinates = [f"https://sub{n}.example.org" for n in range(5)]
+        for entity_id in _subordinates:
+            self.ta.server.subordinate[entity_id] = {"jwks": {"keys": []},
+                                                     "entity_types": ["openid_relying_party"]}
+        _all = sorted([INTERMEDIATE_ID] + _subordinates)
+        _endpoint = self.ta.get_endpoint('list')
+
+        def _list(**kwargs):
+            _resp_args = _endpoint.process_request(_endpoint.parse_request(kwargs))
+            return json.loads(_resp_args['response_msg'])
+
+        assert _list(limit="2") == _all[:2]
+        assert _list(limit="2", **{"from": _all[1]}) == _all[2:4]
+        assert _list(limit="10", entity_type="openid_relying_party",
+                     **{"from": _subordinates[3]}) == _subordinates[4:]
+
+        _endpoint.stream = True
+        _resp_args = _endpoint.process_request(_endpoint.parse_request({}))
+        assert set(json.loads("".join(_resp_args['response_msg']))) == set(_all)
+        _endpoint.stream = False
+
+        # The client asks for one page at the time
+        def _list_callback(request):
+            _args = {k: v[0] for k, v in parse_qs(urlparse(request.url).query).items()}
+            return 200, {"Content-Type": "application/json"}, json.dumps(_list(**_args))
+
+        _ta_ec = self.ta.server.get_endpoint('entity_configuration')
+        _service = self.leaf["federation_entity"].client.get_service("list")
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add("GET", _ta_ec.full_path, body=_ta_ec.process_request({})["response"],
+                     adding_headers={"Content-Type": "application/json"}, status=200)
+            rsps.add_callback("GET", _endpoint.full_path, callback=_list_callback)
+            _pages = _service.iterate(TA1_ID, limit=2)
+            assert next(_pages) == _all[0]
+            _calls = len(rsps.calls)
+            assert next(_pages) == _all[1]
+            assert len(rsps.calls) == _calls
+            assert list(_pages) == _all[2:]
+
+        # A server that doesn't do paging and has exactly a page full
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add("GET", _ta_ec.full_path, body=_ta_ec.process_request({})["response"],
+                     adding_headers={"Content-Type": "application/json"}, status=200)
+            rsps.add("GET", _endpoint.full_path, body=json.dumps(_all),
+                     adding_headers={"Content-Type": "application/json"}, status=200)
+            assert list(_service.iterate(TA1_ID, limit=len(_all))) == _all
+
+        # Filtered pages follow changes to the subordinates
+        _new = "https://sub.example.org"
+        self.ta.server.subordinate[_new] = {"jwks": {"keys": []},
+                                            "entity_types": ["openid_relying_party"]}
+        assert _list(entity_type="openid_relying_party") == sorted(_subordinates + [_new])
+
+    def test_crawl(self, tmp_path):
+        _fe = self.leaf["federation_entity"]
+        _crawler = Crawler(_fe.unit_get, max_workers=2, host_rate=0,
+                           checkpoint_dir=str(tmp_path), checkpoint_interval=1)
+
+        def _mock(rsps):
+            for _entity in [self.ta, self.intermediate, _fe]:
+                _ec = _entity.server.get_endpoint('entity_configuration')
+                rsps.add("GET", _ec.full_path, body=_ec.process_request({})["response"],
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+            for _entity in [self.ta, self.intermediate]:
+                _list = _entity.server.get_endpoint('list')
+                rsps.add("GET", _list.full_path,
+                         body=_list.process_request(_list.parse_request({}))["response_msg"],
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            _mock(rsps)
+            _graph = _crawler.crawl(TA1_ID)
+            _calls = len(rsps.calls)
+
+            assert set(_graph.nodes.keys()) == {TA1_ID, INTERMEDIATE_ID, LEAF_ID}
+            assert _graph.tree() == {TA1_ID: {INTERMEDIATE_ID: {LEAF_ID: {}}}}
+            assert _graph.superiors(LEAF_ID) == [INTERMEDIATE_ID]
+            assert _graph.entities(entity_type="openid_relying_party") == [LEAF_ID]
+            assert not os.path.exists(_crawler.checkpoint_file(TA1_ID))
+
+            # Nothing has expired so only the subordinates are listed again
+            assert _crawler.recrawl(_graph) is _graph
+            assert len(rsps.calls) == _calls + 2
+            assert {c.request.url.split("?")[0] for c in rsps.calls[_calls:]} == {
+                _e.server.get_endpoint('list').full_path for _e in [self.ta, self.intermediate]}
+            _calls = len(rsps.calls)
+
+            # An interrupted crawl is resumed where it stopped
+            _partial = FederationGraph.from_dict(_graph.to_dict())
+            _partial.nodes[LEAF_ID]["configuration"] = {}
+            _crawler._checkpoint(_partial, [(LEAF_ID, INTERMEDIATE_ID)], {TA1_ID, INTERMEDIATE_ID})
+            _resumed = _crawler.crawl(TA1_ID, resume=True)
+            assert len(rsps.calls) == _calls + 1
+            assert rsps.calls[-1].request.url.startswith(LEAF_ID)
+            assert _resumed.entities(entity_type="openid_relying_party") == [LEAF_ID]
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            _mock(rsps)
+            assert _fe.trawl("", TA1_ID, "openid_relying_party") == [LEAF_ID]
+
+        # A subordinate added after the last crawl is found when crawling again
+        _new = "https://rp.example.org"
+        self.intermediate.server.subordinate[_new] = {"jwks": {"keys": []},
+                                                      "entity_types": ["openid_relying_party"]}
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            _mock(rsps)
+            assert _fe.trawl("", TA1_ID, "openid_relying_party") == [LEAF_ID]
+            _graph = _fe.crawl(TA1_ID, max_age=0)
+            assert _new in _graph.subordinates(INTERMEDIATE_ID)
+            assert _graph.get(_new)["error"]
+
     def test_resolve(self):
         _msgs = create_trust_chain_messages(self.leaf["federation_entity"],
                                             self.intermediate,
@@ -352,6 +573,428 @@ class TestFunction:
         _trust_chains = verify_trust_chains(_federation_entity, _chains, _entity_conf)
         assert len(_trust_chains) == 2
 
+        # Modifying a verified statement doesn't change what is cached
+        for _metadata in _trust_chains[0].verified_chain[-1]["metadata"].values():
+            _metadata.clear()
+        _trust_chains[0].verified_chain[-1]["metadata"] = {}
+        assert all(parse_statement(_entity_conf).payload()["metadata"].values())
+
+    def test_collection_budget(self):
+        _federation_entity = self.leaf
+        _collector = _federation_entity["federation_entity"].function.trust_chain_collector
+        # The path leaf->intermediate->trust_anchor_1 is too long
+        _collector.max_superiors = 1
+
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _chains, _entity_conf = collect_trust_chains(_federation_entity, self.leaf.entity_id)
+            # Nothing fetched from the trust anchor above the intermediate
+            assert not [c for c in rsps.calls if c.request.url.startswith(TA1_ID)]
+
+        _trust_chains = verify_trust_chains(_federation_entity, _chains, _entity_conf)
+        assert len(_trust_chains) == 1
+        assert _trust_chains[0].anchor == TA2_ID
+
+        # Only follow one authority hint
+        _collector.max_superiors = 10
+        _collector.max_fan_out = 1
+        _collector.entity_statement_cache.clear()
+        _collector.config_cache.clear()
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _chains, _entity_conf = collect_trust_chains(_federation_entity, self.leaf.entity_id)
+            assert not [c for c in rsps.calls if c.request.url.startswith(TA2_ID)]
+
+        _trust_chains = verify_trust_chains(_federation_entity, _chains, _entity_conf)
+        assert len(_trust_chains) == 1
+        assert _trust_chains[0].anchor == TA1_ID
+
+    def test_circuit_probe_timeout(self):
+        _collector = self.leaf["federation_entity"].function.trust_chain_collector
+        _collector.failures = FailureCache(ttl={"default": 0, "ConnectionError": 0},
+                                           backoff_base=0, failure_threshold=1, reset_timeout=0)
+        _url = f"{TA2_ID}/.well-known/openid-federation"
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", _url, body=ConnectionError("Connection refused"))
+            with pytest.raises(ConnectionError):
+                _collector.fetch_document(_url)
+            assert _collector.failures.status()["hosts"]["2nd.ta.example.org"]["state"] == "open"
+
+            # The probe times out
+            rsps.replace("GET", _url, body=ReadTimeout("Read timed out"))
+            with pytest.raises(ReadTimeout):
+                _collector.fetch_document(_url)
+            # which opens the circuit again instead of leaving it waiting for the probe
+            with pytest.raises(ReadTimeout):
+                _collector.fetch_document(_url)
+            assert len(rsps.calls) == 3
+
+    def test_async_circuit_probe_timeout(self):
+        _federation_entity = self.leaf["federation_entity"]
+        _calls = []
+
+        async def _httpc(method, url, **kwargs):
+            _calls.append(url)
+            if len(_calls) == 1:
+                raise ConnectionError("Connection refused")
+            elif len(_calls) == 3:
+                # Never answers
+                await asyncio.sleep(10)
+            raise ReadTimeout("Read timed out")
+
+        _collector = AsyncTrustChainCollector(upstream_get=_federation_entity.unit_get,
+                                              httpc=_httpc)
+        _collector.collector.failures = FailureCache(
+            ttl={"default": 0, "ConnectionError": 0}, backoff_base=0, failure_threshold=1,
+            reset_timeout=0)
+        _url = f"{TA2_ID}/.well-known/openid-federation"
+
+        with pytest.raises(ConnectionError):
+            asyncio.run(_collector.fetch_document(_url))
+        # The probe times out
+        with pytest.raises(ReadTimeout):
+            asyncio.run(_collector.fetch_document(_url))
+        # The next probe is cancelled
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(_collector.fetch_document(_url), 0.1))
+        # Neither leaves the circuit waiting for the probe
+        with pytest.raises(ReadTimeout):
+            asyncio.run(_collector.fetch_document(_url))
+        assert len(_calls) == 4
+
+    def test_trust_chains_to_leaf_concurrent(self):
+        _federation_entity = self.leaf
+        _collector = _federation_entity["federation_entity"].function.trust_chain_collector
+        _collector.concurrent = True
+
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _chains, _entity_conf = collect_trust_chains(_federation_entity, self.leaf.entity_id)
+
+        _collector.shutdown()
+        # Same order as when collected one branch at the time
+        assert len(_chains) == 2
+        _trust_chains = verify_trust_chains(_federation_entity, _chains, _entity_conf)
+        assert [tc.anchor for tc in _trust_chains] == [TA1_ID, TA2_ID]
+
+    def test_trust_chains_keep_subtrees(self):
+        _federation_entity = self.leaf
+        _collector = _federation_entity["federation_entity"].function.trust_chain_collector
+        _collector.keep_subtrees = True
+
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _chains, _entity_conf = collect_trust_chains(_federation_entity, self.leaf.entity_id)
+
+        assert set(_collector.subtree_cache.keys()) == {
+            f"!!{INTERMEDIATE_ID}", f"!!{TA1_ID}", f"!!{TA2_ID}"}
+
+        # Everything needed is cached
+        with responses.RequestsMock(assert_all_requests_are_fired=False):
+            _chains2, _ = collect_trust_chains(_federation_entity, self.leaf.entity_id)
+
+        assert _chains2 == _chains
+
+    def test_statement_http_freshness(self):
+        _federation_entity = self.leaf
+        _collector = _federation_entity["federation_entity"].function.trust_chain_collector
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+
+        def _add(rsps):
+            for _url, _jwks in _msgs.items():
+                _headers = {"Content-Type": "application/json"}
+                if _url.endswith("/fetch"):
+                    # Shorter than the allowed delta
+                    _headers["Cache-Control"] = "max-age=300"
+                rsps.add("GET", _url, body=_jwks, adding_headers=_headers, status=200)
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            _add(rsps)
+            _chains, _ = collect_trust_chains(_federation_entity, LEAF_ID)
+            _fetched = [c.request.url for c in rsps.calls if "/fetch" in c.request.url]
+        assert _fetched
+
+        # Reused as long as the HTTP response allows
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            assert collect_trust_chains(_federation_entity, LEAF_ID)[0] == _chains
+            assert len(rsps.calls) == 0
+
+        for _url in _fetched:
+            _collector.http_cache.get(_url).reuse_until = utc_time_sans_frac() - 1
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            _add(rsps)
+            assert collect_trust_chains(_federation_entity, LEAF_ID)[0] == _chains
+            assert [c.request.url for c in rsps.calls if "/fetch" in c.request.url]
+
+    def test_shared_subtrees_max_superiors(self):
+        _federation_entity = self.leaf
+        _collector = _federation_entity["federation_entity"].function.trust_chain_collector
+
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+
+        # As when resolving a batch of entities
+        _subtrees = {}
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _resolution = _collector.new_resolution(leaf=LEAF_ID, subtrees=_subtrees)
+            _chains, _ = collect_trust_chains(_federation_entity, LEAF_ID,
+                                              resolution=_resolution)
+            assert len(_chains) == 2
+
+            # The intermediate's superior tree is too high to be reused
+            _collector.max_superiors = 1
+            _resolution = _collector.new_resolution(leaf=LEAF_ID, subtrees=_subtrees)
+            _chains, _entity_conf = collect_trust_chains(_federation_entity, LEAF_ID,
+                                                         resolution=_resolution)
+
+        _trust_chains = verify_trust_chains(_federation_entity, _chains, _entity_conf)
+        assert [tc.anchor for tc in _trust_chains] == [TA2_ID]
+
+    def test_first_verified_trust_chain(self):
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+        self.leaf["federation_entity"].context.tr_priority = [TA2_ID, TA1_ID]
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _trust_chain = get_first_verified_trust_chain(self.leaf, LEAF_ID)
+
+            # Nothing fetched from the intermediate
+            assert not [c for c in rsps.calls if INTERMEDIATE_ID in c.request.url]
+
+        assert _trust_chain.anchor == TA2_ID
+        assert _trust_chain.iss_path == [LEAF_ID, TA2_ID]
+        assert _trust_chain.metadata
+
+    def test_first_verified_trust_chain_priority(self):
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+        # The preferred trust anchor is only reached through the intermediate
+        self.leaf["federation_entity"].context.tr_priority = [TA1_ID, TA2_ID]
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _trust_chain = get_first_verified_trust_chain(self.leaf, LEAF_ID)
+
+        assert _trust_chain.anchor == TA1_ID
+        assert _trust_chain.iss_path == [LEAF_ID, INTERMEDIATE_ID, TA1_ID]
+
+    def test_first_verified_trust_chain_failing_hint(self):
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _ta2_msgs = create_trust_chain_messages(self.leaf, self.ta2)
+        self.leaf["federation_entity"].context.tr_priority = []
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+            # The second trust anchor can not be reached
+            for _url in _ta2_msgs.keys():
+                if _url not in _msgs:
+                    rsps.add("GET", _url, body=ConnectionError("unreachable"))
+
+            _trust_chain = get_first_verified_trust_chain(self.leaf, LEAF_ID)
+
+        assert _trust_chain.anchor == TA1_ID
+        assert _trust_chain.iss_path == [LEAF_ID, INTERMEDIATE_ID, TA1_ID]
+
+    def test_verified_chain_cache(self):
+        _federation_entity = self.leaf
+        _verifier = _federation_entity["federation_entity"].function.verifier
+
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _chains, _entity_conf = collect_trust_chains(_federation_entity, self.leaf.entity_id)
+
+        _chain = _chains[0] + [_entity_conf]
+        _first = _verifier(_chain)
+        assert _verifier.verified_cache.statistics()["hits"] == 0
+        _second = _verifier(_chain[:])
+        assert _verifier.verified_cache.statistics()["hits"] == 1
+        assert _second is not _first
+        assert _second.iss_path == _first.iss_path
+        assert _second.exp == _first.exp
+
+        # A change of trust anchor keys invalidates the cache
+        _federation_entity["federation_entity"].add_trust_anchor(
+            TA1_ID, self.ta1["federation_entity"].keyjar.export_jwks())
+        assert len(_verifier.verified_cache) == 0
+
+    def test_refresh_trust_chain(self):
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _trust_chains = get_verified_trust_chains(self.leaf, LEAF_ID)
+
+        _trust_chain = [tc for tc in _trust_chains if tc.anchor == TA1_ID][0]
+        assert _trust_chain.iss_path == [LEAF_ID, INTERMEDIATE_ID, TA1_ID]
+        # Not expired, nothing to do
+        assert refresh_trust_chain(self.leaf, _trust_chain) is _trust_chain
+
+        # Pretend the entity configuration has expired
+        _trust_chain.verified_chain[-1]["exp"] = 0
+        assert _trust_chain.limiting_link() == 2
+        _leaf_url = f"{LEAF_ID}/.well-known/openid-federation"
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", _leaf_url, body=_msgs[_leaf_url],
+                     adding_headers={"Content-Type": "application/json"}, status=200)
+            _refreshed = refresh_trust_chain(self.leaf, _trust_chain)
+
+        assert _refreshed.exp > 0
+        assert _refreshed.iss_path == _trust_chain.iss_path
+        assert _refreshed.metadata == _trust_chain.metadata
+
+        # Pretend the intermediate's statement about the leaf has expired
+        _refreshed.verified_chain[1]["exp"] = 0
+        _fetch_url = [u for u in _msgs if u.startswith(f"{INTERMEDIATE_ID}/fetch")][0]
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", _fetch_url, body=_msgs[_fetch_url],
+                     adding_headers={"Content-Type": "application/json"}, status=200)
+            _second = refresh_trust_chain(self.leaf, _refreshed)
+
+        assert _second.exp > 0
+        assert _second.metadata == _trust_chain.metadata
+
+    def test_refresh_scheduler(self):
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            self.leaf["federation_entity"].get_trust_chains(LEAF_ID)
+
+        _collector = self.leaf["federation_entity"].function.trust_chain_collector
+        _scheduler = RefreshScheduler(_collector.upstream_get, refresh_ahead=60, jitter=0,
+                                      host_rate=0)
+        _tracked = {(t.kind, t.key) for t in _scheduler.tracked()}
+        assert ("configuration", LEAF_ID) in _tracked
+        assert ("configuration", INTERMEDIATE_ID) in _tracked
+        assert ("statement", f"{INTERMEDIATE_ID}!!{LEAF_ID}") in _tracked
+        assert ("trust_chain", LEAF_ID) in _tracked
+
+        # Nothing is about to expire
+        assert _scheduler.due() == []
+        _later = max(t.exp for t in _scheduler.tracked())
+        assert len(_scheduler.due(now=_later)) == len(_tracked)
+
+        # At most one refresh per host
+        _scheduler = RefreshScheduler(_collector.upstream_get, refresh_ahead=60, jitter=0,
+                                      host_rate=0.001, host_burst=1)
+        _hosts = [t.host for t in _scheduler.due(now=_later)]
+        assert len(_hosts) == len(set(_hosts))
+
+    def test_resolve_many(self):
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+        _unknown = "https://unknown.example.org"
+
+        _federation_entity = self.leaf["federation_entity"]
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _batch = _federation_entity.resolve_many(
+                [LEAF_ID, INTERMEDIATE_ID, _unknown, LEAF_ID], max_workers=2, store=True)
+            _results = _batch.results()
+
+        assert set(_results.keys()) == {LEAF_ID, INTERMEDIATE_ID, _unknown}
+        assert {tc.anchor for tc in _results[LEAF_ID]} == {TA1_ID, TA2_ID}
+        assert [tc.anchor for tc in _results[INTERMEDIATE_ID]] == [TA1_ID]
+        assert isinstance(_results[_unknown], Exception)
+        assert LEAF_ID in _federation_entity.trust_chain
+        assert _unknown not in _federation_entity.trust_chain
+
+        _timings = _batch.timings
+        assert _timings["entities"] == 3
+        assert _timings["resolved"] == 2
+        assert _timings["failed"] == 1
+        assert _timings["elapsed"] >= _timings["max"]
+
+    def test_federation_index(self, tmp_path):
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+        for _entity in [self.ta1, self.intermediate]:
+            _list = _entity.server.get_endpoint('list')
+            _msgs[_list.full_path] = _list.process_request(_list.parse_request({}))[
+                "response_msg"]
+
+        _federation_entity = self.leaf["federation_entity"]
+        _file_name = str(tmp_path / "index.json")
+        _index = FederationIndex(_federation_entity.unit_get, file_name=_file_name,
+                                 check_with_issuer=False)
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            assert _index.find(TA1_ID) == sorted([INTERMEDIATE_ID, LEAF_ID])
+            _calls = len(rsps.calls)
+            assert _index.find(TA1_ID, entity_type="openid_relying_party") == [LEAF_ID]
+            assert _index.find(TA1_ID, credential_type="PersonIdentificationData") == []
+            # Answered from the index
+            assert len(rsps.calls) == _calls
+
+        assert _index.updated(TA1_ID)
+        assert "openid_relying_party" in _index.metadata(TA1_ID, LEAF_ID)
+
+        # Entities whose trust chains have expired are not returned
+        _index.index[TA1_ID]["entities"][LEAF_ID]["exp"] = 1
+        assert _index.find(TA1_ID) == [INTERMEDIATE_ID]
+        assert _index.metadata(TA1_ID, LEAF_ID) is None
+
+        # Picked up from the file
+        _loaded = FederationIndex(_federation_entity.unit_get, file_name=_file_name)
+        assert _loaded.updated(TA1_ID) == _index.updated(TA1_ID)
+        assert _loaded.find(TA1_ID, entity_type="federation_entity") == sorted(
+            [INTERMEDIATE_ID, LEAF_ID])
+
     def test_upstream_context_attribute(self):
         leaf_fe = self.leaf["federation_entity"]
         assert leaf_fe.client.upstream_get('context_attribute', 'entity_id') == LEAF_ID
@@ -396,3 +1039,106 @@ class TestFunction:
         assert trust_chain
         assert trust_chain.anchor == TA1_ID
         assert trust_chain.iss_path == [LEAF_ID, INTERMEDIATE_ID, TA1_ID]
+
+
+X_ID = "https://x.example.org"
+Y_ID = "https://y.example.org"
+
+FEDERATION_CONFIG_4 = {
+    TA1_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [X_ID],
+        "kwargs": {}
+    },
+    TA2_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [Y_ID],
+        "kwargs": {}
+    },
+    X_ID: {
+        "entity_type": "intermediate",
+        "subordinates": [LEAF_ID, Y_ID],
+        "kwargs": {
+            "authority_hints": [Y_ID, TA1_ID]
+        }
+    },
+    Y_ID: {
+        "entity_type": "intermediate",
+        "subordinates": [LEAF_ID, X_ID],
+        "kwargs": {
+            "authority_hints": [X_ID, TA2_ID]
+        }
+    },
+    LEAF_ID: {
+        "entity_type": "openid_relying_party",
+        "trust_anchors": [TA1_ID, TA2_ID],
+        "kwargs": {
+            "authority_hints": [Y_ID, X_ID]
+        }
+    }
+}
+
+
+class TestLoop:
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self):
+        # Two intermediates that are each other's superiors
+        #       TA1       TA2
+        #        |         |
+        #        X <-----> Y
+        #         \       /
+        #          +LEAF-+
+
+        self.federation_entity = build_federation(FEDERATION_CONFIG_4)
+        self.leaf = self.federation_entity[LEAF_ID]
+
+    def _mock(self, rsps):
+        for _entity_id, _entity in self.federation_entity.items():
+            if _entity_id == LEAF_ID:
+                _entity = _entity["federation_entity"]
+            _endpoint = _entity.server.get_endpoint('entity_configuration')
+            rsps.add("GET", _endpoint.full_path, body=_endpoint.process_request({})["response"],
+                     adding_headers={"Content-Type": "application/json"}, status=200)
+            if _entity_id == LEAF_ID:
+                continue
+            rsps.add_callback("GET", _entity.server.get_endpoint('fetch').full_path,
+                              callback=self._fetch_callback(_entity))
+
+    @staticmethod
+    def _fetch_callback(entity):
+        _endpoint = entity.server.get_endpoint('fetch')
+
+        def _callback(request):
+            _args = {k: v[0] for k, v in parse_qs(urlparse(request.url).query).items()}
+            _args["iss"] = entity.entity_id
+            _msg = _endpoint.process_request(_endpoint.parse_request(_args))["response_msg"]
+            return 200, {"Content-Type": "application/json"}, _msg
+
+        return _callback
+
+    def test_trust_chains_through_loop(self):
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            self._mock(rsps)
+            _trust_chains = get_verified_trust_chains(self.leaf, LEAF_ID)
+
+        # A subtree pruned where the loop was found on one path isn't reused on another
+        assert sorted(tc.iss_path for tc in _trust_chains) == [
+            [LEAF_ID, X_ID, TA1_ID],
+            [LEAF_ID, X_ID, Y_ID, TA2_ID],
+            [LEAF_ID, Y_ID, TA2_ID],
+            [LEAF_ID, Y_ID, X_ID, TA1_ID]
+        ]
+
+    def test_resolve_many_through_loop(self):
+        _federation_entity = self.leaf["federation_entity"]
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            self._mock(rsps)
+            _results = _federation_entity.resolve_many([LEAF_ID, X_ID, Y_ID],
+                                                       max_workers=1).results()
+
+        assert len(_results[LEAF_ID]) == 4
+        assert sorted(tc.iss_path for tc in _results[X_ID]) == [
+            [X_ID, TA1_ID], [X_ID, Y_ID, TA2_ID]]
+        assert sorted(tc.iss_path for tc in _results[Y_ID]) == [
+            [Y_ID, TA2_ID], [Y_ID, X_ID, TA1_ID]]
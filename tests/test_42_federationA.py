@@ -1,9 +1,13 @@
+import asyncio
+
 import pytest
 import responses
 
 from fedservice.entity.function import apply_policies
 from fedservice.entity.function import collect_trust_chains
 from fedservice.entity.function import verify_trust_chains
+from fedservice.entity.function import async_trust_chain_collector
+from fedservice.entity.function.async_trust_chain_collector import AsyncTrustChainCollector
 from tests import create_trust_chain_messages
 from tests.build_federation import build_federation
 
@@ -124,3 +128,26 @@ class TestComboCollect(object):
         assert leaf_ec_2
         assert leaf_ec_1 == leaf_ec_2
         assert chains_1 == chains_2
+
+    def test_async_collect_trust_chain(self):
+        _federation_entity = self.rp["federation_entity"]
+        _function = _federation_entity.function
+        _function.async_trust_chain_collector = AsyncTrustChainCollector(
+            upstream_get=_function.unit_get)
+
+        _msgs = create_trust_chain_messages(self.op, self.ta)
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            trust_chains = asyncio.run(
+                async_trust_chain_collector.get_verified_trust_chains(self.rp, OP_ID))
+
+        assert len(trust_chains) == 1
+        assert set(trust_chains[0].metadata.keys()) == {'federation_entity', 'openid_provider'}
+
+        # The caches are shared with the synchronous collector
+        chains, leaf_ec = collect_trust_chains(self.rp, OP_ID)
+        assert len(chains) == 1
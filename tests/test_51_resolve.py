@@ -112,3 +112,32 @@ class TestComboCollect(object):
 
         _trust_chains = apply_policies(self.rp, _trust_chains)
         assert _trust_chains[0].metadata == payload['metadata']
+
+    def test_resolver_cache(self):
+        resolver = self.ta.server.endpoint["resolve"]
+
+        where_and_what = create_trust_chain_messages(self.rp, self.im, self.ta)
+
+        resolver_query = {'sub': self.rp.entity_id,
+                          'anchor': self.ta.entity_id}
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in where_and_what.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            response = resolver.process_request(resolver_query)
+
+        # No HTTP requests allowed, it must come from the cache
+        with responses.RequestsMock():
+            _second = resolver.process_request(resolver_query)
+        assert _second["response_args"] == response["response_args"]
+
+        # Different parameters, different response
+        assert resolver.cache_key(resolver_query, True) != resolver.cache_key(resolver_query,
+                                                                              False)
+        assert len(resolver.response_cache) == 1
+
+        # A new key for the trust anchor invalidates it
+        self.ta.add_trust_anchor(self.ta.entity_id, self.ta.keyjar.export_jwks())
+        assert len(resolver.response_cache) == 0
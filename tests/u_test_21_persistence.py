@@ -167,15 +167,12 @@ class TestEndpointPersistence(object):
         assert _info['iss'] == fedop1
         assert _info['metadata']['federation_entity']['federation_fetch_endpoint'] == 'https://feide.no/fetch'
 
-        # For each entity statement there is also the expiration time
-        assert len(_collector.entity_statement_cache) == 6
+        # The expiration time is kept with each entity statement
+        assert len(_collector.entity_statement_cache) == 3
         assert set(_collector.entity_statement_cache.keys()) == {
             'https://feide.no!!https://ntnu.no',
-            'https://feide.no!exp!https://ntnu.no',
             'https://ntnu.no!!https://op.ntnu.no',
-            'https://ntnu.no!exp!https://op.ntnu.no',
-            'https://swamid.se!!https://ntnu.no',
-            'https://swamid.se!exp!https://ntnu.no'
+            'https://swamid.se!!https://ntnu.no'
         }
 
         # have a look at the payload
@@ -199,15 +196,12 @@ class TestEndpointPersistence(object):
         assert _info['iss'] == fedop1
         assert _info['metadata']['federation_entity']['federation_fetch_endpoint'] == 'https://feide.no/fetch'
 
-        # For each entity statement there is also the expiration time
-        assert len(_c2.entity_statement_cache) == 6
+        # The expiration time is kept with each entity statement
+        assert len(_c2.entity_statement_cache) == 3
         assert set(_c2.entity_statement_cache.keys()) == {
             'https://feide.no!!https://ntnu.no',
-            'https://feide.no!exp!https://ntnu.no',
             'https://ntnu.no!!https://op.ntnu.no',
-            'https://ntnu.no!exp!https://op.ntnu.no',
-            'https://swamid.se!!https://ntnu.no',
-            'https://swamid.se!exp!https://ntnu.no'
+            'https://swamid.se!!https://ntnu.no'
         }
 
         # have a look at the payload